@@ -0,0 +1,96 @@
+import logging
+import time
+from typing import Callable, Optional
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveConcurrency:
+    """An AIMD (additive increase, multiplicative decrease) controller for
+    the number of downloads that may be in flight at once.
+
+    Completed downloads are recorded with record(). Once per window of
+    completions the aggregate throughput and mean latency of that window are
+    compared with the previous window:
+        - any 429/503 responses halve the limit
+        - falling throughput or sharply rising latency reduce the limit by 1
+        - otherwise the limit grows by 1 up to the ceiling
+
+    Attributes:
+        limit: the number of downloads currently allowed in flight
+        ceiling: hard maximum for limit (--max-threads)
+    """
+
+    # relative change in throughput or latency that is treated as significant
+    TOLERANCE: float = 0.1
+    LATENCY_TOLERANCE: float = 0.5
+
+    def __init__(
+        self,
+        ceiling: int,
+        window: int = 10,
+        floor: int = 1,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ceiling = max(ceiling, floor)
+        self.floor = floor
+        self.window = window
+        self.limit = max(floor, min(self.ceiling, 4))
+        self._clock = clock
+        self._last_rate: Optional[float] = None
+        self._last_latency: Optional[float] = None
+        self._reset()
+
+    def _reset(self):
+        self._start = self._clock()
+        self._bytes = 0
+        self._count = 0
+        self._latency = 0.0
+        self._throttled = 0
+
+    def record(self, size: int, seconds: float, throttled: bool = False):
+        """record the outcome of a single download"""
+        self._bytes += size
+        self._count += 1
+        self._latency += seconds
+        if throttled:
+            self._throttled += 1
+        if self._count >= max(self.window, self.limit):
+            self.adjust()
+
+    def adjust(self):
+        elapsed = max(self._clock() - self._start, 1e-6)
+        rate = self._bytes / elapsed
+        latency = self._latency / max(self._count, 1)
+        previous = self.limit
+
+        if self._throttled:
+            self.limit = max(self.floor, self.limit // 2)
+            reason = "{} throttled responses".format(self._throttled)
+        elif self._last_rate is not None and rate < self._last_rate * (
+            1 - self.TOLERANCE
+        ):
+            self.limit = max(self.floor, self.limit - 1)
+            reason = "throughput falling"
+        elif self._last_latency is not None and latency > self._last_latency * (
+            1 + self.LATENCY_TOLERANCE
+        ):
+            self.limit = max(self.floor, self.limit - 1)
+            reason = "latency rising"
+        else:
+            self.limit = min(self.ceiling, self.limit + 1)
+            reason = "throughput steady or rising"
+
+        level = logging.INFO if self.limit != previous else logging.DEBUG
+        log.log(
+            level,
+            "download concurrency %d -> %d (%s: %.2f MB/s, latency %.2fs)",
+            previous,
+            self.limit,
+            reason,
+            rate / 1024 / 1024,
+            latency,
+        )
+        self._last_rate = rate
+        self._last_latency = latency
+        self._reset()
@@ -0,0 +1,75 @@
+import asyncio
+import concurrent.futures as futures
+import logging
+from threading import Thread
+from typing import Any, Callable, Coroutine, Optional
+
+try:
+    import aiohttp  # type: ignore
+
+    _use_aiohttp = True
+except ImportError:
+    aiohttp = None  # type: ignore
+    _use_aiohttp = False
+
+log = logging.getLogger(__name__)
+
+"""
+An alternative to concurrent.futures.ThreadPoolExecutor for the download of
+media items. A single event loop, running in its own thread, services all of
+the concurrent downloads so that hundreds of streams can be open at once
+without a thread (and its stack) per stream.
+
+Requires the optional dependency aiohttp (pip install gphotos-sync[async])
+"""
+
+
+def available() -> bool:
+    return _use_aiohttp
+
+
+class AsyncDownloadPool:
+    """Runs download coroutines on a private event loop.
+
+    submit() has the same contract as ThreadPoolExecutor.submit() except that
+    it takes a coroutine function. The coroutine function is passed the
+    shared aiohttp.ClientSession followed by the supplied arguments.
+    The returned concurrent.futures.Future can be used exactly like those
+    returned from a ThreadPoolExecutor (done, exception, cancel, wait etc.)
+    """
+
+    def __init__(self, max_streams: int):
+        if not _use_aiohttp:
+            raise ImportError("the async download engine requires the aiohttp package")
+        self.max_streams = max_streams
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(
+            target=self._loop.run_forever, name="gphotos-download-loop", daemon=True
+        )
+        self._thread.start()
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+
+    async def _start(self):
+        # these must be created inside the running loop
+        self._semaphore = asyncio.Semaphore(self.max_streams)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_streams)
+        )
+
+    async def _run(self, fn: Callable[..., Coroutine], *args: Any):
+        async with self._semaphore:  # type: ignore
+            return await fn(self._session, *args)
+
+    def submit(self, fn: Callable[..., Coroutine], *args: Any) -> futures.Future:
+        return asyncio.run_coroutine_threadsafe(self._run(fn, *args), self._loop)
+
+    def shutdown(self):
+        if self._loop.is_closed():
+            return
+        if self._session:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -13,6 +13,9 @@ class BaseMedia(object):
 
     TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+    # subclasses that also declare __slots__ have no per instance __dict__
+    __slots__ = ("_id", "_relative_folder", "_root_path", "_duplicate_number")
+
     def __init__(self, root_path: Path = Path(""), **k_args):
         self._id: str = ""
         self._relative_folder: Path = Path("")
@@ -2,7 +2,7 @@
 # coding: utf8
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, TypeVar
+from typing import Optional, TypeVar, Union
 
 from gphotos_sync import Utils
 from gphotos_sync.BaseMedia import BaseMedia
@@ -35,8 +35,26 @@ class DatabaseMedia(BaseMedia):
         _create_date: creation date
         _description:
         _downloaded: true if previously downloaded to disk
+
+    The dates may be passed as values straight from the DB, in which case
+    they are only converted if they are used.
     """
 
+    __slots__ = (
+        "_uid",
+        "_url",
+        "_filename",
+        "_orig_name",
+        "_size",
+        "_mime_type",
+        "_description",
+        "_date",
+        "_create_date",
+        "_downloaded",
+        "_location",
+        "_is_shared_album",
+    )
+
     def __init__(
         self,
         _id: str = "",
@@ -49,8 +67,8 @@ class DatabaseMedia(BaseMedia):
         _size: int = 0,
         _mime_type: str = "",
         _description: str = "",
-        _date: datetime = Utils.MINIMUM_DATE,
-        _create_date: datetime = Utils.MINIMUM_DATE,
+        _date: Union[datetime, int, str] = Utils.MINIMUM_DATE,
+        _create_date: Union[datetime, int, str] = Utils.MINIMUM_DATE,
         _downloaded: bool = False,
         _location: str = "",
         _is_shared_album: bool = False,
@@ -130,14 +148,18 @@ class DatabaseMedia(BaseMedia):
         """
         Creation date
         """
-        return self._create_date
+        if isinstance(self._create_date, (int, str)):
+            self._create_date = Utils.timestamp_to_date(self._create_date)  # type: ignore
+        return self._create_date  # type: ignore
 
     @property
     def modify_date(self) -> datetime:
         """
         Modify Date
         """
-        return self._date
+        if isinstance(self._date, (int, str)):
+            self._date = Utils.timestamp_to_date(self._date)  # type: ignore
+        return self._date  # type: ignore
 
     @property
     def url(self) -> str:
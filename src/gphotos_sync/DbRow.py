@@ -1,6 +1,7 @@
 import logging
+from collections import namedtuple
 from datetime import datetime
-from typing import Any, ClassVar, Dict, List, Mapping, Type, TypeVar
+from typing import Any, ClassVar, Dict, List, Mapping, Sequence, Tuple, Type, TypeVar
 
 from gphotos_sync.BaseMedia import BaseMedia
 from gphotos_sync.DatabaseMedia import DatabaseMedia
@@ -64,6 +65,27 @@ class DbRow:
     def __bool__(self) -> bool:
         return not self.empty
 
+    # namedtuple classes for tuple_type, keyed on (table, columns)
+    _tuple_types: ClassVar[Dict[Tuple[str, Tuple[str, ...]], Type[tuple]]] = {}
+
+    @classmethod
+    def tuple_type(cls, columns: Sequence[str]) -> Type[tuple]:
+        """A namedtuple class for a subset of this table's columns.
+
+        Used by LocalData.get_columns_by_search: the values are as stored in
+        the DB (no date parsing) and the tuples have no __dict__, so they are
+        much cheaper than full row objects for large scans
+        """
+        key = (cls.table, tuple(columns))
+        if key not in DbRow._tuple_types:
+            unknown = set(columns) - set(cls.cols_def)
+            if unknown:
+                raise ValueError("{0} does not have columns {1}".format(cls, unknown))
+            DbRow._tuple_types[key] = namedtuple(  # type: ignore
+                cls.__name__ + "Columns", columns
+            )
+        return DbRow._tuple_types[key]
+
     T = TypeVar("T", bound="DbRow")
 
     # factory method for delivering a DbRow derived object based on named arguments
@@ -101,7 +123,7 @@ class DbRow:
                 if not result_row:
                     value = None
                 elif col_type == datetime:
-                    value = Utils.string_to_date(result_row[col])
+                    value = Utils.timestamp_to_date(result_row[col])
                 else:
                     value = result_row[col]
                 setattr(self, col, value)
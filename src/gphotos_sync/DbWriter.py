@@ -0,0 +1,126 @@
+import logging
+import sqlite3 as lite
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Event, Thread
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+"""
+A single writer for the index DB. SQLite allows one writer at a time, so
+rather than have threads share (and lock around) one connection, a thread of
+its own owns the connection that writes and the other threads queue their
+changes for it. Readers use connections of their own, which requires the DB
+to use a write ahead log so that they are not blocked by the writer.
+"""
+
+# (sql, parameters, True for executemany)
+Command = Tuple[str, Any, bool]
+
+
+class DbWriter:
+    """Applies write commands queued from any number of threads.
+
+    execute() and executemany() return as soon as the command is queued.
+    When the writer thread picks up a command it also takes whatever else is
+    waiting on the queue (up to BATCH_SIZE commands) and applies them all in
+    one transaction, so the number of commits falls as the load rises.
+
+    If a command fails its batch is rolled back and the commands of the batch
+    are retried in a transaction each, so only the failing command is lost.
+    The first error is raised by the next call to flush() or close().
+    """
+
+    BATCH_SIZE: int = 1000
+    # the number of commands that may be queued before producers wait
+    QUEUE_SIZE: int = 10000
+
+    def __init__(self, db_file: Path, pragmas: Dict[str, Any]):
+        self._queue: Queue = Queue(maxsize=self.QUEUE_SIZE)
+        self._error: Optional[BaseException] = None
+        # autocommit mode, the transactions are managed by _apply
+        self._con = lite.connect(
+            str(db_file), check_same_thread=False, isolation_level=None
+        )
+        for pragma, value in pragmas.items():
+            self._con.execute("PRAGMA {}={};".format(pragma, value))
+        self._thread = Thread(target=self._run, name="gphotos-db-writer", daemon=True)
+        self._thread.start()
+
+    def execute(self, sql: str, params: Any = ()):
+        self._put((sql, params, False))
+
+    def executemany(self, sql: str, seq_of_params: Iterable[Any]):
+        # parameters are gathered in the calling thread
+        self._put((sql, list(seq_of_params), True))
+
+    def flush(self):
+        """wait until every command queued before this call is committed"""
+        done = Event()
+        self._put(done)
+        done.wait()
+        self._raise()
+
+    def close(self):
+        """commit the outstanding commands and stop the writer thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise()
+
+    def _put(self, item: Any):
+        if not self._thread.is_alive():
+            raise RuntimeError("the database writer is closed")
+        self._queue.put(item)
+
+    def _raise(self):
+        error, self._error = self._error, None
+        if error:
+            raise error
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            commands = [item for item in batch if isinstance(item, tuple)]
+            if commands:
+                self._apply(commands)
+            for item in batch:
+                if isinstance(item, Event):
+                    item.set()
+                elif item is None:
+                    stop = True
+        self._con.close()
+
+    def _apply(self, commands: List[Command]):
+        cur = self._con.cursor()
+        try:
+            cur.execute("BEGIN")
+            for sql, params, many in commands:
+                if many:
+                    cur.executemany(sql, params)
+                else:
+                    cur.execute(sql, params)
+            cur.execute("COMMIT")
+        except Exception as e:
+            if self._con.in_transaction:
+                cur.execute("ROLLBACK")
+            if len(commands) > 1:
+                for command in commands:
+                    self._apply([command])
+            else:
+                sql, params, many = commands[0]
+                if isinstance(e, lite.IntegrityError):
+                    rows = len(params) if many else 1
+                    log.error("SQL constraint issue writing %d rows: %s", rows, e)
+                log.error("database write failed: %s\n%s", sql, e)
+                if self._error is None:
+                    self._error = e
+        finally:
+            cur.close()
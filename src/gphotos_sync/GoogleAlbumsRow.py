@@ -1,7 +1,6 @@
 import logging
 from datetime import datetime
 
-from gphotos_sync import Utils
 from gphotos_sync.DatabaseMedia import DatabaseMedia
 from gphotos_sync.DbRow import DbRow
 from gphotos_sync.GoogleAlbumMedia import GoogleAlbumMedia
@@ -56,7 +55,7 @@ class GoogleAlbumsRow(DbRow):
             Size=size,
             StartDate=start,
             EndDate=end,
-            SyncDate=Utils.date_to_string(datetime.now()),
+            SyncDate=datetime.now(),
             Downloaded=0,
             IsSharedAlbum=is_shared,
         )
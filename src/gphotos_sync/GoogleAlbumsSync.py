@@ -4,7 +4,7 @@ import re
 import shutil
 from datetime import datetime
 from pathlib import Path
-from typing import Callable, Dict, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 from gphotos_sync.Checks import get_check
 
@@ -102,6 +102,10 @@ class GoogleAlbumsSync(object):
                     media_json = []
                     log.warning("*** Empty Media JSON with a Next Page Token")
 
+            album_files: List[Tuple[str, str, int]] = []
+            rows: List[GooglePhotosRow] = []
+            page_ids: Set[str] = set()
+            pending: Dict[Tuple[str, str], int] = {}
             for media_item_json in media_json:
                 position += 1
                 media_item = GooglePhotosMedia(media_item_json)
@@ -111,7 +115,7 @@ class GoogleAlbumsSync(object):
                     continue
 
                 log.debug("----%s", media_item.filename)
-                self._db.put_album_file(album_id, media_item.id, position)
+                album_files.append((album_id, media_item.id, position))
                 last_date = max(media_item.create_date, last_date)
                 first_date = min(media_item.create_date, first_date)
 
@@ -123,15 +127,19 @@ class GoogleAlbumsSync(object):
                 #  the folder. Currently with the meta data available it would
                 #  be impossible to eliminate these without eliminating other
                 #  cases where date and filename (TITLE) match
-                if add_media_items:
+                if add_media_items and media_item.id not in page_ids:
+                    page_ids.add(media_item.id)
                     media_item.set_path_by_date(
                         self._photos_folder, self._use_flat_path
                     )
-                    (num, _) = self._db.file_duplicate_no(
+                    num, row = self._db.file_duplicate_no(
                         str(media_item.filename),
                         str(media_item.relative_folder),
                         media_item.id,
+                        pending,
                     )
+                    if row:
+                        continue
                     # we just learned if there were any duplicates in the db
                     media_item.duplicate_number = num
 
@@ -141,7 +149,10 @@ class GoogleAlbumsSync(object):
                         media_item.filename,
                         media_item.duplicate_number,
                     )
-                    self._db.put_row(GooglePhotosRow.from_media(media_item), False)
+                    rows.append(GooglePhotosRow.from_media(media_item))
+
+            self._db.put_album_files(album_files)
+            self._db.put_rows(rows)
 
             next_page = items_json.get("nextPageToken")
             if next_page:
@@ -300,8 +311,8 @@ class GoogleAlbumsSync(object):
             path,
             file_name,
             album_name,
-            start_date_str,
-            end_date_str,
+            start_stamp,
+            end_stamp,
             rid,
             created,
             sharedAlbum,
@@ -314,8 +325,12 @@ class GoogleAlbumsSync(object):
                 self._db.put_album_downloaded(rid)
                 current_rid = rid
                 album_item = 0
-            end_date = Utils.string_to_date(end_date_str)
-            start_date = Utils.string_to_date(start_date_str)
+                # rows are ordered by album so these only change here
+                end_date = Utils.timestamp_to_date(end_stamp)
+                start_date = Utils.timestamp_to_date(start_stamp)
+                link_folder: Path = self.album_folder_name(
+                    album_name, start_date, end_date, sharedAlbum
+                )
 
             if len(str(self._root_folder / path)) > get_check().max_path:
                 max_path_len = get_check().max_path - len(str(self._root_folder))
@@ -329,10 +344,6 @@ class GoogleAlbumsSync(object):
 
             full_file_name = self._root_folder / path / file_name
 
-            link_folder: Path = self.album_folder_name(
-                album_name, start_date, end_date, sharedAlbum
-            )
-
             if self._no_album_sorting:
                 link_filename = "{}".format(file_name)
             else:
@@ -349,7 +360,7 @@ class GoogleAlbumsSync(object):
                     log.debug("new album folder %s", link_folder)
                     link_folder.mkdir(parents=True)
 
-                created_date = Utils.string_to_date(created)
+                created_date = Utils.timestamp_to_date(created)
                 if full_file_name.exists():
                     if self._use_hardlinks:
                         os.link(full_file_name, link_file)
@@ -1,28 +1,49 @@
 # type: ignore
 # lots of typing issues in this file, partly due to use of asyncIO Future
 # and concurrent Future - TODO: for reviewimport concurrent.futures as futures
+import asyncio
+import base64
 import concurrent.futures as futures
 import errno
+import hashlib
 import logging
 import os
+import re
 import shutil
-import tempfile
+import time
 from asyncio import Future
+from collections import deque
 from datetime import datetime
 from itertools import zip_longest
 from pathlib import Path
-from typing import Dict, Iterable, List, Mapping, Union
+from threading import Event
+from typing import (
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import requests
 from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException, Timeout
+from urllib3.exceptions import HTTPError
 from urllib3.util.retry import Retry
 
 from gphotos_sync import Utils
+from gphotos_sync.AdaptiveConcurrency import AdaptiveConcurrency
+from gphotos_sync.AsyncDownloadPool import AsyncDownloadPool, aiohttp
 from gphotos_sync.BadIds import BadIds
+from gphotos_sync.BaseMedia import BaseMedia
 from gphotos_sync.DatabaseMedia import DatabaseMedia
 from gphotos_sync.GooglePhotosRow import GooglePhotosRow
 from gphotos_sync.LocalData import LocalData
+from gphotos_sync.RateLimiter import THROTTLE_STATUSES, RateLimiter, was_throttled
 from gphotos_sync.restclient import RestClient
 
 from .Settings import Settings
@@ -38,15 +59,46 @@ except ImportError:
 
 log = logging.getLogger(__name__)
 
+# the total size of the media is the final group in a Content-Range header
+CONTENT_RANGE = re.compile(r"bytes \d+-\d+/(\d+|\*)")
+
+
+class DownloadStats(NamedTuple):
+    """returned by a completed download for AdaptiveConcurrency"""
+
+    size: int
+    seconds: float
+    throttled: bool
+
+
+class IncompleteDownload(RequestException):
+    """A download stopped before all of the media was received. Its partial
+    file is kept so that a later attempt can resume where it stopped"""
+
+
+class StalePartial(RequestException):
+    """The server refused a Range request to resume a download, so the media
+    no longer matches the partial download"""
+
 
 class GooglePhotosDownload(object):
     """A Class for managing the indexing and download of Google Photos"""
 
     PAGE_SIZE: int = 100
     BATCH_SIZE: int = 40
+    CHUNK_SIZE: int = 1024 * 64
+    BACKOFF_FACTOR: int = 5
+    RETRY_STATUSES = [500, 502, 503, 504, 509, 429]
+    # base urls expire after 60 minutes, refresh them a little before that
+    BASE_URL_LIFETIME: int = 50 * 60
 
     def __init__(
-        self, api: RestClient, root_folder: Path, db: LocalData, settings: Settings
+        self,
+        api: RestClient,
+        root_folder: Path,
+        db: LocalData,
+        settings: Settings,
+        rate_limiter: Optional[RateLimiter] = None,
     ):
         """
         Parameters:
@@ -54,8 +106,10 @@ class GooglePhotosDownload(object):
             root_folder: path to the root of local file synchronization
             db: local database for indexing
             settings: further arguments
+            rate_limiter: paces media downloads (shared with the RestClient)
         """
         self._db: LocalData = db
+        self.rate_limiter: RateLimiter = rate_limiter or RateLimiter()
         self._root_folder: Path = root_folder
         self._api: RestClient = api
 
@@ -74,31 +128,75 @@ class GooglePhotosDownload(object):
         self.image_timeout: int = settings.image_timeout
 
         # attributes related to multi-threaded download
-        self.download_pool = futures.ThreadPoolExecutor(max_workers=self.max_threads)
+        if settings.download_engine == "async":
+            self.download_pool = AsyncDownloadPool(max_streams=self.max_threads)
+            self._do_download = self.do_download_file_async
+        else:
+            self.download_pool = futures.ThreadPoolExecutor(
+                max_workers=self.max_threads
+            )
+            self._do_download = self.do_download_file
         self.pool_future_to_media: Dict[Future, DatabaseMedia] = {}
+        # when enabled the number of downloads in flight is tuned by observed
+        # throughput, with max_threads as the ceiling
+        self.concurrency: Optional[AdaptiveConcurrency] = None
+        if settings.adaptive_threads:
+            self.concurrency = AdaptiveConcurrency(ceiling=self.max_threads)
+        # batches of media waiting for download with their base url requests,
+        # the number of batches whose base urls are requested ahead of their
+        # download
+        self.prefetch_batches = settings.prefetch_batches
+        self.prefetch_pool = futures.ThreadPoolExecutor(
+            max_workers=max(1, self.prefetch_batches)
+        )
+        self.pending_batches: Deque[
+            Tuple[Mapping[str, DatabaseMedia], futures.Future]
+        ] = deque()
         self.bad_ids = BadIds(self._root_folder)
 
         self.current_umask = os.umask(7)
         os.umask(self.current_umask)
 
+        # parallel download of segments of large media (threads engine only)
+        self.segment_pool = None
+        if settings.segment_threshold and settings.download_engine != "async":
+            self.segment_pool = futures.ThreadPoolExecutor(max_workers=self.max_threads)
+
         self._session = requests.Session()
         # define the retry behaviour for each connection. Note that
         # respect_retry_after_header=True means that status codes [413, 429, 503]
         # will backoff for the recommended period defined in the retry after header
         retries = Retry(
             total=settings.max_retries,
-            backoff_factor=5,
-            status_forcelist=[500, 502, 503, 504, 509, 429],
+            backoff_factor=self.BACKOFF_FACTOR,
+            status_forcelist=self.RETRY_STATUSES,
             allowed_methods=frozenset(["GET", "POST"]),
             raise_on_status=False,
             respect_retry_after_header=True,
         )
         self._session.mount(
-            "https://", HTTPAdapter(max_retries=retries, pool_maxsize=self.max_threads)
+            "https://",
+            HTTPAdapter(
+                max_retries=retries,
+                pool_maxsize=self.max_threads * (2 if self.segment_pool else 1),
+            ),
         )
 
+    @property
+    def in_flight_limit(self) -> int:
+        """the number of downloads that may run at once"""
+        if self.concurrency:
+            return self.concurrency.limit
+        return self.max_threads
+
     def close(self):
         self._session.close()
+        if isinstance(self.download_pool, AsyncDownloadPool):
+            self.download_pool.shutdown()
+
+    def grouper(self, iterable: Iterable[BaseMedia]) -> Iterable[Iterable[BaseMedia]]:
+        """Collect data into chunks size BATCH_SIZE"""
+        return zip_longest(*[iter(iterable)] * self.BATCH_SIZE, fillvalue=None)
 
     def download_photo_media(self):
         """
@@ -106,100 +204,160 @@ class GooglePhotosDownload(object):
         This avoids the overhead of one REST call per file. A REST call
         takes longer than downloading an image
         """
-
-        def grouper(
-            iterable: Iterable[DatabaseMedia],
-        ) -> Iterable[Iterable[DatabaseMedia]]:
-            """Collect data into chunks size BATCH_SIZE"""
-            return zip_longest(*[iter(iterable)] * self.BATCH_SIZE, fillvalue=None)
-
         if not self.retry_download:
-            self.files_download_skipped = self._db.downloaded_count()
+            # items downloaded earlier in this run are already counted
+            self.files_download_skipped = (
+                self._db.downloaded_count() - self.files_downloaded
+            )
 
         log.warning("Downloading Photos ...")
         try:
-            for media_items_block in grouper(
-                self._db.get_rows_by_search(
-                    GooglePhotosRow,
-                    start_date=self.start_date,
-                    end_date=self.end_date,
-                    skip_downloaded=not self.retry_download,
-                )
-            ):
-                batch = {}
-
-                items = (mi for mi in media_items_block if mi)
-                for media_item in items:
-                    if self.case_insensitive_fs:
-                        relative_folder = str(media_item.relative_folder).lower()
-                        filename = str(media_item.filename).lower()
-                    else:
-                        relative_folder = media_item.relative_folder
-                        filename = media_item.filename
-                    local_folder = self._root_folder / relative_folder
-                    local_full_path = local_folder / filename
-
-                    try:
-                        if local_full_path.exists():
-                            self.files_download_skipped += 1
-                            log.debug(
-                                "SKIPPED download (file exists) %d %s",
-                                self.files_download_skipped,
-                                media_item.relative_path,
-                            )
-                            self._db.put_downloaded(media_item.id)
-
-                        elif self.bad_ids.check_id_ok(media_item.id):
-                            batch[media_item.id] = media_item
-                            if not local_folder.is_dir():
-                                local_folder.mkdir(parents=True)
-
-                    except Exception as err:
-                        # skip files with filenames too long for this OS.
-                        # probably thrown by local_full_path.exists().
-                        errname = type(err).__name__
-                        if errname == "OSError" and (
-                            err.errno == errno.ENAMETOOLONG  # type: ignore
-                        ):
-                            log.warning(
-                                "SKIPPED file because name is too long for this OS %s",
-                                local_full_path,
-                            )
-                            self.files_download_failed += 1
-                        else:
-                            # re-raise other errors
-                            raise
-
-                if len(batch) > 0:
-                    self.download_batch(batch)
-        finally:
-            # allow any remaining background downloads to complete
-            futures_left = list(self.pool_future_to_media.keys())
-            self.do_download_complete(futures_left)
-            log.warning(
-                "Downloaded %d Items, Failed %d, Already Downloaded %d",
-                self.files_downloaded,
-                self.files_download_failed,
-                self.files_download_skipped,
+            rows = self._db.get_columns_by_search(
+                GooglePhotosRow,
+                GooglePhotosRow.media_columns,
+                start_date=self.start_date,
+                end_date=self.end_date,
+                skip_downloaded=not self.retry_download,
             )
-            self.bad_ids.store_ids()
-            self.bad_ids.report()
+            media_items = map(GooglePhotosRow.columns_to_media, rows)
+            for media_items_block in self.grouper(media_items):
+                self.download_block(media_items_block)
+            self.flush_batches()
+        finally:
+            self.complete_downloads()
         return self.files_downloaded
 
-    def download_batch(self, batch: Mapping[str, DatabaseMedia]):
+    def download_indexed_media(self, media_items: Iterable[BaseMedia]):
+        """Start downloading media items as soon as they have been indexed.
+
+        Used as the on_page callback of GooglePhotosIndex.index_photos_media
+        so that downloads overlap with the listing of the library. The caller
+        must call flush_batches and complete_downloads(report=False) once
+        indexing is finished, download_photo_media then reports on both.
+        """
+        for media_items_block in self.grouper(media_items):
+            self.download_block(media_items_block)
+
+    def download_block(self, media_items_block: Iterable[BaseMedia]):
+        """Filter a block of up to BATCH_SIZE media items down to those that
+        need downloading and pass them to download_batch"""
+        batch = {}
+
+        items = (mi for mi in media_items_block if mi)
+        for media_item in items:
+            if self.case_insensitive_fs:
+                relative_folder = str(media_item.relative_folder).lower()
+                filename = str(media_item.filename).lower()
+            else:
+                relative_folder = media_item.relative_folder
+                filename = media_item.filename
+            local_folder = self._root_folder / relative_folder
+            local_full_path = local_folder / filename
+
+            try:
+                if local_full_path.exists():
+                    self.files_download_skipped += 1
+                    log.debug(
+                        "SKIPPED download (file exists) %d %s",
+                        self.files_download_skipped,
+                        media_item.relative_path,
+                    )
+                    self._db.put_downloaded(media_item.id)
+
+                elif self.bad_ids.check_id_ok(media_item.id):
+                    batch[media_item.id] = media_item
+                    if not local_folder.is_dir():
+                        local_folder.mkdir(parents=True)
+
+            except Exception as err:
+                # skip files with filenames too long for this OS.
+                # probably thrown by local_full_path.exists().
+                errname = type(err).__name__
+                if errname == "OSError" and (
+                    err.errno == errno.ENAMETOOLONG  # type: ignore
+                ):
+                    log.warning(
+                        "SKIPPED file because name is too long for this OS %s",
+                        local_full_path,
+                    )
+                    self.files_download_failed += 1
+                else:
+                    # re-raise other errors
+                    raise
+
+        if len(batch) > 0:
+            self.queue_batch(batch)
+
+    def complete_downloads(self, report: bool = True):
+        """allow any remaining background downloads to complete and report.
+        Batches still waiting for download are dropped, call flush_batches
+        first to download them. With report False the counts are kept for a
+        later call to report on, as download_photo_media does after the
+        downloads of a pipelined index"""
+        for _, base_urls in self.pending_batches:
+            base_urls.cancel()
+        self.pending_batches.clear()
+        futures_left = list(self.pool_future_to_media.keys())
+        self.do_download_complete(futures_left)
+        self.bad_ids.store_ids()
+        if not report:
+            return
+        log.warning(
+            "Downloaded %d Items, Failed %d, Already Downloaded %d",
+            self.files_downloaded,
+            self.files_download_failed,
+            self.files_download_skipped,
+        )
+        self.bad_ids.report()
+
+    def queue_batch(self, batch: Mapping[str, DatabaseMedia]):
+        """Start fetching the base urls for a batch in the background and
+        download the oldest queued batch once more than prefetch_batches are
+        waiting. This keeps the download pool busy while the next
+        mediaItems.batchGet round trips are in flight"""
+        base_urls = self.prefetch_pool.submit(self.get_base_urls, batch)
+        self.pending_batches.append((batch, base_urls))
+        while len(self.pending_batches) > self.prefetch_batches:
+            self.download_batch(*self.pending_batches.popleft())
+
+    def flush_batches(self):
+        """download all of the batches still waiting in queue_batch"""
+        while self.pending_batches:
+            self.download_batch(*self.pending_batches.popleft())
+
+    def get_base_urls(self, batch: Mapping[str, DatabaseMedia]) -> Tuple[float, dict]:
+        """Get fresh base urls for a batch of media items
+
+        Returns:
+            the time the request was made, the response json
+        """
+        fetched = time.monotonic()
+        response = self._api.mediaItems.batchGet.execute(mediaItemIds=batch.keys())
+        return fetched, response.json()
+
+    def download_batch(
+        self,
+        batch: Mapping[str, DatabaseMedia],
+        base_urls: Optional[futures.Future] = None,
+    ):
         """Downloads a batch of media items collected in download_photo_media.
 
         A fresh 'base_url' is required since they have limited lifespan and
         these are obtained by a single call to the service function
-        mediaItems.batchGet.
+        mediaItems.batchGet. base_urls is the result of that call if it was
+        prefetched by queue_batch. Prefetched base urls that have outlived
+        BASE_URL_LIFETIME are fetched again before use.
         """
         try:
-            response = self._api.mediaItems.batchGet.execute(mediaItemIds=batch.keys())
-            r_json = response.json()
+            if base_urls:
+                fetched, r_json = base_urls.result()
+            else:
+                fetched, r_json = self.get_base_urls(batch)
             if r_json.get("pageToken"):
                 log.error("Ops - Batch size too big, some items dropped!")
 
-            for i, result in enumerate(r_json["mediaItemResults"]):
+            results = r_json["mediaItemResults"]
+            for i, result in enumerate(results):
                 media_item_json = result.get("mediaItem")
                 if not media_item_json:
                     log.warning("Null response in mediaItems.batchGet %s", batch.keys())
@@ -210,6 +368,15 @@ class GooglePhotosDownload(object):
                         str(r_json),
                         str(result),
                     )
+                elif base_urls and time.monotonic() - fetched > self.BASE_URL_LIFETIME:
+                    remaining = {
+                        r["mediaItem"]["id"]: batch[r["mediaItem"]["id"]]
+                        for r in results[i:]
+                        if r.get("mediaItem")
+                    }
+                    log.info("refreshing %d expired base urls", len(remaining))
+                    self.download_batch(remaining)
+                    break
                 else:
                     media_item = batch.get(media_item_json["id"])
                     self.download_file(media_item, media_item_json)
@@ -235,26 +402,28 @@ class GooglePhotosDownload(object):
         base_url = media_json["baseUrl"]
 
         # we dont want a massive queue so wait until at least one thread is free
-        while len(self.pool_future_to_media) >= self.max_threads:
-            # check which futures are done, complete the main thread work
-            # and remove them from the dictionary
-            done_list = []
-            for future in self.pool_future_to_media.keys():
-                if future.done():
-                    done_list.append(future)
-
-            self.do_download_complete(done_list)
+        while len(self.pool_future_to_media) >= self.in_flight_limit:
+            # block until at least one download is done, then complete the
+            # main thread work for every download that has finished so far
+            done_set, _ = futures.wait(
+                self.pool_future_to_media, return_when=futures.FIRST_COMPLETED
+            )
+            self.do_download_complete(list(done_set))
 
         # start a new background download
         self.files_download_started += 1
         log.info(
             "downloading %d %s", self.files_download_started, media_item.relative_path
         )
-        future = self.download_pool.submit(self.do_download_file, base_url, media_item)
+        future = self.download_pool.submit(self._do_download, base_url, media_item)
         self.pool_future_to_media[future] = media_item
 
-    def do_download_file(self, base_url: str, media_item: DatabaseMedia):
-        """Runs in a process pool and does a download of a single media item."""
+    def download_target(self, base_url: str, media_item: DatabaseMedia):
+        """Work out where a media item is downloaded to and from
+
+        Returns:
+            local folder, local file path, download url, timeout
+        """
         if self.case_insensitive_fs:
             relative_folder = str(media_item.relative_folder).lower()
             filename = str(media_item.filename).lower()
@@ -270,51 +439,453 @@ class GooglePhotosDownload(object):
         else:
             download_url = "{}=d".format(base_url)
             timeout = self.image_timeout
-        temp_file = tempfile.NamedTemporaryFile(dir=local_folder, delete=False)
-        t_path = Path(temp_file.name)
+        return local_folder, local_full_path, download_url, timeout
 
+    def finalise_download(
+        self, t_path: Path, local_full_path: Path, media_item: DatabaseMedia
+    ):
+        """Move a completed download into place and set its dates and access
+        rights"""
+        t_path.rename(local_full_path)
+        create_date = Utils.safe_timestamp(media_item.create_date)
         try:
-            response = self._session.get(download_url, stream=True, timeout=timeout)
-            response.raise_for_status()
-            shutil.copyfileobj(response.raw, temp_file)
-            temp_file.close()
-            temp_file = None
-            response.close()
-            t_path.rename(local_full_path)
-            create_date = Utils.safe_timestamp(media_item.create_date)
-            try:
-                os.utime(
-                    str(local_full_path),
-                    (
-                        Utils.safe_timestamp(media_item.modify_date).timestamp(),
-                        create_date.timestamp(),
-                    ),
-                )
-            except (PermissionError,):
-                log.debug("Could not set times for downloaded file")
-            if _use_win_32:
-                file_handle = win32file.CreateFile(
-                    str(local_full_path),
-                    win32file.GENERIC_WRITE,
-                    0,
-                    None,
-                    win32con.OPEN_EXISTING,
-                    0,
-                    None,
-                )
-                win32file.SetFileTime(file_handle, *(create_date,) * 3)
-                file_handle.close()
-            try:
-                os.chmod(str(local_full_path), 0o666 & ~self.current_umask)
-            except (PermissionError,):
-                log.debug("Could not set file access rights for downloaded file")
+            os.utime(
+                str(local_full_path),
+                (
+                    Utils.safe_timestamp(media_item.modify_date).timestamp(),
+                    create_date.timestamp(),
+                ),
+            )
+        except (PermissionError,):
+            log.debug("Could not set times for downloaded file")
+        if _use_win_32:
+            file_handle = win32file.CreateFile(
+                str(local_full_path),
+                win32file.GENERIC_WRITE,
+                0,
+                None,
+                win32con.OPEN_EXISTING,
+                0,
+                None,
+            )
+            win32file.SetFileTime(file_handle, *(create_date,) * 3)
+            file_handle.close()
+        try:
+            os.chmod(str(local_full_path), 0o666 & ~self.current_umask)
+        except (PermissionError,):
+            log.debug("Could not set file access rights for downloaded file")
+        if self._db.writer:
+            # record the download as soon as the file is in place, see
+            # do_download_complete
+            self._db.put_downloaded(media_item.id)
+
+    @staticmethod
+    def partial_path(local_folder: Path, media_item: DatabaseMedia) -> Path:
+        """The file that a media item is downloaded into before it is moved to
+        its final name. This is keyed by RemoteId so that an interrupted
+        download can be found and resumed by a later attempt or a later run.
+        The leading '.' hides it from check_for_removed"""
+        return local_folder / ".gphotos-{}.part".format(media_item.id)
+
+    @staticmethod
+    def partial_size(t_path: Path) -> int:
+        try:
+            return t_path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def segment_files(t_path: Path) -> List[Tuple[int, int, Path]]:
+        """The files of an unfinished segmented download into t_path, in
+        order, with the byte range of the media that each one receives. See
+        download_segments"""
+        segments = []
+        for pth in t_path.parent.glob(t_path.name + ".*-*"):
+            start, _, end = pth.suffix[1:].partition("-")
+            if start.isdigit() and end.isdigit():
+                segments.append((int(start), int(end), pth))
+        return sorted(segments)
+
+    def received_size(self, t_path: Path) -> int:
+        """the bytes received by an unfinished download, in all its files"""
+        return self.partial_size(t_path) + sum(
+            self.partial_size(pth) for _, _, pth in self.segment_files(t_path)
+        )
+
+    def discard_partial(self, t_path: Path):
+        for _, _, pth in self.segment_files(t_path):
+            pth.unlink()
+        if t_path.exists():
+            t_path.unlink()
+
+    @staticmethod
+    def range_header(offset: int) -> Dict[str, str]:
+        return {"Range": "bytes={}-".format(offset)} if offset else {}
+
+    @staticmethod
+    def expected_size(status: int, headers: Mapping, offset: int) -> Optional[int]:
+        """Use the response headers to work out the full size of the media"""
+        if status == 206:
+            match = CONTENT_RANGE.match(headers.get("Content-Range", ""))
+            if match and match.group(1) != "*":
+                return int(match.group(1))
+        length = headers.get("Content-Length")
+        if length and length.isdigit():
+            return int(length) + (offset if status == 206 else 0)
+        return None
+
+    def check_download(self, t_path: Path, status: int, headers: Mapping, offset: int):
+        """Decide if a download is complete using the size and (if the server
+        supplied one) the MD5 checksum of the media. X-Goog-Hash is the hash
+        of the whole media in a partial response too, Content-MD5 that of the
+        bytes in the response"""
+        size = self.expected_size(status, headers, offset)
+        actual = self.partial_size(t_path)
+        if size is not None and actual < size:
+            raise IncompleteDownload("received {} of {} bytes".format(actual, size))
+        if size is not None and actual > size:
+            t_path.unlink()
+            raise RequestException(
+                "received {} bytes but expected {}".format(actual, size)
+            )
+        expected_md5 = None
+        for value in headers.get("X-Goog-Hash", "").split(","):
+            key, _, digest = value.strip().partition("=")
+            if key == "md5":
+                expected_md5 = digest
+        if status == 200:
+            expected_md5 = expected_md5 or headers.get("Content-MD5")
+        if expected_md5:
+            md5 = hashlib.md5()
+            with t_path.open("rb") as f:
+                for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b""):
+                    md5.update(chunk)
+            if base64.b64encode(md5.digest()).decode() != expected_md5:
+                t_path.unlink()
+                raise RequestException("checksum mismatch")
+
+    def download_error(self, t_path: Path, start_size: int, e: BaseException):
+        """Classify a failed download. If it made progress its partial file is
+        kept and the failure is reported as an IncompleteDownload so that the
+        media item is not recorded as a bad id"""
+        size = self.received_size(t_path)
+        if size > start_size:
+            return IncompleteDownload(
+                "{} after {} bytes, the download will be resumed".format(repr(e), size)
+            )
+        if isinstance(e, RequestException):
+            return e
+        return RequestException(repr(e))
+
+    def do_download_file(self, base_url: str, media_item: DatabaseMedia):
+        """Runs in a process pool and does a download of a single media item.
+
+        The download is resumed with a Range request if a partial file exists
+        from a previous attempt. While each attempt makes progress, a dropped
+        connection is resumed immediately (up to max_retries times)
+        """
+        local_folder, local_full_path, download_url, timeout = self.download_target(
+            base_url, media_item
+        )
+        t_path = self.partial_path(local_folder, media_item)
+        start_size = self.received_size(t_path)
+        retry = 0
+        started = time.monotonic()
+        throttled = False
+
+        try:
+            while True:
+                segments = self.segment_files(t_path)
+                if segments and self.segment_pool is None:
+                    # t_path holds the first segment, resume it as a whole
+                    for _, _, pth in segments:
+                        pth.unlink()
+                    segments = []
+                offset = self.partial_size(t_path)
+                received = self.received_size(t_path)
+                try:
+                    if segments:
+                        # continue an unfinished segmented download
+                        bounds = [(0, segments[0][0])] + [
+                            (start, end) for start, end, _ in segments
+                        ]
+                        seen = self.download_segments(
+                            None, download_url, timeout, t_path, bounds
+                        )
+                        size = bounds[-1][1]
+                        headers = {
+                            "Content-Range": "bytes 0-{}/{}".format(size - 1, size),
+                            "X-Goog-Hash": seen.get("X-Goog-Hash", ""),
+                        }
+                        self.check_download(t_path, 206, headers, 0)
+                        break
+                    # asking for 'bytes=0-' tells us if the server supports ranges
+                    segment = self.segment_pool is not None and not offset
+                    self.rate_limiter.media.acquire()
+                    response = self._session.get(
+                        download_url,
+                        stream=True,
+                        timeout=timeout,
+                        headers=(
+                            {"Range": "bytes=0-"}
+                            if segment
+                            else self.range_header(offset)
+                        ),
+                    )
+                    if was_throttled(response):
+                        throttled = True
+                        self.rate_limiter.media.throttled()
+                    with response:
+                        if response.status_code == 416 and offset:
+                            raise StalePartial("the server refused to resume")
+                        response.raise_for_status()
+                        size = self.expected_size(
+                            response.status_code, response.headers, offset
+                        )
+                        if (
+                            segment
+                            and response.status_code == 206
+                            and size
+                            and size > self.settings.segment_threshold
+                        ):
+                            count = self.settings.download_segments
+                            length = -(-size // count)
+                            bounds = [
+                                (start, min(start + length, size))
+                                for start in range(0, size, length)
+                            ]
+                            self.download_segments(
+                                response, download_url, timeout, t_path, bounds
+                            )
+                        else:
+                            mode = "ab" if response.status_code == 206 else "wb"
+                            with t_path.open(mode) as f:
+                                shutil.copyfileobj(response.raw, f)
+                    self.check_download(
+                        t_path, response.status_code, response.headers, offset
+                    )
+                    break
+                except StalePartial:
+                    # the media no longer matches the partial download, restart
+                    if not received:
+                        raise
+                    self.discard_partial(t_path)
+                except (IncompleteDownload, HTTPError, RequestException):
+                    if (
+                        self.received_size(t_path) > received
+                        and retry < self.settings.max_retries
+                    ):
+                        retry += 1
+                        log.debug("resuming download of %s", media_item.relative_path)
+                        continue
+                    raise
+            size = self.partial_size(t_path) - start_size
+            self.finalise_download(t_path, local_full_path, media_item)
+            return DownloadStats(size, time.monotonic() - started, throttled)
         except KeyboardInterrupt:
             log.debug("User cancelled download thread")
             raise
+        except (HTTPError, RequestException) as e:
+            error = self.download_error(t_path, start_size, e)
+            if error is e:
+                raise
+            raise error from e
         finally:
-            if temp_file:
-                temp_file.close()
-            if t_path.exists():
+            if not self.received_size(t_path):
+                self.discard_partial(t_path)
+
+    def download_segments(
+        self,
+        response: Optional[requests.Response],
+        download_url: str,
+        timeout: int,
+        t_path: Path,
+        bounds: List[Tuple[int, int]],
+    ) -> Mapping:
+        """Download a large media item as several byte ranges in parallel.
+
+        The first range is downloaded into t_path and each of the others
+        into a file of its own named after its range (see segment_files),
+        which is appended to t_path once every range has been received. So
+        after a failure, or a crash, each file holds the start of its range
+        and a later attempt requests only the rest of each range.
+
+        Parameters:
+            response: an open response from the start of the media, used for
+              the first range
+            bounds: the (start, end) of each range, end exclusive
+
+        Returns:
+            the headers of a response to one of the range requests
+        """
+        files = [t_path] + [
+            t_path.with_name("{}.{}-{}".format(t_path.name, start, end))
+            for start, end in bounds[1:]
+        ]
+        for pth in files[1:]:
+            pth.touch()
+        headers: List[Mapping] = []
+        failed = Event()
+
+        def fetch(index: int, segment_response: Optional[requests.Response] = None):
+            start, end = bounds[index]
+            received = self.partial_size(files[index])
+            if received >= end - start:
+                return
+            if segment_response is None:
+                self.rate_limiter.media.acquire()
+                segment_response = self._session.get(
+                    download_url,
+                    stream=True,
+                    timeout=timeout,
+                    headers={"Range": "bytes={}-{}".format(start + received, end - 1)},
+                )
+                if segment_response.status_code == 416:
+                    raise StalePartial("the server refused a segment")
+                segment_response.raise_for_status()
+            with segment_response:
+                if segment_response.status_code != 206:
+                    raise RequestException("server ignored a Range request")
+                headers.append(segment_response.headers)
+                with files[index].open("ab") as f:
+                    while received < end - start:
+                        if failed.is_set():
+                            return
+                        want = min(self.CHUNK_SIZE, end - start - received)
+                        chunk = segment_response.raw.read(want)
+                        if not chunk:
+                            raise IncompleteDownload(
+                                "segment {} ended early".format(index)
+                            )
+                        f.write(chunk)
+                        received += len(chunk)
+
+        log.debug("downloading %d bytes in %d segments", bounds[-1][1], len(bounds))
+        jobs = [self.segment_pool.submit(fetch, i) for i in range(1, len(bounds))]
+        try:
+            fetch(0, response)
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            done, _ = futures.wait(jobs, return_when=futures.FIRST_EXCEPTION)
+            if any(job.exception() for job in done):
+                failed.set()
+            futures.wait(jobs)
+        for job in jobs:
+            job.result()
+
+        # append the segments in order, each one is only removed once it has
+        # been appended, and a repeat after a crash first cuts t_path back
+        with t_path.open("r+b") as out:
+            for (start, _), pth in zip(bounds[1:], files[1:]):
+                out.truncate(start)
+                out.seek(start)
+                with pth.open("rb") as f:
+                    shutil.copyfileobj(f, out, self.CHUNK_SIZE)
+                out.flush()
+                os.fsync(out.fileno())
+                pth.unlink()
+        return headers[0] if headers else {}
+
+    async def do_download_file_async(
+        self, session, base_url: str, media_item: DatabaseMedia
+    ):
+        """Runs in the AsyncDownloadPool event loop and does a download of a
+        single media item.
+
+        aiohttp has no equivalent of the urllib3 Retry used by the threaded
+        engine so the same retry policy is applied here. Failures are
+        re-raised as RequestException so that do_download_complete treats them
+        exactly as it does failures in the threaded engine. Partial downloads
+        are resumed in the same way as do_download_file.
+
+        File writes and the MD5 check run in the loop's default executor so
+        that disk IO and hashing a large video do not stall the other streams.
+        """
+        local_folder, local_full_path, download_url, timeout = self.download_target(
+            base_url, media_item
+        )
+        t_path = self.partial_path(local_folder, media_item)
+        start_size = self.partial_size(t_path)
+        loop = asyncio.get_running_loop()
+        client_timeout = aiohttp.ClientTimeout(sock_read=timeout, sock_connect=timeout)
+        retry = 0
+        started = time.monotonic()
+        throttled = False
+
+        try:
+            while True:
+                offset = self.partial_size(t_path)
+                try:
+                    await asyncio.sleep(self.rate_limiter.media.reserve())
+                    async with session.get(
+                        download_url,
+                        timeout=client_timeout,
+                        headers=self.range_header(offset),
+                    ) as r:
+                        if r.status == 416 and offset:
+                            # the partial file does not match the media, restart
+                            t_path.unlink()
+                            continue
+                        if r.status in THROTTLE_STATUSES:
+                            throttled = True
+                            self.rate_limiter.media.throttled()
+                        if (
+                            r.status in self.RETRY_STATUSES
+                            and retry < self.settings.max_retries
+                        ):
+                            retry += 1
+                            delay = r.headers.get("Retry-After")
+                            delay = int(delay) if delay and delay.isdigit() else None
+                            await asyncio.sleep(
+                                delay or self.BACKOFF_FACTOR * 2 ** (retry - 1)
+                            )
+                            continue
+                        r.raise_for_status()
+                        # opened before any await so that the body received so
+                        # far is read before a dropped connection is reported
+                        f = t_path.open("ab" if r.status == 206 else "wb")
+                        try:
+                            async for chunk in r.content.iter_chunked(self.CHUNK_SIZE):
+                                await loop.run_in_executor(None, f.write, chunk)
+                        finally:
+                            await loop.run_in_executor(None, f.close)
+                        await loop.run_in_executor(
+                            None,
+                            self.check_download,
+                            t_path,
+                            r.status,
+                            r.headers,
+                            offset,
+                        )
+                        break
+                except (
+                    IncompleteDownload,
+                    aiohttp.ClientPayloadError,
+                    aiohttp.ClientConnectionError,
+                    asyncio.TimeoutError,
+                ):
+                    if (
+                        self.partial_size(t_path) > offset
+                        and retry < self.settings.max_retries
+                    ):
+                        retry += 1
+                        log.debug("resuming download of %s", media_item.relative_path)
+                        continue
+                    raise
+            size = self.partial_size(t_path) - start_size
+            await loop.run_in_executor(
+                None, self.finalise_download, t_path, local_full_path, media_item
+            )
+            return DownloadStats(size, time.monotonic() - started, throttled)
+        except (RequestException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = self.download_error(t_path, start_size, e)
+            if error is e:
+                raise
+            raise error from e
+        finally:
+            if t_path.exists() and not self.partial_size(t_path):
                 t_path.unlink()
 
     def do_download_complete(
@@ -325,12 +896,44 @@ class GooglePhotosDownload(object):
     ):
         """runs in the main thread and completes processing of a media
         item once (multi threaded) do_download has completed
+
+        The Downloaded flags for all of the successful downloads in
+        futures_list are written to the DB in a single batch. With a DB
+        writer each download thread has already queued its own flag
         """
+        downloaded_ids: List[str] = []
+        try:
+            self._complete_futures(futures_list, downloaded_ids)
+        finally:
+            if not self._db.writer:
+                self._db.put_downloaded_batch(downloaded_ids)
+
+    def _complete_futures(
+        self, futures_list: Iterable[futures.Future], downloaded_ids: List[str]
+    ):
         for future in futures_list:
             media_item = self.pool_future_to_media.get(future)
             timeout = self.video_timeout if media_item.is_video else self.image_timeout
             e = future.exception(timeout=timeout)
-            if e:
+            if self.concurrency:
+                if e:
+                    response = getattr(e, "response", None)
+                    status = getattr(response, "status_code", None) or getattr(
+                        e.__cause__, "status", None
+                    )
+                    self.concurrency.record(0, 0, status in THROTTLE_STATUSES)
+                elif future.result():
+                    self.concurrency.record(*future.result())
+            if isinstance(e, IncompleteDownload):
+                # not a bad id, the partial file is kept and resumed next time
+                self.files_download_failed += 1
+                log.warning(
+                    "INCOMPLETE %d downloading %s - %s",
+                    self.files_download_failed,
+                    media_item.relative_path,
+                    e,
+                )
+            elif e:
                 self.files_download_failed += 1
                 log.error(
                     "FAILURE %d downloading %s - %s",
@@ -356,7 +959,7 @@ class GooglePhotosDownload(object):
                     del self.pool_future_to_media[future]
                     raise e
             else:
-                self._db.put_downloaded(media_item.id)
+                downloaded_ids.append(media_item.id)
                 self.files_downloaded += 1
                 log.debug(
                     "COMPLETED %d downloading %s",
@@ -1,12 +1,19 @@
+import json
 import logging
-from datetime import datetime
+import os
+from collections import deque
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional
+from queue import Full, Queue
+from threading import Condition, Event, Thread
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+from requests.exceptions import HTTPError
 
 from gphotos_sync import Utils
 from gphotos_sync.GooglePhotosMedia import GooglePhotosMedia
 from gphotos_sync.GooglePhotosRow import GooglePhotosRow
-from gphotos_sync.LocalData import LocalData
+from gphotos_sync.LocalData import IndexCheckpoint, LocalData
 from gphotos_sync.LocalFilesMedia import LocalFilesMedia
 from gphotos_sync.restclient import RestClient
 from gphotos_sync.Settings import Settings
@@ -14,8 +21,25 @@ from gphotos_sync.Settings import Settings
 log = logging.getLogger(__name__)
 
 
+class _Shard:
+    """A window of dates listed by one of the sharded_pages workers"""
+
+    def __init__(self, first: datetime, last: datetime):
+        self.first = first
+        self.last = last
+        self.pages: Deque[dict] = deque()
+        # set when the window has been split in two instead of listed
+        self.halves: Optional[List["_Shard"]] = None
+        self.done = False
+
+
 class GooglePhotosIndex(object):
     PAGE_SIZE = 100
+    # the dates searched when no start or end date is given
+    SEARCH_START = datetime(1900, 1, 1)
+    SEARCH_END = datetime(3000, 1, 1)
+    # number of listed pages that may be queued ahead of a pipelined download
+    PIPELINE_DEPTH = 4
 
     def __init__(
         self, api: RestClient, root_folder: Path, db: LocalData, settings: Settings
@@ -26,6 +50,13 @@ class GooglePhotosIndex(object):
 
         self.files_indexed: int = 0
         self.files_index_skipped: int = 0
+        self.total_listed: int = 0
+        self.pages_indexed: int = 0
+        # stamped on the items listed, see index_photos_media
+        self.generation: int = 0
+        # the creation date of the oldest item listed, the search returns
+        # the newest first so every item after this date has been seen
+        self.earliest_listed: Optional[datetime] = None
 
         if db:
             self.latest_download = self._db.get_scan_date() or Utils.MINIMUM_DATE
@@ -35,28 +66,58 @@ class GooglePhotosIndex(object):
         self.end_date: datetime = settings.end_date
         self.include_video: bool = settings.include_video
         self.rescan: bool = settings.rescan
+        self.index_workers: int = settings.index_workers
+        self.rolling_rescan: int = settings.rolling_rescan
         self.favourites = settings.favourites_only
         self.case_insensitive_fs: bool = settings.case_insensitive_fs
         self.archived: bool = settings.archived
         self._use_flat_path: bool = settings.use_flat_path
         self._media_folder: Path = settings.photos_path
 
-    def check_for_removed_in_folder(self, folder: Path):
-        for pth in folder.iterdir():
-            if pth.is_dir():
-                self.check_for_removed_in_folder(pth)
+    def check_for_removed_in_folder(
+        self, folder: Path, dry_run: bool = False
+    ) -> List[Path]:
+        """Remove the files under folder that have no entry in SyncFiles.
+
+        The (Path, FileName) of every indexed item is read in one query and
+        the folder is walked once with os.scandir, so the cost is a set
+        lookup per file rather than a query and a stat. The files to remove
+        are all found before any is removed.
+
+        Parameters:
+            dry_run: only report the files that would be removed
+        Returns:
+            the files removed (or that would be removed)
+        """
+        indexed = set(self._db.get_sync_paths())
+        removed: List[Path] = []
+        folders = [folder]
+        while folders:
+            current = folders.pop()
+            relative = str(current.relative_to(self._root_folder))
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        folders.append(Path(entry.path))
+                    elif entry.name.startswith((".", "gphotos")):
+                        continue
+                    elif (relative, entry.name) not in indexed:
+                        removed.append(Path(entry.path))
+
+        for pth in sorted(removed):
+            if dry_run:
+                log.warning("%s would be deleted", pth)
             else:
-                local_path = pth.relative_to(self._root_folder).parent
-                if pth.match(".*") or pth.match("gphotos*"):
-                    continue
-                file_row = self._db.get_file_by_path(
-                    GooglePhotosRow, local_path, pth.name
-                )
-                if not file_row:
-                    pth.unlink()
-                    log.warning("%s deleted", pth)
+                pth.unlink()
+                log.warning("%s deleted", pth)
+        log.warning(
+            "%d files %s",
+            len(removed),
+            "would be deleted (dry run)" if dry_run else "deleted",
+        )
+        return removed
 
-    def check_for_removed(self):
+    def check_for_removed(self, dry_run: bool = False) -> List[Path]:
         """Removes local files that are no longer represented in the Photos
         Library - presumably because they were deleted.
 
@@ -64,16 +125,24 @@ class GooglePhotosIndex(object):
         for a file to exist it must have been indexed in a previous scan
         """
         log.warning("Finding and removing deleted media ...")
-        self.check_for_removed_in_folder(self._root_folder / self._media_folder)
+        return self.check_for_removed_in_folder(
+            self._root_folder / self._media_folder, dry_run
+        )
 
-    def write_media_index(self, media: GooglePhotosMedia, update: bool = True):
-        self._db.put_row(GooglePhotosRow.from_media(media), update)
-        if media.create_date > self.latest_download:
-            self.latest_download = media.create_date
+    def write_media_index_page(
+        self, media_items: List[GooglePhotosMedia], update: bool = False
+    ):
+        """write a page of media items in a single transaction"""
+        self._db.put_rows(
+            [GooglePhotosRow.from_media(media) for media in media_items], update
+        )
+        for media in media_items:
+            if media.create_date > self.latest_download:
+                self.latest_download = media.create_date
 
     def search_media(
         self,
-        page_token: Optional[int] = None,
+        page_token: Optional[str] = None,
         start_date: Optional[datetime] = None,
         end_date: Optional[datetime] = None,
         do_video: bool = False,
@@ -88,8 +157,8 @@ class GooglePhotosIndex(object):
             def to_dict(self):
                 return {"year": self.year, "month": self.month, "day": self.day}
 
-        start = Y(1900, 1, 1)
-        end = Y(3000, 1, 1)
+        start = Y(self.SEARCH_START.year, self.SEARCH_START.month, 1)
+        end = Y(self.SEARCH_END.year, self.SEARCH_END.month, 1)
         type_list = ["ALL_MEDIA"]
 
         if start_date:
@@ -134,9 +203,349 @@ class GooglePhotosIndex(object):
             log.debug("mediaItems.search with body:\n{}".format(body))
             return self._api.mediaItems.search.execute(body).json()  # type: ignore
 
-    def index_photos_media(self) -> int:
+    def search_pages(
+        self,
+        start_date: Optional[datetime],
+        end_date: Optional[datetime],
+        page_token: Optional[str] = None,
+    ) -> Iterator[dict]:
+        """Iterate over the pages of a media items search, following the
+        nextPageToken chain until the listing is exhausted. If page_token is
+        given the listing continues from that page of the same search"""
+        while True:
+            items_json = self.search_media(
+                page_token=page_token,
+                start_date=start_date,
+                end_date=end_date,
+                do_video=self.include_video,
+                favourites=self.favourites,
+            )
+            if not items_json:
+                break
+            yield items_json
+            page_token = items_json.get("nextPageToken")
+            if not page_token:
+                break
+
+    def prefetch_pages(
+        self,
+        start_date: Optional[datetime],
+        end_date: Optional[datetime],
+        page_token: Optional[str] = None,
+    ) -> Iterator[dict]:
+        """As search_pages but the listing runs in a background thread which
+        stays up to PIPELINE_DEPTH pages ahead of the caller. This lets the
+        caller work on one page (e.g. downloading its contents) while the
+        next pages are being listed.
+
+        Only the API calls run in the background thread, all DB access
+        remains in the calling thread.
+        """
+        pages: Queue = Queue(maxsize=self.PIPELINE_DEPTH)
+        stop = Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def lister():
+            try:
+                for page in self.search_pages(start_date, end_date, page_token):
+                    if not put(page):
+                        return
+            except BaseException as e:
+                put(e)
+            else:
+                put(None)
+
+        thread = Thread(target=lister, name="gphotos-lister", daemon=True)
+        thread.start()
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    break
+                if isinstance(page, BaseException):
+                    raise page
+                yield page
+        finally:
+            stop.set()
+            thread.join()
+
+    @staticmethod
+    def split_window(
+        start: datetime, end: datetime, count: int
+    ) -> List[Tuple[datetime, datetime]]:
+        """Split the days from start to end (both inclusive, as in the
+        search dateFilter) into up to count windows of whole days, the most
+        recent window first"""
+        first = datetime(start.year, start.month, start.day)
+        days = (datetime(end.year, end.month, end.day) - first).days + 1
+        count = max(1, min(count, days))
+        windows = [
+            (
+                first + timedelta(days=days * i // count),
+                first + timedelta(days=days * (i + 1) // count - 1),
+            )
+            for i in range(count)
+        ]
+        windows.reverse()
+        return windows
+
+    def sharded_pages(
+        self, start_date: Optional[datetime], end_date: Optional[datetime]
+    ) -> Iterator[dict]:
+        """As search_pages but the dates of the search are split into windows
+        which index_workers threads list in parallel, each following the
+        page chain of its own window.
+
+        When the first page of a window shows that it holds more than one
+        page, and fewer windows are waiting than there are workers, the window
+        is split in two and the halves are listed instead (its first page is
+        dropped, the halves list those items again). Dense periods of the
+        library are spread across the workers as they turn up.
+
+        Pages are returned window by window, newest window first, and in the
+        API's order within each window, whatever order the workers finish in.
+        The API returns a search newest first, so the items arrive in the
+        order of a serial search and, since all DB access remains in the
+        calling thread, index_page assigns the same duplicate numbers.
+        """
+        workers = self.index_workers
+        limit = self.PIPELINE_DEPTH * workers
+        shards = [
+            _Shard(first, last)
+            for first, last in self.split_window(
+                start_date or self.SEARCH_START,
+                end_date or self.SEARCH_END,
+                workers,
+            )
+        ]
+        # shards waiting for a worker, and shards waiting to be merged, in
+        # merge order. Workers take the newest waiting shard so that the
+        # shard being merged is never left waiting behind the others
+        todo: List[_Shard] = list(shards)
+        order: Deque[_Shard] = deque(shards)
+        changed = Condition()
+        stop = Event()
+        busy = 0
+        buffered = 0
+        error: Optional[BaseException] = None
+
+        def next_shard() -> Optional[_Shard]:
+            nonlocal busy
+            with changed:
+                # a busy worker may yet split its shard
+                while not todo and busy and not stop.is_set():
+                    changed.wait(timeout=1)
+                if not todo or stop.is_set():
+                    return None
+                busy += 1
+                return todo.pop(0)
+
+        def list_shard(shard: _Shard):
+            nonlocal buffered
+            page_token = None
+            while not stop.is_set():
+                page = self.search_media(
+                    page_token=page_token,
+                    start_date=shard.first,
+                    end_date=shard.last,
+                    do_video=self.include_video,
+                    favourites=self.favourites,
+                )
+                first_page = page_token is None
+                page_token = page.get("nextPageToken")
+                with changed:
+                    if (
+                        first_page
+                        and page_token
+                        and shard.last > shard.first
+                        and len(todo) < workers
+                    ):
+                        log.debug(
+                            "splitting index window %s - %s", shard.first, shard.last
+                        )
+                        shard.halves = [
+                            _Shard(first, last)
+                            for first, last in self.split_window(
+                                shard.first, shard.last, 2
+                            )
+                        ]
+                        todo.extend(shard.halves)
+                        todo.sort(key=lambda s: s.last, reverse=True)
+                        changed.notify_all()
+                        return
+                    # only the shard being merged may run past the limit
+                    while (
+                        buffered >= limit
+                        and order
+                        and order[0] is not shard
+                        and not stop.is_set()
+                    ):
+                        changed.wait(timeout=1)
+                    shard.pages.append(page)
+                    buffered += 1
+                    changed.notify_all()
+                if not page_token:
+                    return
+
+        def lister():
+            nonlocal busy, error
+            try:
+                while True:
+                    shard = next_shard()
+                    if shard is None:
+                        break
+                    try:
+                        list_shard(shard)
+                    finally:
+                        with changed:
+                            shard.done = True
+                            busy -= 1
+                            changed.notify_all()
+            except BaseException as e:
+                with changed:
+                    error = error or e
+                    changed.notify_all()
+
+        threads = [
+            Thread(target=lister, name="gphotos-lister-{}".format(i), daemon=True)
+            for i in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                page = None
+                with changed:
+                    while page is None:
+                        if error:
+                            raise error
+                        if not order:
+                            return
+                        head = order[0]
+                        if head.pages:
+                            page = head.pages.popleft()
+                            buffered -= 1
+                        elif head.halves is not None:
+                            order.popleft()
+                            order.extendleft(reversed(head.halves))
+                        elif head.done:
+                            order.popleft()
+                        else:
+                            changed.wait(timeout=1)
+                            continue
+                        changed.notify_all()
+                yield page
+        finally:
+            stop.set()
+            with changed:
+                changed.notify_all()
+            for thread in threads:
+                thread.join()
+
+    def index_page(self, media_json: List[dict]) -> List[GooglePhotosMedia]:
+        """Write a single page of listed media items to the index
+
+        Returns:
+            the media items that were newly added to the index
+        """
+        new_items: List[GooglePhotosMedia] = []
+        updated_items: List[GooglePhotosMedia] = []
+        page_ids: Set[str] = set()
+        pending: Dict[Tuple[str, str], int] = {}
+        for media_item_json in media_json:
+            self.total_listed += 1
+            media_item = GooglePhotosMedia(
+                media_item_json, to_lower=self.case_insensitive_fs
+            )
+            if (
+                not self.earliest_listed
+                or media_item.create_date < self.earliest_listed
+            ):
+                self.earliest_listed = media_item.create_date
+            if media_item.id in page_ids:
+                continue
+            page_ids.add(media_item.id)
+            media_item.set_path_by_date(self._media_folder, self._use_flat_path)
+            num, row = self._db.file_duplicate_no(
+                str(media_item.filename),
+                str(media_item.relative_folder),
+                media_item.id,
+                pending,
+            )
+            # we just learned if there were any duplicates in the db
+            media_item.duplicate_number = num
+
+            if self.settings.progress and self.total_listed % 10 == 0:
+                log.warning(f"Listed {self.total_listed} items ...\033[F")
+            if not row:
+                self.files_indexed += 1
+                log.info("Indexed %d %s", self.files_indexed, media_item.relative_path)
+                new_items.append(media_item)
+            elif media_item.modify_date > row.modify_date:
+                self.files_indexed += 1
+                # todo at present there is no modify date in the API
+                #  so updates cannot be monitored - this won't get called
+                log.info(
+                    "Updated Index %d %s",
+                    self.files_indexed,
+                    media_item.relative_path,
+                )
+                updated_items.append(media_item)
+            else:
+                self.files_index_skipped += 1
+                log.debug(
+                    "Skipped Index (already indexed) %d %s",
+                    self.files_index_skipped,
+                    media_item.relative_path,
+                )
+                self.latest_download = max(self.latest_download, media_item.create_date)
+        self.write_media_index_page(new_items, update=False)
+        self._db.put_generation(page_ids, self.generation)
+        self.write_media_index_page(updated_items, update=True)
+        log.debug(
+            "search_media parsed %d media_items with %d PAGE_SIZE",
+            len(media_json),
+            GooglePhotosIndex.PAGE_SIZE,
+        )
+        return new_items
+
+    def index_photos_media(
+        self, on_page: Optional[Callable[[List[GooglePhotosMedia]], Any]] = None
+    ) -> int:
+        """Index the Google Photos Library
+
+        Parameters:
+            on_page: optional callback which receives the newly indexed media
+              items of each page as soon as that page has been indexed. When
+              supplied the listing of further pages continues in the
+              background while the callback runs (see prefetch_pages)
+
+        With more than one index_workers the library is listed by date
+        windows in parallel (see sharded_pages). With rolling_rescan an
+        incremental index also re-lists one slice of the library (see
+        rescan_slice).
+
+        Every item listed is stamped with the current generation. A listing
+        of the whole library starts a new generation and when it completes
+        the items it did not see, which have been deleted from the library,
+        are removed from the index (see LocalData.remove_unlisted).
+
+        A serial listing saves an IndexCheckpoint after each page. If the
+        index is interrupted the next run of the same search resumes from
+        the saved page, or if the API no longer accepts that page token,
+        lists only the dates not yet covered.
+        """
         log.warning("Indexing Google Photos Files ...")
-        total_listed = 0
+        self.total_listed = 0
+        self.pages_indexed = 0
 
         if self.start_date:
             start_date = self.start_date
@@ -145,87 +554,196 @@ class GooglePhotosIndex(object):
         else:
             start_date = self._db.get_scan_date()
 
-        items_json = self.search_media(
-            start_date=start_date,
-            end_date=self.end_date,
-            do_video=self.include_video,
-            favourites=self.favourites,
-        )
+        # a listing of the whole library sees every item that remains in it
+        full_listing = not start_date and not self.end_date and not self.favourites
+        self.generation = self._db.get_generation()
 
-        while items_json:
-            media_json = items_json.get("mediaItems", [])
-            items_count = 0
-            for media_item_json in media_json:
-                items_count += 1
-                total_listed += 1
-                media_item = GooglePhotosMedia(
-                    media_item_json, to_lower=self.case_insensitive_fs
-                )
-                media_item.set_path_by_date(self._media_folder, self._use_flat_path)
-                (num, row) = self._db.file_duplicate_no(
-                    str(media_item.filename),
-                    str(media_item.relative_folder),
-                    media_item.id,
-                )
-                # we just learned if there were any duplicates in the db
-                media_item.duplicate_number = num
-
-                if self.settings.progress and total_listed % 10 == 0:
-                    log.warning(f"Listed {total_listed} items ...\033[F")
-                if not row:
-                    self.files_indexed += 1
-                    log.info(
-                        "Indexed %d %s", self.files_indexed, media_item.relative_path
-                    )
-                    self.write_media_index(media_item, False)
-                    if self.files_indexed % 2000 == 0:
-                        self._db.store()
-                elif media_item.modify_date > row.modify_date:
-                    self.files_indexed += 1
-                    # todo at present there is no modify date in the API
-                    #  so updates cannot be monitored - this won't get called
-                    log.info(
-                        "Updated Index %d %s",
-                        self.files_indexed,
-                        media_item.relative_path,
-                    )
-                    self.write_media_index(media_item, True)
-                else:
-                    self.files_index_skipped += 1
-                    log.debug(
-                        "Skipped Index (already indexed) %d %s",
-                        self.files_index_skipped,
-                        media_item.relative_path,
-                    )
-                    self.latest_download = max(
-                        self.latest_download, media_item.create_date
-                    )
-            log.debug(
-                "search_media parsed %d media_items with %d PAGE_SIZE",
-                items_count,
-                GooglePhotosIndex.PAGE_SIZE,
+        search = self.search_filter(start_date, self.end_date)
+        end_date = self.end_date
+        checkpoint = self._db.get_index_checkpoint()
+        if self.index_workers > 1 or not checkpoint or checkpoint.filter != search:
+            self._db.clear_index_checkpoint()
+            if full_listing:
+                self.generation += 1
+                self._db.set_generation(self.generation)
+            self.index_pages(search, start_date, end_date, None, on_page)
+        else:
+            log.warning(
+                "resuming the index after %d pages (%d items indexed)",
+                checkpoint.pages,
+                checkpoint.indexed,
             )
-
-            next_page = items_json.get("nextPageToken")
-            if next_page:
-                items_json = self.search_media(
-                    page_token=next_page,
-                    start_date=start_date,
-                    end_date=self.end_date,
-                    do_video=self.include_video,
-                    favourites=self.favourites,
+            self.pages_indexed = checkpoint.pages
+            self.files_indexed = checkpoint.indexed
+            self.files_index_skipped = checkpoint.skipped
+            self.latest_download = max(self.latest_download, checkpoint.latest_download)
+            self.earliest_listed = checkpoint.covered
+            try:
+                # without a page token the listing had finished
+                if checkpoint.page_token:
+                    self.index_pages(
+                        search,
+                        start_date,
+                        checkpoint.end_date,
+                        checkpoint.page_token,
+                        on_page,
+                    )
+            except HTTPError:
+                # the token has expired, fall back to the dates not yet covered
+                if self.pages_indexed > checkpoint.pages:
+                    raise
+                log.warning(
+                    "the index checkpoint has expired, indexing up to %s",
+                    checkpoint.covered,
+                )
+                self.index_pages(
+                    search, start_date, checkpoint.covered or end_date, None, on_page
                 )
-            else:
-                break
 
         # scan (in reverse date order) completed so the next incremental scan
         # can start from the most recent file in this scan
         if not self.start_date:
             self._db.set_scan_date(last_date=self.latest_download)
+        if full_listing:
+            removed = self._db.remove_unlisted(self.generation, self.include_video)
+            log.warning("removed %d items deleted from the library", removed)
+        self._db.clear_index_checkpoint()
+
+        # a favourites only listing does not see the whole of a slice, the
+        # sweep would remove every other item in it
+        if (
+            self.rolling_rescan
+            and not full_listing
+            and not self.start_date
+            and not self.favourites
+        ):
+            self.rescan_slice(on_page)
 
         log.warning(f"indexed {self.files_indexed} items")
         return self.files_indexed
 
+    @staticmethod
+    def rolling_slice(
+        first_year: int, last_year: int, runs: int, scans: Dict[int, datetime]
+    ) -> Tuple[int, int]:
+        """Divide the years from first_year to last_year into up to runs
+        slices of whole years, most recent first, and choose the slice that
+        was re-listed longest ago (or the most recent of those never
+        re-listed). Re-listing one slice a run covers every year within runs
+        runs.
+
+        Parameters:
+            scans: when each year was last re-listed
+        Returns:
+            the first and last years of the slice
+        """
+        years = last_year - first_year + 1
+        width = -(-years // max(1, runs))
+        slices = [
+            (max(first_year, year - width + 1), year)
+            for year in range(last_year, first_year - 1, -width)
+        ]
+        return min(
+            slices,
+            key=lambda s: min(
+                scans.get(year, Utils.MINIMUM_DATE) for year in range(s[0], s[1] + 1)
+            ),
+        )
+
+    def rescan_slice(
+        self, on_page: Optional[Callable[[List[GooglePhotosMedia]], Any]] = None
+    ):
+        """Re-list the slice of the library's years chosen by rolling_slice.
+
+        An incremental index only lists items created since the last index,
+        so it misses items uploaded later with older dates, and the items
+        deleted from the library. Re-listing one slice per run finds both
+        (the unseen items in the slice are swept as by a full listing) for
+        the cost of listing a fraction of the library.
+        """
+        earliest = self._db.get_earliest_date()
+        if not earliest:
+            return
+        now = datetime.now()
+        first, last = self.rolling_slice(
+            earliest.year, now.year, self.rolling_rescan, self._db.get_slice_scans()
+        )
+        start_date, end_date = datetime(first, 1, 1), datetime(last, 12, 31)
+        log.warning("Rolling rescan of %d - %d ...", first, last)
+
+        self.generation = self._db.get_generation() + 1
+        self._db.set_generation(self.generation)
+        self.index_pages(
+            self.search_filter(start_date, end_date),
+            start_date,
+            end_date,
+            None,
+            on_page,
+        )
+        self._db.clear_index_checkpoint()
+        # the dates in the search are local and those in the index UTC, so
+        # items within a day of either end may have been listed in another
+        # slice and are left for a full listing to sweep
+        removed = self._db.remove_unlisted(
+            self.generation,
+            self.include_video,
+            start_date + timedelta(days=1),
+            end_date,
+        )
+        log.warning("removed %d items deleted from the library", removed)
+        self._db.put_slice_scanned(range(first, last + 1), now)
+
+    def search_filter(
+        self, start_date: Optional[datetime], end_date: Optional[datetime]
+    ) -> str:
+        """identifies the search made by index_photos_media so that a
+        checkpoint is only resumed by the same search"""
+        return json.dumps(
+            {
+                "start": start_date and Utils.date_to_string(start_date),
+                "end": end_date and Utils.date_to_string(end_date),
+                "video": self.include_video,
+                "favourites": self.favourites,
+                "archived": self.archived,
+            },
+            sort_keys=True,
+        )
+
+    def index_pages(
+        self,
+        search: str,
+        start_date: Optional[datetime],
+        end_date: Optional[datetime],
+        page_token: Optional[str],
+        on_page: Optional[Callable[[List[GooglePhotosMedia]], Any]],
+    ):
+        """index the pages of a listing, saving a checkpoint after each"""
+        if self.index_workers > 1:
+            pages = self.sharded_pages(start_date, end_date)
+        elif on_page:
+            pages = self.prefetch_pages(start_date, end_date, page_token)
+        else:
+            pages = self.search_pages(start_date, end_date, page_token)
+
+        for items_json in pages:
+            new_items = self.index_page(items_json.get("mediaItems", []))
+            self.pages_indexed += 1
+            if self.index_workers == 1:
+                self._db.put_index_checkpoint(
+                    IndexCheckpoint(
+                        search,
+                        end_date,
+                        items_json.get("nextPageToken"),
+                        self.earliest_listed,
+                        self.pages_indexed,
+                        self.files_indexed,
+                        self.files_index_skipped,
+                        self.latest_download,
+                    )
+                )
+            if on_page:
+                on_page(new_items)
+
     def get_extra_meta(self):
         count = 0
         log.warning(
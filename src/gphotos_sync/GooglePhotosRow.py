@@ -2,7 +2,6 @@ import logging
 from datetime import datetime
 from pathlib import Path
 
-from gphotos_sync.BaseMedia import BaseMedia
 from gphotos_sync.DatabaseMedia import DatabaseMedia
 from gphotos_sync.DbRow import DbRow
 from gphotos_sync.GooglePhotosMedia import GooglePhotosMedia
@@ -39,6 +38,17 @@ class GooglePhotosRow(DbRow):
     }
     no_update = ["Id"]
 
+    # the columns that columns_to_media needs
+    media_columns = (
+        "RemoteId",
+        "Url",
+        "Path",
+        "FileName",
+        "MimeType",
+        "ModifyDate",
+        "CreateDate",
+    )
+
     # All properties on this class are dynamically added from the above
     # list using DbRow.make. Hence Mypy cannot see them and they need
     # type: ignore
@@ -62,12 +72,26 @@ class GooglePhotosRow(DbRow):
         )
         return db_media
 
+    @staticmethod
+    def columns_to_media(columns) -> DatabaseMedia:
+        """A DatabaseMedia with enough of its attributes populated for
+        download, from a tuple of media_columns returned by
+        LocalData.get_columns_by_search. The dates are converted on first use"""
+        return DatabaseMedia(
+            _id=columns.RemoteId,
+            _url=columns.Url,
+            _relative_folder=Path(columns.Path),
+            _filename=columns.FileName,
+            _mime_type=columns.MimeType,
+            _date=columns.ModifyDate,
+            _create_date=columns.CreateDate,
+        )
+
     @classmethod
     def from_media(  # type: ignore
         cls,
         media: GooglePhotosMedia,
     ) -> "GooglePhotosRow":
-        now_time = datetime.now().strftime(BaseMedia.TIME_FORMAT)
         new_row = cls.make(
             RemoteId=media.id,
             Url=media.url,
@@ -81,7 +105,7 @@ class GooglePhotosRow(DbRow):
             Description=media.description,
             ModifyDate=media.modify_date,
             CreateDate=media.create_date,
-            SyncDate=now_time,
+            SyncDate=datetime.now(),
             Downloaded=0,
             Location="",
         )
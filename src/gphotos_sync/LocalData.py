@@ -1,24 +1,58 @@
 import logging
 import platform
 import sqlite3 as lite
+import threading
 from datetime import datetime
 from pathlib import Path
 from sqlite3.dbapi2 import Connection, Cursor
-from typing import Any, Iterable, Iterator, Optional, Tuple, Type
+from types import SimpleNamespace
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+)
 
 # todo this module could be tidied quite a bit
 #  too much application logic at this level in some cases
 #  also the generic functions seem a bit ugly and could do with rework
+import gphotos_sync.Migrations as Migrations
 import gphotos_sync.Queries as Queries
 from gphotos_sync import Utils
 from gphotos_sync.DatabaseMedia import DatabaseMedia
 from gphotos_sync.DbRow import DbRow
+from gphotos_sync.DbWriter import DbWriter
 from gphotos_sync.GoogleAlbumsRow import GoogleAlbumsRow
 from gphotos_sync.GooglePhotosRow import GooglePhotosRow
 from gphotos_sync.LocalFilesRow import LocalFilesRow
 
 log = logging.getLogger(__name__)
 
+# all dates are stored as integers, including those passed as query parameters
+lite.register_adapter(datetime, Utils.date_to_timestamp)
+
+
+class IndexCheckpoint(NamedTuple):
+    """The progress of an index_photos_media listing after a page"""
+
+    # identifies the search being indexed, see GooglePhotosIndex.search_filter
+    filter: str
+    # the end date of the listing that page_token continues
+    end_date: Optional[datetime]
+    page_token: Optional[str]
+    # every item created after this date has been indexed
+    covered: Optional[datetime]
+    pages: int
+    indexed: int
+    skipped: int
+    latest_download: datetime
+
 
 class LocalData:
     """
@@ -28,13 +62,37 @@ class LocalData:
 
     DB_FILE_NAME: str = "gphotos.sqlite"
     BLOCK_SIZE: int = 10000
-    VERSION: float = 5.7
+    VERSION: float = 6.4
+
+    # PRAGMAs applied to each new connection for the --db-profile options.
+    # 'safe' uses the SQLite defaults (rollback journal, synchronous=FULL).
+    # It sets them explicitly because the journal mode is stored in the DB
+    # file, so a DB left in WAL mode by a 'fast' run is switched back.
+    # 'fast' uses a write ahead log so that readers can run while a sync is
+    # writing, only syncs to disk at WAL checkpoints (a power cut may lose
+    # the last transactions but not corrupt the DB) and keeps more of the DB
+    # in memory. WAL does not work on network filesystems.
+    PROFILES: Dict[str, Dict[str, Any]] = {
+        "safe": {"journal_mode": "DELETE", "synchronous": "FULL"},
+        "fast": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -64000,  # negative values are in KiB
+            "mmap_size": 256 * 1024 * 1024,
+            "temp_store": "MEMORY",
+        },
+    }
 
-    def __init__(self, root_folder: Path, flush_index: bool = False):
+    def __init__(
+        self, root_folder: Path, flush_index: bool = False, profile: str = "safe"
+    ):
         """Initialize a connection to the DB and create some cursors.
         If requested or if the DB schema version is old, recreate the DB
         from scratch.
         """
+        if profile not in self.PROFILES:
+            raise ValueError("unknown database profile {}".format(profile))
+        self.profile = profile
         if platform.system() == "Windows" or platform.system() == "Darwin":
             self.case_insensitive = True
         else:
@@ -48,12 +106,18 @@ class LocalData:
             clean_db = True
             self.backup_sql_file()
 
-        self.con: Connection = lite.connect(str(self.db_file), check_same_thread=False)
-        self.con.row_factory = lite.Row
-        self.cur: Cursor = self.con.cursor()
-        # second cursor for iterator functions so they can interleave with
-        # others
-        self.cur2: Cursor = self.con.cursor()
+        # optional in memory copy of the SyncFiles keys, see load_key_index
+        self._known_ids: Optional[Dict[str, Tuple[int, Any]]] = None
+        self._max_duplicate: Dict[Tuple[str, str], int] = {}
+
+        # see start_writer
+        self.writer: Optional[DbWriter] = None
+        self._local = threading.local()
+        self._readers: List[Connection] = []
+        self._readers_lock = threading.Lock()
+
+        self._shared = SimpleNamespace()
+        self.connect()
         if clean_db:
             self.clean_db()
         self.check_schema_version()
@@ -61,22 +125,142 @@ class LocalData:
     def __enter__(self):
         return self
 
+    def connect(self):
+        """open the DB file and apply the PRAGMAs for self.profile"""
+        self._shared = self.open_connection()
+        log.debug("database opened with profile %s", self.profile)
+
+    def open_connection(self) -> SimpleNamespace:
+        con = lite.connect(str(self.db_file), check_same_thread=False)
+        con.row_factory = lite.Row
+        # second cursor for iterator functions so they can interleave with
+        # others
+        connection = SimpleNamespace(con=con, cur=con.cursor(), cur2=con.cursor())
+        pragmas = self.PROFILES[self.profile]
+        if self.writer:
+            # the readers of a DbWriter must not change it from WAL mode
+            pragmas = dict(pragmas, journal_mode="WAL")
+        for pragma, value in pragmas.items():
+            # read the result, an unfinished statement holds a read lock
+            connection.cur.execute("PRAGMA {}={};".format(pragma, value)).fetchall()
+        return connection
+
+    def connection(self) -> SimpleNamespace:
+        """The connection and cursors for the calling thread.
+
+        Without a writer every thread shares the connection opened by
+        connect(). With one, each thread reads through a connection of its
+        own, after waiting for the writes it has queued to be committed.
+        """
+        if self.writer is None:
+            return self._shared
+        local = self._local
+        if not hasattr(local, "connection"):
+            local.connection = self.open_connection()
+            with self._readers_lock:
+                self._readers.append(local.connection.con)
+        if getattr(local, "dirty", False):
+            local.dirty = False
+            self.writer.flush()
+        return local.connection
+
+    @property
+    def con(self) -> Connection:
+        return self.connection().con
+
+    @property
+    def cur(self) -> Cursor:
+        return self.connection().cur
+
+    @property
+    def cur2(self) -> Cursor:
+        return self.connection().cur2
+
+    def start_writer(self):
+        """From now on apply all changes to the DB in a DbWriter thread, so
+        that any thread may write, and give each thread its own connection
+        for reading. This switches the DB to a write ahead log, which allows
+        reads while the writer is committing"""
+        if self.writer:
+            return
+        shared = self._shared
+        shared.con.commit()
+        # finish any statements left part read (they hold a read lock) before
+        # changing the journal mode
+        for cur in (shared.cur, shared.cur2):
+            cur.close()
+        shared.cur, shared.cur2 = shared.con.cursor(), shared.con.cursor()
+        shared.cur.execute("PRAGMA journal_mode=WAL;").fetchall()
+        pragmas = dict(self.PROFILES[self.profile], journal_mode="WAL")
+        self.writer = DbWriter(self.db_file, pragmas)
+        # the calling thread keeps reading through the shared connection
+        self._local.connection = self._shared
+        log.debug("database writer started")
+
+    def stop_writer(self):
+        """commit the queued changes and return to writing through the shared
+        connection"""
+        if not self.writer:
+            return
+        writer, self.writer = self.writer, None
+        try:
+            writer.close()
+        finally:
+            with self._readers_lock:
+                for con in self._readers:
+                    con.close()
+                self._readers.clear()
+            self._local = threading.local()
+            log.debug("database writer stopped")
+
+    def write(self, sql: str, params: Any = ()) -> Optional[Cursor]:
+        """Execute a statement that changes the DB. With a writer this is
+        queued and returns None, otherwise it returns the cursor"""
+        if self.writer:
+            self._local.dirty = True
+            self.writer.execute(sql, params)
+            return None
+        return self._shared.cur.execute(sql, params)
+
+    def write_many(self, sql: str, seq_of_params: Iterable[Any]):
+        """executemany a statement that changes the DB, see write"""
+        if self.writer:
+            self._local.dirty = True
+            self.writer.executemany(sql, seq_of_params)
+        else:
+            self._shared.cur.executemany(sql, seq_of_params)
+
     def backup_sql_file(self):
         backup = self.db_file.parent / (self.db_file.name + ".previous")
         if backup.exists():
             backup.unlink()
         self.db_file.rename(backup)
+        # a WAL mode DB that was not closed cleanly leaves its log alongside
+        for suffix in ("-wal", "-shm"):
+            log_file = self.db_file.parent / (self.db_file.name + suffix)
+            backup_log = backup.parent / (backup.name + suffix)
+            if backup_log.exists():
+                backup_log.unlink()
+            if log_file.exists():
+                log_file.rename(backup_log)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Always clean up and close the connection when this object is
         destroyed."""
-        if self.con:
-            self.store()
-            self.con.close()
+        if self._shared.con:
+            try:
+                self.stop_writer()
+            finally:
+                self.store()
+                self._shared.con.close()
 
     def store(self):
         log.info("Saving Database ...")
-        self.con.commit()
+        if self.writer:
+            self._local.dirty = False
+            self.writer.flush()
+        else:
+            self.con.commit()
         log.info("Database Saved.")
 
     def check_schema_version(self):
@@ -85,7 +269,7 @@ class LocalData:
         version = float(self.cur.fetchone()[0])
         if version > self.VERSION:
             raise ValueError("Database version is newer than gphotos-sync")
-        elif version < self.VERSION:
+        elif version < Migrations.OLDEST_VERSION:
             log.warning(
                 "Database schema out of date. Flushing index ...\n"
                 "A backup of the previous DB has been created"
@@ -93,11 +277,46 @@ class LocalData:
             self.con.commit()
             self.con.close()
             self.backup_sql_file()
-            self.con = lite.connect(str(self.db_file))
-            self.con.row_factory = lite.Row
-            self.cur = self.con.cursor()
-            self.cur2 = self.con.cursor()
+            self.connect()
             self.clean_db()
+        elif version < self.VERSION:
+            self.migrate(version)
+
+    def migrate(self, version: float):
+        """Bring the schema up to date from version by applying the
+        outstanding Migrations in order. Each migration is applied in its own
+        transaction along with the update of the schema version, so an
+        interrupted upgrade continues from the last completed step."""
+        self.con.commit()
+        for migration in Migrations.MIGRATIONS:
+            if migration.version <= version:
+                continue
+            log.warning(
+                "Upgrading database schema %s -> %s (%s)",
+                version,
+                migration.version,
+                migration.description,
+            )
+            try:
+                self.cur.execute("BEGIN")
+                for step in migration.steps:
+                    if callable(step):
+                        step(self.cur)
+                    else:
+                        self.cur.execute(step)
+                self.cur.execute(
+                    "UPDATE Globals SET Version = ? WHERE Id IS 1",
+                    (migration.version,),
+                )
+                self.con.commit()
+            except Exception:
+                self.con.rollback()
+                log.error(
+                    "Database upgrade to %s failed, use --flush-index to rebuild",
+                    migration.version,
+                )
+                raise
+            version = migration.version
 
     def clean_db(self):
         """Execute the DB creation script, erasing old data and bringing
@@ -117,65 +336,273 @@ class LocalData:
 
     # functions to set global values ##########################################
     def set_scan_date(self, last_date: datetime):
-        d = Utils.date_to_string(last_date)
-        self.cur.execute("UPDATE Globals SET LastIndex=? " "WHERE Id IS 1", (d,))
+        self.write("UPDATE Globals SET LastIndex=? " "WHERE Id IS 1", (last_date,))
 
     def get_scan_date(self) -> Optional[datetime]:
         query = "SELECT LastIndex " "FROM  Globals WHERE Id IS 1"
         self.cur.execute(query)
         res = self.cur.fetchone()
 
-        d = res["LastIndex"]
-        if d:
-            last_date = Utils.string_to_date(d)
-        else:
-            last_date = None
+        return Utils.timestamp_to_date(res["LastIndex"])
+
+    def get_generation(self) -> int:
+        """the generation of the most recent full listing of the library"""
+        self.cur.execute("SELECT Generation FROM Globals WHERE Id IS 1")
+        return self.cur.fetchone()["Generation"] or 0
 
-        return last_date
+    def set_generation(self, generation: int):
+        self.write("UPDATE Globals SET Generation=? WHERE Id IS 1", (generation,))
+
+    def put_generation(self, remote_ids: Iterable[str], generation: int):
+        """stamp the items seen by a listing of the library"""
+        self.write_many(
+            "UPDATE SyncFiles SET Generation=? WHERE RemoteId IS ?;",
+            ((generation, remote_id) for remote_id in remote_ids),
+        )
+
+    def remove_unlisted(
+        self,
+        generation: int,
+        videos: bool = True,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+    ) -> int:
+        """Sweep the items that a full listing of the library, stamped with
+        generation, did not see. These have been deleted from the library.
+        With videos False the videos, which that listing skipped, are kept.
+        With start_date and end_date the listing covered items created
+        after start_date and before end_date only, and so does the sweep.
+
+        Items only indexed from albums are not in the library listing. Those
+        indexed since schema 6.3 have no generation, and so are not swept.
+        Older ones cannot be told apart from library items, so the items of
+        shared albums (the only source of such items) are always kept. An
+        item deleted from the library but still in a shared album therefore
+        stays in the index, as the album sync would add it back.
+
+        Returns:
+            the number of items removed
+        """
+        condition = (
+            "Generation < ? AND RemoteId NOT IN (SELECT DriveRec FROM AlbumFiles "
+            "JOIN Albums ON AlbumFiles.AlbumRec = Albums.RemoteId "
+            "WHERE Albums.IsSharedAlbum)"
+        )
+        params: List[Any] = [generation]
+        if not videos:
+            condition += " AND MimeType NOT LIKE 'video%'"
+        if start_date:
+            condition += " AND CreateDate > ?"
+            params.append(start_date)
+        if end_date:
+            condition += " AND CreateDate < ?"
+            params.append(end_date)
+        self.cur.execute(
+            "SELECT COUNT() FROM SyncFiles WHERE {};".format(condition), params
+        )
+        count = self.cur.fetchone()[0]
+        if count:
+            self.write(
+                "DELETE FROM AlbumFiles WHERE DriveRec IN "
+                "(SELECT RemoteId FROM SyncFiles WHERE {});".format(condition),
+                params,
+            )
+            self.write("DELETE FROM SyncFiles WHERE {};".format(condition), params)
+            # the duplicate numbers held in memory may now be out of date
+            if self._known_ids is not None:
+                self.load_key_index()
+        return count
+
+    def get_earliest_date(self) -> Optional[datetime]:
+        """the creation date of the oldest item in the library"""
+        self.cur.execute(
+            "SELECT MIN(CreateDate) FROM SyncFiles WHERE Generation IS NOT NULL;"
+        )
+        return Utils.timestamp_to_date(self.cur.fetchone()[0])
+
+    def get_slice_scans(self) -> Dict[int, datetime]:
+        """when each year of the library was last re-listed"""
+        self.cur.execute("SELECT Year, LastScanned FROM IndexSlices;")
+        return {
+            year: Utils.timestamp_to_date(last_scanned) or Utils.MINIMUM_DATE
+            for year, last_scanned in self.cur.fetchall()
+        }
+
+    def put_slice_scanned(self, years: Iterable[int], last_scanned: datetime):
+        self.write_many(
+            "INSERT OR REPLACE INTO IndexSlices (Year, LastScanned) VALUES (?, ?);",
+            ((year, last_scanned) for year in years),
+        )
+
+    def put_index_checkpoint(self, checkpoint: IndexCheckpoint):
+        """record the progress of the index, committing it together with the
+        rows indexed so far"""
+        self.write(
+            "INSERT OR REPLACE INTO IndexCheckpoint (Id, Filter, EndDate, "
+            "PageToken, Covered, Pages, Indexed, Skipped, LatestDownload) "
+            "VALUES (1, ?, ?, ?, ?, ?, ?, ?, ?);",
+            checkpoint,
+        )
+        if not self.writer:
+            self.con.commit()
+
+    def get_index_checkpoint(self) -> Optional[IndexCheckpoint]:
+        self.cur.execute(
+            "SELECT Filter, EndDate, PageToken, Covered, Pages, Indexed, Skipped, "
+            "LatestDownload FROM IndexCheckpoint WHERE Id IS 1;"
+        )
+        res = self.cur.fetchone()
+        if not res:
+            return None
+        return IndexCheckpoint(
+            res["Filter"],
+            Utils.timestamp_to_date(res["EndDate"]),
+            res["PageToken"],
+            Utils.timestamp_to_date(res["Covered"]),
+            res["Pages"],
+            res["Indexed"],
+            res["Skipped"],
+            Utils.timestamp_to_date(res["LatestDownload"]) or Utils.MINIMUM_DATE,
+        )
+
+    def clear_index_checkpoint(self):
+        self.write("DELETE FROM IndexCheckpoint;")
 
     # functions for managing the (any) Media Tables ###########################
+    @staticmethod
+    def row_query(row_type: Type[DbRow], update: bool = False) -> str:
+        """The parameterized statement for writing a row of row_type. This
+        text is the same for every row of a type, so sqlite3 compiles it once
+        and reuses it from its statement cache"""
+        if update:
+            return "UPDATE {0} Set {1} WHERE RemoteId = :RemoteId".format(
+                row_type.table, row_type.update
+            )
+        # EXISTS - allows for no action when trying to re-insert
+        return (
+            "INSERT INTO {0} ({1}) SELECT {2} "
+            "WHERE NOT EXISTS (SELECT * FROM SyncFiles "
+            "WHERE RemoteId = :RemoteId)".format(
+                row_type.table, row_type.columns, row_type.params
+            )
+        )
+
     # noinspection SqlResolve
-    def put_row(self, row: DbRow, update=False, album=False):
+    def put_row(self, row: DbRow, update=False, album=False) -> Optional[int]:
+        """write a row, returns its rowid (None when using the writer, which
+        reports its own errors)"""
+        query = self.row_query(type(row), bool(update))
+        if self.writer:
+            self.write(query, row.dict)
+            self.add_keys((row,))
+            return None
         try:
-            if update:
-                if album:
-                    # noinspection PyUnresolvedReferences
-                    query = "UPDATE {0} Set {1} WHERE RemoteId = '{2}'".format(
-                        row.table, row.update, row.RemoteId
-                    )
-                else:
-                    # noinspection PyUnresolvedReferences
-                    query = "UPDATE {0} Set {1} WHERE RemoteId = '{2}'".format(
-                        row.table, row.update, row.RemoteId
-                    )
-            else:
-                # EXISTS - allows for no action when trying to re-insert
-                # noinspection PyUnresolvedReferences
-                query = (
-                    "INSERT INTO {0} ({1}) SELECT {2} "
-                    "WHERE NOT EXISTS (SELECT * FROM SyncFiles "
-                    "WHERE RemoteId = '{3}')".format(
-                        row.table, row.columns, row.params, row.RemoteId
-                    )
-                )
-            self.cur.execute(query, row.dict)
-            row_id = self.cur.lastrowid
+            cur = self._shared.cur.execute(query, row.dict)
         except lite.IntegrityError:
             log.error("SQL constraint issue with {}".format(row.dict))
             raise
-        return row_id
+        self.add_keys((row,))
+        return cur.lastrowid
 
-    # noinspection SqlResolve
-    def get_rows_by_search(
-        self,
-        row_type: Type[DbRow] = DbRow,
-        uid: str = "",
-        remote_id: str = "%",
-        file_name: str = "%",
-        path: str = "%",
+    def put_rows(self, rows: Sequence[DbRow], update: bool = False):
+        """Write many rows of the same type with a single executemany in
+        their own transaction. Used to write a page of results at a time"""
+        if not rows:
+            return
+        query = self.row_query(type(rows[0]), update)
+        if self.writer:
+            # the writer applies it in a transaction and reports any error
+            self.write_many(query, (row.dict for row in rows))
+        else:
+            try:
+                with self._shared.con:
+                    self._shared.cur.executemany(query, (row.dict for row in rows))
+            except lite.IntegrityError:
+                log.error("SQL constraint issue writing %d rows", len(rows))
+                raise
+        self.add_keys(rows)
+
+    @staticmethod
+    def search_query(
+        row_type: Type[DbRow],
+        columns: str,
+        uid: Optional[str] = None,
+        remote_id: Optional[str] = None,
+        file_name: Optional[str] = None,
+        path: Optional[str] = None,
         start_date: Optional[datetime] = None,
         end_date: Optional[datetime] = None,
         skip_downloaded: bool = False,
+    ) -> Tuple[str, List[Any]]:
+        """The query and parameters for one page of get_rows_by_search or
+        get_columns_by_search. Only the filters in use are included so that
+        the planner can pick the best index for them.
+
+        The caller appends the last rowid of the previous page and the page
+        size to the parameters. The rowid is the first column of the result.
+        """
+        predicates: List[str] = []
+        params: List[Any] = []
+
+        for column, value in (
+            ("RemoteId", remote_id),
+            ("FileName", file_name),
+            ("Path", path),
+        ):
+            if value is None or value == "%":
+                continue
+            # values containing a wildcard are LIKE patterns
+            predicates.append("{} {} ?".format(column, "LIKE" if "%" in value else "="))
+            params.append(value)
+        if uid == "ISNULL":
+            predicates.append("Uid IS NULL")
+        elif uid == "NOTNULL":
+            predicates.append("Uid IS NOT NULL")
+        elif uid:
+            predicates.append("Uid = ?")
+            params.append(uid)
+        if start_date:
+            # look for create date too since an photo recently uploaded will
+            # keep its original modified date (since that is in the exif)
+            # this clause is specifically to assist in incremental download
+            predicates.append("(ModifyDate >= ? OR CreateDate >= ?)")
+            params += [start_date, start_date]
+        if end_date:
+            predicates.append("ModifyDate <= ?")
+            params.append(end_date)
+        if skip_downloaded:
+            # a literal so that the partial index SyncPendingIdx applies
+            predicates.append("Downloaded = 0")
+        predicates.append("rowid > ?")
+
+        query = "SELECT rowid, {0} FROM {1} WHERE {2} ORDER BY rowid LIMIT ?;".format(
+            columns, row_type.table, " AND ".join(predicates)
+        )
+        return query, params
+
+    def search_pages(
+        self, cur: Cursor, row_type: Type[DbRow], columns: str, **search: Any
+    ) -> Iterator[List[Any]]:
+        """Run a search_query a page at a time. Each page is a new statement
+        that starts after the last rowid of the previous one, so the caller
+        may update the rows it has already been given (e.g. Downloaded)"""
+        query, params = self.search_query(row_type, columns, **search)
+        last_rowid = 0
+        try:
+            while True:
+                cur.execute(query, params + [last_rowid, self.BLOCK_SIZE])
+                records = cur.fetchall()
+                if not records:
+                    break
+                last_rowid = records[-1][0]
+                yield records
+        except Exception:
+            log.error("query: %s\nparams: %s", query, params)
+            raise
+
+    # noinspection SqlResolve
+    def get_rows_by_search(
+        self, row_type: Type[DbRow] = DbRow, **search: Any
     ) -> Iterator[DatabaseMedia]:
         """
         Search for a selection of files in a media table.
@@ -183,50 +610,43 @@ class LocalData:
         Parameters:
             row_type: One of the DbRow derived classes - defines which table
               this request is for
-            uid: the exif unique identifier search entry (can be ISNULL)
+            uid: the exif unique identifier, or ISNULL / NOTNULL
             remote_id: Google Photos unique ID
             file_name:
             path:
             start_date: start day for search
             end_date: end day for search
             skip_downloaded: Dont return entries already downloaded
+            (remote_id, file_name and path may be LIKE patterns using %)
         Return:
             An iterator over query results
         """
-        params: Tuple[Any, ...] = (remote_id, file_name, path)
-        extra_clauses = ""
-        if start_date:
-            # look for create date too since an photo recently uploaded will
-            # keep its original modified date (since that is in the exif)
-            # this clause is specifically to assist in incremental download
-            extra_clauses += "AND (ModifyDate >= ? OR CreateDate >= ?)"
-            params += (start_date, start_date)
-        if end_date:
-            extra_clauses += "AND ModifyDate <= ?"
-            params += (end_date,)
-        if skip_downloaded:
-            extra_clauses += "AND Downloaded IS 0"
-        if uid:
-            extra_clauses += "AND Uid " + uid
-
-        query = (
-            "SELECT {0} FROM {1} WHERE RemoteId LIKE ? "
-            "AND FileName LIKE ? and Path LIKE ? {2};".format(
-                row_type.columns, row_type.table, extra_clauses
-            )
-        )
+        for records in self.search_pages(
+            self.cur2, row_type, row_type.columns, **search
+        ):
+            for record in records:
+                yield row_type(record).to_media()
 
+    def get_columns_by_search(
+        self, row_type: Type[DbRow], columns: Sequence[str], **search: Any
+    ) -> Iterator[tuple]:
+        """
+        As get_rows_by_search but yields namedtuples of just the requested
+        columns, with the values as stored in the DB (dates are not parsed).
+        This is an order of magnitude cheaper per row for large scans.
+        """
+        tuple_type = row_type.tuple_type(columns)
+        # a private cursor without the Row factory, the tuples are made here
+        cur = self.con.cursor()
+        cur.row_factory = None
         try:
-            self.cur2.execute(query, params)
-            while True:
-                records = self.cur2.fetchmany(LocalData.BLOCK_SIZE)
-                if not records:
-                    break
+            for records in self.search_pages(
+                cur, row_type, ",".join(columns), **search
+            ):
                 for record in records:
-                    yield row_type(record).to_media()
-        except Exception:
-            log.error("query: %s\nparams: %s", query, params)
-            raise
+                    yield tuple_type._make(record[1:])  # type: ignore
+        finally:
+            cur.close()
 
     # noinspection SqlResolve
     def get_file_by_path(
@@ -245,19 +665,102 @@ class LocalData:
 
     # functions for managing the SyncFiles Table ##############################
 
+    def get_sync_paths(self) -> Iterator[Tuple[str, str]]:
+        """The Path and FileName of every SyncFiles row, read from the
+        covering unique index and streamed on a private cursor"""
+        cur = self.con.cursor()
+        try:
+            cur.execute("SELECT Path, FileName FROM SyncFiles;")
+            while True:
+                records = cur.fetchmany(self.BLOCK_SIZE)
+                if not records:
+                    break
+                for path, name in records:
+                    yield path, name
+        finally:
+            cur.close()
+
+    def duplicate_key(self, path: str, name: str) -> Tuple[str, str]:
+        return path, name.lower() if self.case_insensitive else name
+
+    def load_key_index(self):
+        """Read the keys that file_duplicate_no needs for every SyncFiles row
+        into memory, so that indexing does not query the DB for each item.
+        Rows written with put_row / put_rows are added as they are written."""
+        self._known_ids = {}
+        self._max_duplicate = {}
+        self.cur2.execute(
+            "SELECT RemoteId, Path, OrigFileName, DuplicateNo, ModifyDate "
+            "FROM SyncFiles;"
+        )
+        for remote_id, path, name, dup, modify_date in self.cur2:
+            self._known_ids[remote_id] = (dup, modify_date)
+            key = self.duplicate_key(path, name)
+            self._max_duplicate[key] = max(dup, self._max_duplicate.get(key, -1))
+        log.debug("loaded index keys for %d items", len(self._known_ids))
+
+    def add_keys(self, rows: Iterable[DbRow]):
+        """keep the in memory key index in step with SyncFiles"""
+        if self._known_ids is None:
+            return
+        for row in rows:
+            if isinstance(row, GooglePhotosRow) and row.RemoteId not in self._known_ids:
+                self._known_ids[row.RemoteId] = (
+                    row.DuplicateNo,  # type: ignore
+                    row.ModifyDate,  # type: ignore
+                )
+                key = self.duplicate_key(row.Path, row.OrigFileName)  # type: ignore
+                self._max_duplicate[key] = max(
+                    row.DuplicateNo, self._max_duplicate.get(key, -1)  # type: ignore
+                )
+
+    def indexed_duplicate_no(
+        self, name: str, path: str, remote_id: str
+    ) -> Tuple[int, Optional[DatabaseMedia]]:
+        """file_duplicate_no answered from the in memory key index. The
+        returned DatabaseMedia for a known item only has the id, duplicate
+        number and modify date filled in."""
+        assert self._known_ids is not None
+        known = self._known_ids.get(remote_id)
+        if known:
+            dup, modify_date = known
+            if not isinstance(modify_date, datetime):
+                modify_date = Utils.timestamp_to_date(modify_date)
+            return dup, DatabaseMedia(
+                _id=remote_id, _duplicate_number=dup, _date=modify_date
+            )
+        # reserve the number straight away, in case the item is written later
+        # in a batch with others of the same name
+        key = self.duplicate_key(path, name)
+        dup = self._max_duplicate.get(key, -1) + 1
+        self._max_duplicate[key] = dup
+        return dup, None
+
     # todo this could be generic and support Albums and LocalFiles too
     def file_duplicate_no(
-        self, name: str, path: str, remote_id: str
+        self,
+        name: str,
+        path: str,
+        remote_id: str,
+        pending: Optional[Dict[Tuple[str, str], int]] = None,
     ) -> Tuple[int, Optional[DatabaseMedia]]:
         """
         determine if there is already an entry for file. If not determine
         if other entries share the same path/filename and determine a duplicate
         number for providing a unique local filename suffix
 
+        Parameters:
+            pending: duplicate numbers already assigned to rows that have not
+                been written yet (e.g. the rest of a page for put_rows),
+                keyed on (path, name). Updated with the number assigned here
+
         Returns:
             duplicate no. (zero if there are no duplicates),
             Single row from the SyncRow table
         """
+        if self._known_ids is not None:
+            return self.indexed_duplicate_no(name, path, remote_id)
+
         query = "SELECT {0} FROM SyncFiles WHERE RemoteId = ?; ".format(
             GooglePhotosRow.columns
         )
@@ -285,23 +788,37 @@ class LocalData:
         if results[0] is not None:
             # assign the next available duplicate no.
             dup = results[0] + 1
-            return dup, None
         else:
             # the file is new and has no duplicates
-            return 0, None
+            dup = 0
+
+        if pending is not None:
+            key = self.duplicate_key(path, name)
+            if key in pending:
+                dup = max(dup, pending[key] + 1)
+            pending[key] = dup
+        return dup, None
 
     def put_location(self, sync_file_id: str, location: str):
-        self.cur.execute(
+        self.write(
             "UPDATE SyncFiles SET Location=? " "WHERE RemoteId IS ?;",
             (location, sync_file_id),
         )
 
     def put_downloaded(self, sync_file_id: str, downloaded: bool = True):
-        self.cur.execute(
+        self.write(
             "UPDATE SyncFiles SET Downloaded=? " "WHERE RemoteId IS ?;",
             (downloaded, sync_file_id),
         )
 
+    def put_downloaded_batch(
+        self, sync_file_ids: Iterable[str], downloaded: bool = True
+    ):
+        self.write_many(
+            "UPDATE SyncFiles SET Downloaded=? " "WHERE RemoteId IS ?;",
+            ((downloaded, sync_file_id) for sync_file_id in sync_file_ids),
+        )
+
     def downloaded_count(self, downloaded: bool = True) -> int:
         self.cur.execute(
             "Select Count(Downloaded) from main.SyncFiles WHERE Downloaded=? ",
@@ -320,7 +837,7 @@ class LocalData:
         return GoogleAlbumsRow(res).to_media()
 
     def put_album_downloaded(self, album_id: str, downloaded: bool = True):
-        self.cur.execute(
+        self.write(
             "UPDATE Albums SET Downloaded=? " "WHERE RemoteId IS ?;",
             (downloaded, album_id),
         )
@@ -330,83 +847,132 @@ class LocalData:
         album_id: str = "%",
         album_invert: bool = False,
         download_again: bool = False,
-    ) -> Iterable[Tuple[Any, ...]]:
+    ) -> Iterator[Tuple[Any, ...]]:
         """Join the Albums, SyncFiles and AlbumFiles tables to get a list
         of the files in an album or all albums.
+
+        The albums are read a page at a time and the files of each album are
+        streamed from a separate statement on a private cursor. The caller may
+        therefore update Albums (e.g. put_album_downloaded) while iterating
+        and the whole join is never held in memory.
+
         Parameters
             album_id: the Google Photos unique id for an album or None for all
             albums
             album_invert: inverses the sorting direction of the returned files
         Returns:
             A tuple containing:
-                Path, Filename, AlbumName, Album end date
+                Path, Filename, AlbumName, Album start date, Album end date,
+                Album RemoteId, CreateDate, IsSharedAlbum
         """
-
-        extra_clauses = "" if download_again else "AND Albums.Downloaded==0"
-
-        query = """
-        SELECT SyncFiles.Path, SyncFiles.Filename, Albums.AlbumName,
-        Albums.StartDate, Albums.EndDate, Albums.RemoteId, SyncFiles.CreateDate,
-        Albums.IsSharedAlbum FROM AlbumFiles
+        extra_clauses = "" if download_again else "AND Downloaded = 0"
+        albums_query = """
+        SELECT RemoteId, AlbumName, StartDate, EndDate, IsSharedAlbum
+        FROM Albums WHERE RemoteId LIKE ? {} AND RemoteId > ?
+        ORDER BY RemoteId LIMIT ?;""".format(extra_clauses)
+        # AlbumFilesPositionIdx covers AlbumFiles for this query and is
+        # already in the requested order
+        files_query = """
+        SELECT SyncFiles.Path, SyncFiles.FileName, SyncFiles.CreateDate
+        FROM AlbumFiles
         INNER JOIN SyncFiles ON AlbumFiles.DriveRec=SyncFiles.RemoteId
-        INNER JOIN Albums ON AlbumFiles.AlbumRec=Albums.RemoteId
-        WHERE Albums.RemoteId LIKE ?
-        {}
-        ORDER BY Albums.RemoteId, AlbumFiles.Position {},
-        SyncFiles.CreateDate;""".format(
-            extra_clauses, "DESC" if album_invert else "ASC"
+        WHERE AlbumFiles.AlbumRec = ?
+        ORDER BY AlbumFiles.Position {0}, AlbumFiles.DriveRec {0};""".format(
+            "DESC" if album_invert else "ASC"
         )
 
-        self.cur.execute(query, (album_id,))
-        results = self.cur.fetchall()
-        # fetchall does not need to use cur2
-        for result in results:
-            yield tuple(result)
+        cur = self.con.cursor()
+        cur.row_factory = None
+        last_album = ""
+        try:
+            while True:
+                cur.execute(albums_query, (album_id, last_album, self.BLOCK_SIZE))
+                albums = cur.fetchall()
+                if not albums:
+                    break
+                last_album = albums[-1][0]
+                for rid, name, start_date, end_date, shared in albums:
+                    cur.execute(files_query, (rid,))
+                    while True:
+                        records = cur.fetchmany(self.BLOCK_SIZE)
+                        if not records:
+                            break
+                        for path, file_name, create_date in records:
+                            yield (
+                                path,
+                                file_name,
+                                name,
+                                start_date,
+                                end_date,
+                                rid,
+                                create_date,
+                                shared,
+                            )
+        finally:
+            cur.close()
 
     def put_album_file(self, album_rec: str, file_rec: str, position: int):
         """Record in the DB a relationship between an album and a media item"""
-        self.cur.execute(
+        self.write(
             "INSERT OR REPLACE INTO AlbumFiles(AlbumRec, DriveRec, Position) "
             "VALUES(?,"
             "?,?) ;",
             (album_rec, file_rec, position),
         )
 
+    def put_album_files(self, album_files: Iterable[Tuple[str, str, int]]):
+        """Record many (album, media item, position) relationships at once"""
+        self.write_many(
+            "INSERT OR REPLACE INTO AlbumFiles(AlbumRec, DriveRec, Position) "
+            "VALUES(?,?,?) ;",
+            album_files,
+        )
+
     def remove_all_album_files(self):
         # noinspection SqlWithoutWhere
-        self.cur.execute("DELETE FROM AlbumFiles")
+        self.write("DELETE FROM AlbumFiles")
 
     # ---- LocalFiles Queries -------------------------------------------
 
-    def get_missing_paths(self):
-        self.cur2.execute(Queries.missing_files)
+    def get_missing_paths(self) -> Iterator[Path]:
+        """local files that have no match in the library"""
+        last_id = 0
         while True:
-            records = self.cur2.fetchmany(LocalData.BLOCK_SIZE)
+            self.cur2.execute(Queries.missing_files, (last_id, self.BLOCK_SIZE))
+            records = self.cur2.fetchall()
             if not records:
                 break
+            last_id = records[-1]["Id"]
             for record in records:
                 r = LocalFilesRow(record).to_media()
                 pth = Path(r.relative_path.parent / r.filename)
                 yield pth
 
-    def get_duplicates(self):
-        self.cur2.execute(Queries.duplicate_files)
+    def get_duplicates(self) -> Iterator[Tuple[str, Path]]:
+        """local files that match the same library item, grouped by item"""
+        last_remote_id = ""
         while True:
-            records = self.cur2.fetchmany(LocalData.BLOCK_SIZE)
+            self.cur2.execute(
+                Queries.duplicate_files, (last_remote_id, self.BLOCK_SIZE)
+            )
+            records = self.cur2.fetchall()
             if not records:
                 break
+            last_remote_id = records[-1]["RemoteId"]
             for record in records:
                 r = LocalFilesRow(record).to_media()
                 pth = r.relative_path.parent / r.filename
                 yield r.id, pth
 
-    def get_extra_paths(self):
-        self.cur2.execute(Queries.pre_extra_files)
-        self.cur2.execute(Queries.extra_files)
+    def get_extra_paths(self) -> Iterator[Path]:
+        """library items that have no match in the local files"""
+        last_id = 0
         while True:
-            records = self.cur2.fetchmany(LocalData.BLOCK_SIZE)
+            self.cur2.execute(Queries.extra_files, (last_id, self.BLOCK_SIZE))
+            records = self.cur2.fetchall()
             if not records:
                 break
+            last_id = records[-1]["Id"]
             for record in records:
                 r = GooglePhotosRow(record).to_media()
                 pth = r.relative_path.parent / r.filename
@@ -422,10 +988,88 @@ class LocalData:
 
     def local_erase(self):
         # noinspection SqlWithoutWhere
-        self.cur.execute("DELETE FROM main.LocalFiles")
+        self.write("DELETE FROM main.LocalFiles")
 
     def find_local_matches(self):
+        """Set LocalFiles.RemoteId to the RemoteId of the SyncFiles entry that
+        each local file is a copy of. Gives the same results as the stages of
+        the original correlated subquery UPDATEs (kept in the tests as the
+        reference) but with one pass over each table and dictionary
+        lookups in place of correlated subqueries:
+            1. same Uid and same name and create date (or any 32 char Uid)
+            2. same name and create date, unused by stage 1
+            3. same name, unused by stages 1 and 2
+        Where several SyncFiles entries qualify, the one chosen is the one
+        the SQL version found first using the indexes SQLite picks for it:
+        the lowest Id for stages 1 and 2 (preferring a name and date match in
+        stage 1) and (DuplicateNo, Description, Id) order for stage 3.
+        """
+        by_uid: Dict[str, List[Tuple[str, str, str]]] = {}
+        by_name_date: Dict[Tuple[str, str], List[str]] = {}
+        by_name: Dict[str, List[str]] = {}
+
+        log.info("Loading remote files for local match")
+        self.cur2.execute(
+            "SELECT RemoteId, Uid, OrigFileName, CreateDate FROM SyncFiles "
+            "ORDER BY Id;"
+        )
+        for remote_id, uid, name, create_date in self.cur2:
+            if uid is not None:
+                by_uid.setdefault(uid, []).append((remote_id, name, create_date))
+            if name is not None and create_date is not None:
+                by_name_date.setdefault((name, create_date), []).append(remote_id)
+        self.cur2.execute(
+            "SELECT RemoteId, OrigFileName FROM SyncFiles "
+            "WHERE OrigFileName NOTNULL ORDER BY DuplicateNo, Description, Id;"
+        )
+        for remote_id, name in self.cur2:
+            by_name.setdefault(name, []).append(remote_id)
+
+        self.cur2.execute(
+            "SELECT Id, Uid, OriginalFileName, CreateDate FROM LocalFiles;"
+        )
+        local_files = self.cur2.fetchall()
+
+        log.info("Matching %d local files", len(local_files))
+        matches: Dict[int, str] = {}
+        for local_id, uid, name, create_date in local_files:
+            if uid is None or uid == "not_supported":
+                continue
+            candidates = by_uid.get(uid, ())
+            for remote_id, remote_name, remote_date in candidates:
+                # (NULL never equals anything in SQL)
+                if (
+                    name is not None
+                    and create_date is not None
+                    and name == remote_name
+                    and create_date == remote_date
+                ):
+                    matches[local_id] = remote_id
+                    break
+            else:
+                # 32 character ids are legitimate and unique
+                if candidates and len(uid) == 32:
+                    matches[local_id] = candidates[0][0]
+
+        def mop_up(key, candidates: Dict[Any, List[str]]):
+            # ids matched by the previous stages are not reused, but one
+            # entry may match several local files within this stage
+            used = set(matches.values())
+            for local_id, _, name, create_date in local_files:
+                if local_id in matches:
+                    continue
+                for remote_id in candidates.get(key(name, create_date), ()):
+                    if remote_id not in used:
+                        matches[local_id] = remote_id
+                        break
+
+        mop_up(lambda name, create_date: (name, create_date), by_name_date)
+        mop_up(lambda name, _: name, by_name)
+
+        log.info("Saving %d local matches", len(matches))
         # noinspection SqlWithoutWhere
-        for i, q in enumerate(Queries.match):
-            log.info("Executing local match query {}".format(i))
-            self.cur.execute(q)
+        self.write("UPDATE LocalFiles SET RemoteId = NULL;")
+        self.write_many(
+            "UPDATE LocalFiles SET RemoteId = ? WHERE Id = ?;",
+            ((remote_id, local_id) for local_id, remote_id in matches.items()),
+        )
@@ -2,7 +2,6 @@ import logging
 from datetime import datetime
 from pathlib import Path
 
-from gphotos_sync.BaseMedia import BaseMedia
 from gphotos_sync.DatabaseMedia import DatabaseMedia
 from gphotos_sync.DbRow import DbRow
 from gphotos_sync.LocalFilesMedia import LocalFilesMedia
@@ -56,7 +55,6 @@ class LocalFilesRow(DbRow):
 
     @classmethod
     def from_media(cls, media: LocalFilesMedia) -> "LocalFilesRow":  # type: ignore
-        now_time = datetime.now().strftime(BaseMedia.TIME_FORMAT)
         new_row = cls.make(
             Path=str(media.relative_folder),
             Uid=media.uid,
@@ -68,6 +66,6 @@ class LocalFilesRow(DbRow):
             Description=media.description,
             ModifyDate=media.modify_date,
             CreateDate=media.create_date,
-            SyncDate=now_time,
+            SyncDate=datetime.now(),
         )
         return new_row
@@ -0,0 +1,127 @@
+# coding: utf8
+from sqlite3.dbapi2 import Cursor
+from typing import Callable, List, NamedTuple, Sequence, Union
+
+"""
+In place upgrades of the index DB schema.
+
+Each Migration brings the schema from the version of the previous entry up
+to its own version, without losing the state held in the index (downloaded
+flags, locations, album contents etc.). LocalData.check_schema_version
+applies those newer than the DB, in order, each in its own transaction.
+A DB older than OLDEST_VERSION is flushed and re-indexed instead.
+
+To change the schema: update sql/gphotos_create.sql for new DBs, append a
+Migration here for existing DBs, and set LocalData.VERSION to its version.
+"""
+
+# a step is an SQL statement or a function that is passed the DB cursor
+Step = Union[str, Callable[[Cursor], None]]
+
+
+class Migration(NamedTuple):
+    version: float
+    description: str
+    steps: Sequence[Step]
+
+
+# the date columns that were stored as strings before version 5.9
+DATE_COLUMNS = {
+    "SyncFiles": ("ModifyDate", "CreateDate", "SyncDate"),
+    "LocalFiles": ("ModifyDate", "CreateDate", "SyncDate"),
+    "Albums": ("StartDate", "EndDate", "SyncDate"),
+    "Globals": ("LastIndex",),
+}
+
+
+def dates_to_timestamps() -> List[str]:
+    """SQL to convert the date strings in DATE_COLUMNS to integers in place.
+    Accepts the same strings as Utils.string_to_date, i.e. any single
+    character separators between the date and time fields"""
+    statements = []
+    for table, columns in DATE_COLUMNS.items():
+        for column in columns:
+            normalized = (
+                "CASE WHEN length({0}) >= 19 THEN "
+                "substr({0},1,4)||'-'||substr({0},6,2)||'-'||substr({0},9,2)||' '||"
+                "substr({0},12,2)||':'||substr({0},15,2)||':'||substr({0},18,2) "
+                "ELSE substr({0},1,4)||'-'||substr({0},6,2)||'-'||substr({0},9,2) "
+                "END".format(column)
+            )
+            statements.append(
+                "UPDATE {0} SET {1} = CAST(strftime('%s', {2}) AS INTEGER) "
+                "WHERE typeof({1}) = 'text';".format(table, column, normalized)
+            )
+    return statements
+
+
+def add_column(table: str, definition: str) -> Callable[[Cursor], None]:
+    """a step that adds a column unless the table already has it"""
+
+    def step(cur: Cursor):
+        columns = [row[1] for row in cur.execute("PRAGMA table_info({})".format(table))]
+        if definition.split()[0] not in columns:
+            cur.execute("ALTER TABLE {} ADD COLUMN {};".format(table, definition))
+
+    return step
+
+
+OLDEST_VERSION: float = 5.7
+
+MIGRATIONS: List[Migration] = [
+    Migration(
+        5.8,
+        "index lower(OrigFileName) for case insensitive filesystems",
+        [
+            "CREATE INDEX IF NOT EXISTS SyncLowerNameIdx "
+            "ON SyncFiles (Path, lower(OrigFileName));"
+        ],
+    ),
+    Migration(5.9, "store dates as integers", dates_to_timestamps()),
+    Migration(
+        6.0,
+        "partial index of items waiting for download",
+        [
+            "CREATE INDEX IF NOT EXISTS SyncPendingIdx "
+            "ON SyncFiles (Downloaded) WHERE Downloaded = 0;"
+        ],
+    ),
+    Migration(
+        6.1,
+        "covering index of album contents in album order",
+        [
+            "CREATE INDEX IF NOT EXISTS AlbumFilesPositionIdx "
+            "ON AlbumFiles (AlbumRec, Position, DriveRec);"
+        ],
+    ),
+    Migration(
+        6.2,
+        "checkpoints of the index progress",
+        [
+            "CREATE TABLE IF NOT EXISTS IndexCheckpoint (Id INTEGER PRIMARY KEY, "
+            "Filter TEXT, EndDate INT, PageToken TEXT, Covered INT, Pages INT, "
+            "Indexed INT, Skipped INT, LatestDownload INT);"
+        ],
+    ),
+    Migration(
+        6.3,
+        "generation of the library listing that last saw each item",
+        [
+            add_column("SyncFiles", "Generation INT"),
+            add_column("Globals", "Generation INT DEFAULT 0"),
+            "UPDATE Globals SET Generation = 0;",
+            # which items were indexed from albums only is not recorded, so
+            # all are in the library until a full listing shows otherwise.
+            # LocalData.remove_unlisted keeps the items of shared albums
+            "UPDATE SyncFiles SET Generation = 0;",
+        ],
+    ),
+    Migration(
+        6.4,
+        "the years re-listed by rolling rescans",
+        [
+            "CREATE TABLE IF NOT EXISTS IndexSlices "
+            "(Year INTEGER PRIMARY KEY, LastScanned INT);"
+        ],
+    ),
+]
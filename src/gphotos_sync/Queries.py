@@ -1,79 +1,34 @@
 # coding: utf8
 
-# noinspection SqlWithoutWhere
-match = [
-    """
--- stage 0 - remove previous matches
-UPDATE LocalFiles
-set RemoteId = NULL  ;
-""",
-    """
--- stage 1 - look for unique matches
-UPDATE LocalFiles
-set RemoteId = (SELECT RemoteId
-                FROM SyncFiles
-                WHERE LocalFiles.OriginalFileName == SyncFiles.OrigFileName
-                  AND (LocalFiles.Uid == SyncFiles.Uid AND
-                       LocalFiles.CreateDate = SyncFiles.CreateDate)
-                  -- 32 character ids are legitimate and unique
-                  OR (LocalFiles.Uid == SyncFiles.Uid AND
-                  length(LocalFiles.Uid) == 32)
-)
-WHERE LocalFiles.Uid notnull and LocalFiles.Uid != 'not_supported'
-;
-""",
-    """
--- stage 2 - mop up entries that have no UID (this is a small enough
--- population that filename + CreateDate is probably unique)
-with pre_match(RemoteId) as
-   (SELECT RemoteId from LocalFiles where RemoteId notnull)
-UPDATE LocalFiles
-set RemoteId = (SELECT RemoteId
-            FROM SyncFiles
-            WHERE LocalFiles.OriginalFileName == SyncFiles.OrigFileName
-              AND LocalFiles.CreateDate = SyncFiles.CreateDate
-            AND SyncFiles.RemoteId NOT IN (select RemoteId from pre_match)
-)
-WHERE LocalFiles.RemoteId isnull
-;
-""",
-    """
--- stage 3 FINAL - mop up on filename only
-with pre_match(RemoteId) as
-   (SELECT RemoteId from LocalFiles where RemoteId notnull)
-UPDATE LocalFiles
-set RemoteId = (SELECT RemoteId
-            FROM SyncFiles
-            WHERE LocalFiles.OriginalFileName == SyncFiles.OrigFileName
-            AND SyncFiles.RemoteId NOT IN (select RemoteId from pre_match)
-)
-WHERE LocalFiles.RemoteId isnull
-;
-""",
-]
+# the reports below are read in pages of LocalData.BLOCK_SIZE rows (or
+# groups), each page starting after the key of the last row of the previous
+# page. None of them modify LocalFiles, so they can be run repeatedly
 
-missing_files = """select * from LocalFiles where RemoteId isnull;"""
-
-pre_extra_files = """
--- overwrite NULL RemoteIds or extra_files will get no matches
-update LocalFiles set RemoteId='not_found' where RemoteId isnull
+missing_files = """
+select * from LocalFiles
+where RemoteId isnull and Id > ?
+order by Id limit ?
+;
 """
 
 extra_files = """
-select * from SyncFiles where RemoteId not in (select RemoteId from LocalFiles)
--- and uid not in (select uid from LocalFiles where length(SyncFiles.Uid) = 32)
+-- anti join, uses LocalRemoteIdIdx
+select SyncFiles.* from SyncFiles
+left join LocalFiles on LocalFiles.RemoteId = SyncFiles.RemoteId
+where LocalFiles.Id isnull and SyncFiles.Id > ?
+order by SyncFiles.Id limit ?
 ;
 """
 
 duplicate_files = """
-with matches(RemoteId) as (
+-- pages by whole groups of duplicates, the groups come from LocalRemoteIdIdx
+select * from LocalFiles
+where RemoteId in (
   select RemoteId from LocalFiles
-  GROUP BY LocalFiles.RemoteId
-  HAVING COUNT(LocalFiles.RemoteId) > 1
+  where RemoteId > ?
+  group by RemoteId having count() > 1
+  order by RemoteId limit ?
 )
-SELECT *
-FROM LocalFiles
-       JOIN matches
-WHERE LocalFiles.RemoteId = matches.RemoteId
+order by RemoteId, Id
 ;
 """
@@ -0,0 +1,194 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from yaml import YAMLError, safe_dump, safe_load
+
+log = logging.getLogger(__name__)
+
+"""
+Pacing of requests to the Google Photos Library API and to the media
+download URLs. Google applies quotas per minute and per day to each of these
+separately so there is one TokenBucket for each of them.
+
+The daily counts and the current sustainable rate are stored in a YAML
+file next to the index DB so that consecutive runs (e.g. from cron) share
+the daily quota.
+"""
+
+THROTTLE_STATUSES = [429, 503]
+
+
+def was_throttled(response) -> bool:
+    """True if a requests Response was rate limited, or was retried by urllib3
+    because of rate limiting before it succeeded"""
+    retries = getattr(response.raw, "retries", None)
+    history = getattr(retries, "history", None) or ()
+    return response.status_code in THROTTLE_STATUSES or any(
+        h.status in THROTTLE_STATUSES for h in history
+    )
+
+
+class QuotaExceeded(Exception):
+    """The daily request quota has been used up. This is deliberately not a
+    RequestException so that it aborts the run instead of marking media items
+    as bad ids"""
+
+
+class TokenBucket:
+    """A thread safe token bucket.
+
+    Tokens are added at 'rate' per second up to 'rate' tokens (one second of
+    burst). reserve() takes a token and returns how long the caller must wait
+    before using it, so that both threads and coroutines can use the bucket.
+
+    When the server signals rate limiting the rate drops by DECREASE and then
+    creeps back up by INCREASE for each minute without throttling, never
+    exceeding the configured maximum. The rate therefore settles just below
+    the highest rate the server will sustain.
+
+    Attributes:
+        name: used in log messages and the persisted state
+        max_rate: configured requests per second (0 for unlimited)
+        rate: current requests per second
+        daily_limit: maximum requests per UTC day (0 for unlimited)
+        used: requests made so far today
+    """
+
+    DECREASE: float = 0.75
+    INCREASE: float = 1.05
+
+    def __init__(
+        self,
+        name: str,
+        rate: float = 0,
+        daily_limit: int = 0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.daily_limit = daily_limit
+        self.day = self.today()
+        self.used = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = float(rate)
+        self._updated = clock()
+        self._last_throttle = self._updated
+
+    @staticmethod
+    def today() -> str:
+        return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+    def reserve(self) -> float:
+        """take a token
+
+        Returns:
+            the number of seconds to wait before making the request
+        """
+        with self._lock:
+            today = self.today()
+            if today != self.day:
+                self.day, self.used = today, 0
+            if self.daily_limit and self.used >= self.daily_limit:
+                raise QuotaExceeded(
+                    "daily quota of {} {} requests used up".format(
+                        self.daily_limit, self.name
+                    )
+                )
+            self.used += 1
+            if not self.rate:
+                return 0
+
+            now = self._clock()
+            if now - self._last_throttle > 60 and self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate * self.INCREASE)
+                self._last_throttle = now
+            self._tokens = min(
+                self.rate, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """take a token, blocking until the request may be made"""
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def throttled(self):
+        """the server has rate limited a request made with this bucket"""
+        with self._lock:
+            self._last_throttle = self._clock()
+            if self.rate:
+                previous = self.rate
+                self.rate = max(self.rate * self.DECREASE, 0.1)
+                log.info(
+                    "%s request rate %.2f/s -> %.2f/s after rate limiting",
+                    self.name,
+                    previous,
+                    self.rate,
+                )
+
+    def to_dict(self) -> Dict:
+        return {"day": self.day, "used": self.used, "rate": self.rate}
+
+    def from_dict(self, state: Dict):
+        if state.get("day") == self.today():
+            self.used = int(state.get("used", 0))
+        rate = state.get("rate")
+        if self.max_rate and rate:
+            self.rate = min(self.max_rate, float(rate))
+            self._tokens = min(self._tokens, self.rate)
+
+
+class RateLimiter:
+    """The shared rate limits for API calls and media downloads
+
+    Attributes:
+        api: TokenBucket for Google Photos Library API calls
+        media: TokenBucket for media downloads from base urls
+    """
+
+    def __init__(
+        self,
+        state_file: Optional[Path] = None,
+        api_rate: float = 0,
+        api_daily: int = 0,
+        media_rate: float = 0,
+        media_daily: int = 0,
+    ):
+        self.state_file = state_file
+        self.api = TokenBucket("api", api_rate, api_daily)
+        self.media = TokenBucket("media", media_rate, media_daily)
+        self.load()
+
+    def load(self):
+        if not self.state_file:
+            return
+        try:
+            with self.state_file.open("r") as stream:
+                state = safe_load(stream) or {}
+            self.api.from_dict(state.get("api", {}))
+            self.media.from_dict(state.get("media", {}))
+            log.debug(
+                "rate limits loaded, used today: api %d, media %d",
+                self.api.used,
+                self.media.used,
+            )
+        except (YAMLError, IOError, AttributeError, ValueError):
+            log.debug("no rate limit state, starting from configured rates")
+
+    def store(self):
+        if not self.state_file:
+            return
+        state = {"api": self.api.to_dict(), "media": self.media.to_dict()}
+        with self.state_file.open("w") as stream:
+            safe_dump(state, stream, default_flow_style=False)
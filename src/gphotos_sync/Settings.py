@@ -41,6 +41,14 @@ class Settings:
     rescan: bool
     max_retries: int
     max_threads: int
+    prefetch_batches: int
+    pipeline: bool
+    index_workers: int
+    rolling_rescan: int
+    download_engine: str
+    adaptive_threads: bool
+    segment_threshold: int
+    download_segments: int
     case_insensitive_fs: bool
     progress: bool
 
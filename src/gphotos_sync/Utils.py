@@ -1,11 +1,11 @@
 import logging
 import re
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from os import utime
 from pathlib import Path
 from sqlite3 import Timestamp
 from tempfile import NamedTemporaryFile
-from typing import Optional
+from typing import Optional, Union
 
 # Todo tisy this into a class (combine with checks?)
 
@@ -17,6 +17,9 @@ PatType = type(DATE_NORMALIZE)
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 DATE_ONLY = "%Y-%m-%d"
 MINIMUM_DATE = datetime(year=1900, month=1, day=1)
+# dates are stored in the DB as whole seconds since EPOCH, naive dates are
+# treated as UTC
+EPOCH = datetime(year=1970, month=1, day=1)
 
 
 # incredibly windows cannot handle dates below 1980
@@ -38,6 +41,23 @@ def date_to_string(date_t: datetime):
     return date_t.strftime(DATE_FORMAT)
 
 
+def date_to_timestamp(date_t: datetime) -> int:
+    """the integer that represents date_t in the DB"""
+    if date_t.tzinfo:
+        date_t = date_t.astimezone(timezone.utc).replace(tzinfo=None)
+    return (date_t - EPOCH) // timedelta(seconds=1)
+
+
+def timestamp_to_date(value: Union[int, str, None]) -> Optional[datetime]:
+    """the inverse of date_to_timestamp. Also accepts the date strings used
+    by DB versions before 5.9"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        return string_to_date(value)
+    return EPOCH + timedelta(seconds=value)
+
+
 def maximum_date() -> datetime:
     return datetime.max
 
@@ -20,6 +20,7 @@ from gphotos_sync.GooglePhotosIndex import GooglePhotosIndex
 from gphotos_sync.LocalData import LocalData
 from gphotos_sync.LocalFilesScan import LocalFilesScan
 from gphotos_sync.Logging import setup_logging
+from gphotos_sync.RateLimiter import RateLimiter
 from gphotos_sync.restclient import RestClient
 from gphotos_sync.Settings import Settings
 
@@ -51,6 +52,7 @@ class GooglePhotosSyncMain:
         self.google_photos_down: GooglePhotosDownload
         self.google_albums_sync: GoogleAlbumsSync
         self.local_files_scan: LocalFilesScan
+        self.rate_limiter: RateLimiter
         self._start_date: Optional[DateTime]
         self._end_date = Optional[DateTime]
 
@@ -126,6 +128,30 @@ class GooglePhotosSyncMain:
         action="store_true",
         help="delete the index db, re-scan everything",
     )
+    parser.add_argument(
+        "--db-profile",
+        choices=sorted(LocalData.PROFILES),
+        default="safe",
+        help="SQLite settings for the index db. 'fast' uses a write ahead log, "
+        "fewer disk syncs and a larger cache. It allows other processes to read "
+        "the db during a sync but must not be used when --db-path is on a "
+        "network filesystem. 'safe' returns the db to a rollback journal",
+    )
+    parser.add_argument(
+        "--db-writer",
+        action="store_true",
+        help="write to the index db from a dedicated thread that batches "
+        "changes into larger transactions, with a separate connection for "
+        "reading in each thread. Switches the db to a write ahead log, so "
+        "must not be used when --db-path is on a network filesystem",
+    )
+    parser.add_argument(
+        "--cache-index-keys",
+        action="store_true",
+        help="load the keys of all indexed items into memory at the start of "
+        "the run. Speeds up indexing of large libraries at the cost of some "
+        "memory (roughly 100MB per 300,000 items)",
+    )
     parser.add_argument(
         "--rescan",
         action="store_true",
@@ -223,12 +249,42 @@ class GooglePhotosSyncMain:
         action="store_true",
         help="Use index from previous run and start download immediately",
     )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Start downloading newly indexed media while the rest of the "
+        "library is still being indexed",
+    )
+    parser.add_argument(
+        "--index-workers",
+        help="List the library with this many parallel searches, each over "
+        "a range of dates. Ranges holding many items are split between the "
+        "searches as they are found. 1 lists the library in a single search",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--rolling-rescan",
+        help="Re-list a slice of the library's years after each incremental "
+        "index so that every year is re-listed within this many runs. This "
+        "finds items added with old dates, and removes deleted items from the "
+        "index, without a full --rescan. Not used with --favourites-only. 0 (the "
+        "default) disables it",
+        type=int,
+        default=0,
+    )
     parser.add_argument(
         "--do-delete",
         action="store_true",
         help="""Remove local copies of files that were deleted.
-        Must be used with --flush-index since the deleted items must be removed
-        from the index""",
+        Deleted items are removed from the index by a listing of the whole
+        library, so use with --rescan to find the latest deletions""",
+    )
+    parser.add_argument(
+        "--delete-dry-run",
+        action="store_true",
+        help="List the local files that --do-delete would remove without "
+        "removing them",
     )
     parser.add_argument(
         "--skip-files",
@@ -269,6 +325,73 @@ class GooglePhotosSyncMain:
         type=int,
         default=20,
     )
+    parser.add_argument(
+        "--prefetch-batches",
+        help="Request the download urls of this many batches of media ahead "
+        "of their download, so that downloads are not left waiting for them. "
+        "0 requests each batch's urls just before it is downloaded",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--adaptive-threads",
+        action="store_true",
+        help="Tune the number of concurrent downloads from the measured "
+        "throughput, latency and rate limiting responses. --max-threads is "
+        "the upper limit",
+    )
+    parser.add_argument(
+        "--download-engine",
+        help="Select how media are downloaded concurrently. 'threads' uses a "
+        "thread per download. 'async' uses a single event loop and can keep "
+        "many more downloads in flight (requires aiohttp). --max-threads sets "
+        "the number of concurrent downloads for either engine",
+        choices=["threads", "async"],
+        default="threads",
+    )
+    parser.add_argument(
+        "--segment-threshold",
+        help="Download media larger than this many MB as several byte ranges "
+        "in parallel (threads engine only). 0 disables segmented download",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--download-segments",
+        help="The number of byte ranges to fetch in parallel for media above "
+        "--segment-threshold",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--api-rate",
+        help="Limit Google Photos API calls to this many per second "
+        "(0 for no limit). The rate is reduced automatically if the server "
+        "reports rate limiting",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--api-daily-quota",
+        help="Stop before making more than this many API calls in a day, "
+        "counting calls made by earlier runs (0 for no limit)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--media-rate",
+        help="Limit media download requests to this many per second "
+        "(0 for no limit)",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--media-daily-quota",
+        help="Stop before making more than this many media download requests "
+        "in a day, counting requests made by earlier runs (0 for no limit)",
+        type=int,
+        default=0,
+    )
     parser.add_argument(
         "--secret",
         help="Path to client secret file (by default this is in the "
@@ -344,7 +467,11 @@ class GooglePhotosSyncMain:
             compare_folder = Path(args.compare_folder).absolute()
         app_dirs = AppDirs(APP_NAME)
 
-        self.data_store = LocalData(db_path, args.flush_index)
+        self.data_store = LocalData(db_path, args.flush_index, args.db_profile)
+        if args.cache_index_keys:
+            self.data_store.load_key_index()
+        if args.db_writer:
+            self.data_store.start_writer()
 
         credentials_file = db_path / ".gphotos.token"
         if args.secret:
@@ -391,6 +518,14 @@ class GooglePhotosSyncMain:
             use_flat_path=args.use_flat_path,
             max_retries=int(args.max_retries),
             max_threads=int(args.max_threads),
+            prefetch_batches=int(args.prefetch_batches),
+            pipeline=args.pipeline,
+            index_workers=int(args.index_workers),
+            rolling_rescan=int(args.rolling_rescan),
+            download_engine=args.download_engine,
+            adaptive_threads=args.adaptive_threads,
+            segment_threshold=int(args.segment_threshold) * 1024 * 1024,
+            download_segments=int(args.download_segments),
             omit_album_date=args.omit_album_date,
             album_invert=args.album_invert,
             use_hardlinks=args.use_hardlinks,
@@ -403,15 +538,27 @@ class GooglePhotosSyncMain:
             no_album_sorting=args.no_album_sorting,
         )
 
+        self.rate_limiter = RateLimiter(
+            db_path / "gphotos.quota.yaml",
+            api_rate=args.api_rate,
+            api_daily=args.api_daily_quota,
+            media_rate=args.media_rate,
+            media_daily=args.media_daily_quota,
+        )
         self.google_photos_client = RestClient(
             photos_api_url,
             self.auth.session,  # type: ignore
+            self.rate_limiter,
         )
         self.google_photos_idx = GooglePhotosIndex(
             self.google_photos_client, root_folder, self.data_store, settings
         )
         self.google_photos_down = GooglePhotosDownload(
-            self.google_photos_client, root_folder, self.data_store, settings
+            self.google_photos_client,
+            root_folder,
+            self.data_store,
+            settings,
+            self.rate_limiter,
         )
         self.google_albums_sync = GoogleAlbumsSync(
             self.google_photos_client,
@@ -432,7 +579,10 @@ class GooglePhotosSyncMain:
         with self.data_store:
             if not args.skip_index:
                 if not args.skip_files and not args.album and not args.album_regex:
-                    self.google_photos_idx.index_photos_media()
+                    if args.pipeline and not args.index_only:
+                        self.index_and_download()
+                    else:
+                        self.google_photos_idx.index_photos_media()
 
             if not args.index_only:
                 if not args.skip_files:
@@ -458,8 +608,8 @@ class GooglePhotosSyncMain:
                     or (args.album is not None or args.album_regex is not None)
                 ):
                     self.google_albums_sync.create_album_content_links()
-                if args.do_delete:
-                    self.google_photos_idx.check_for_removed()
+                if args.do_delete or args.delete_dry_run:
+                    self.google_photos_idx.check_for_removed(args.delete_dry_run)
 
             if args.compare_folder:
                 if not args.skip_index:
@@ -467,8 +617,24 @@ class GooglePhotosSyncMain:
                     self.google_photos_idx.get_extra_meta()
                 self.local_files_scan.find_missing_gphotos()
 
+    def index_and_download(self):
+        """Index the library and download each page of newly indexed media
+        while the following pages are listed. The regular download that
+        follows in do_sync picks up anything indexed in previous runs that
+        is still waiting to be downloaded"""
+        try:
+            self.google_photos_idx.index_photos_media(
+                on_page=self.google_photos_down.download_indexed_media
+            )
+            self.google_photos_down.flush_batches()
+        finally:
+            self.google_photos_down.complete_downloads(report=False)
+
     def start(self, args: Namespace):
-        self.do_sync(args)
+        try:
+            self.do_sync(args)
+        finally:
+            self.rate_limiter.store()
 
     @staticmethod
     def fs_checks(root_folder: Path, args):
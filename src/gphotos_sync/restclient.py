@@ -1,10 +1,12 @@
 import logging
 from json import dumps
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
 
 from requests import Session
 from requests.exceptions import HTTPError
 
+from gphotos_sync.RateLimiter import RateLimiter, was_throttled
+
 JSONValue = Union[str, int, float, bool, None, Dict[str, Any], List[Any]]
 JSONType = Union[Dict[str, JSONValue], List[JSONValue]]
 
@@ -34,11 +36,17 @@ class RestClient:
         https://developers.google.com/discovery/v1/using
     """
 
-    def __init__(self, api_url: str, auth_session: Session):
+    def __init__(
+        self,
+        api_url: str,
+        auth_session: Session,
+        rate_limiter: Optional[RateLimiter] = None,
+    ):
         """
         Create a rest API object tree from an api description
         """
         self.auth_session: Session = auth_session
+        self.rate_limiter: RateLimiter = rate_limiter or RateLimiter()
         service_document = self.auth_session.get(api_url).json()
         self.json: JSONType = service_document
         self.base_url: str = str(service_document["baseUrl"])
@@ -95,9 +103,12 @@ class Method:
             query_args,
             body,
         )
+        self.service.rate_limiter.api.acquire()
         result = self.service.auth_session.request(
             self.httpMethod, data=body, url=path, timeout=10, params=query_args
         )
+        if was_throttled(result):
+            self.service.rate_limiter.api.throttled()
         log.trace(  # type: ignore
             "\nRESPONSE: %s\n%s", result.status_code, str(result.content)
         )
@@ -80,7 +80,8 @@ create table SyncFiles
 	CreateDate INT,
 	SyncDate INT,
   Downloaded INT DEFAULT 0,
-  Location Text
+  Location Text,
+  Generation INT -- the last library listing that saw this item
 );
 
 DROP INDEX IF EXISTS RemoteIdIdx;
@@ -91,6 +92,8 @@ DROP INDEX IF EXISTS FileSizeAndSizeIdx;
 DROP INDEX IF EXISTS CreatedIdx;
 DROP INDEX IF EXISTS ModifyDateIdx;
 DROP INDEX IF EXISTS SyncMatchIdx;
+DROP INDEX IF EXISTS SyncLowerNameIdx;
+DROP INDEX IF EXISTS SyncPendingIdx;
 DROP INDEX IF EXISTS SyncFiles_Path_FileName_DuplicateNo_uindex;
 create unique index RemoteIdIdx	on SyncFiles (RemoteId);
 create index FileNameIdx  on SyncFiles (FileName);
@@ -100,6 +103,10 @@ create index FileSizeAndSizeIdx  on SyncFiles (FileName, FileSize);
 create index CreatedIdx  on SyncFiles (CreateDate);
 create index ModifyDateIdx  on SyncFiles (ModifyDate);
 create index SyncMatchIdx  on SyncFiles (OrigFileName, DuplicateNo, Description);
+-- for case insensitive duplicate lookups (file_duplicate_no)
+create index SyncLowerNameIdx  on SyncFiles (Path, lower(OrigFileName));
+-- items waiting for download (get_rows_by_search skip_downloaded)
+create index SyncPendingIdx  on SyncFiles (Downloaded) where Downloaded = 0;
 create unique index SyncFiles_Path_FileName_DuplicateNo_uindex
  	on SyncFiles (Path, FileName, DuplicateNo);
 
@@ -120,6 +127,10 @@ create table AlbumFiles
 DROP INDEX IF EXISTS AlbumFiles_AlbumRec_DriveRec_uindex;
 create unique index AlbumFiles_AlbumRec_DriveRec_uindex
 	on AlbumFiles (AlbumRec, DriveRec);
+-- album contents in album order (get_album_files)
+DROP INDEX IF EXISTS AlbumFilesPositionIdx;
+create index AlbumFilesPositionIdx
+	on AlbumFiles (AlbumRec, Position, DriveRec);
 
 drop table if exists Globals;
 CREATE TABLE Globals
@@ -128,8 +139,32 @@ CREATE TABLE Globals
   Version TEXT,
   Albums INTEGER,
   Files INTEGER,
-  LastIndex INT -- Date of last sync
+  LastIndex INT, -- Date of last sync
+  Generation INT DEFAULT 0 -- the last full listing of the library
 );
 CREATE UNIQUE INDEX Globals_Id_uindex ON Globals (Id);
 
+-- the progress of an unfinished index_photos_media, saved after each page
+drop table if exists IndexCheckpoint;
+CREATE TABLE IndexCheckpoint
+(
+  Id INTEGER PRIMARY KEY,
+  Filter TEXT, -- the search being indexed
+  EndDate INT, -- the end date of the listing that PageToken continues
+  PageToken TEXT,
+  Covered INT, -- the items created after this date have all been indexed
+  Pages INT,
+  Indexed INT,
+  Skipped INT,
+  LatestDownload INT
+);
+
+-- when each year of the library was last re-listed by --rolling-rescan
+drop table if exists IndexSlices;
+CREATE TABLE IndexSlices
+(
+  Year INTEGER PRIMARY KEY,
+  LastScanned INT
+);
+
 
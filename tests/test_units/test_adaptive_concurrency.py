@@ -0,0 +1,47 @@
+from unittest import TestCase
+
+from gphotos_sync.AdaptiveConcurrency import AdaptiveConcurrency
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestAdaptiveConcurrency(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.control = AdaptiveConcurrency(ceiling=8, window=4, clock=self.clock)
+
+    def run_window(self, rate: float, latency: float = 1.0, throttled: int = 0):
+        """complete one window of downloads at rate bytes/sec"""
+        count = max(self.control.window, self.control.limit)
+        self.clock.now += 1
+        for i in range(count):
+            self.control.record(int(rate / count), latency, i < throttled)
+
+    def test_increase_to_ceiling(self):
+        self.assertEqual(self.control.limit, 4)
+        for rate in range(1, 10):
+            self.run_window(rate * 1000)
+        self.assertEqual(self.control.limit, 8)
+
+    def test_throttled_halves(self):
+        self.run_window(1000)
+        self.assertEqual(self.control.limit, 5)
+        self.run_window(1000, throttled=1)
+        self.assertEqual(self.control.limit, 2)
+        for _ in range(5):
+            self.run_window(1000, throttled=1)
+        self.assertEqual(self.control.limit, 1)
+
+    def test_falling_throughput_and_rising_latency(self):
+        self.run_window(10000)
+        self.assertEqual(self.control.limit, 5)
+        self.run_window(5000)
+        self.assertEqual(self.control.limit, 4)
+        self.run_window(5000, latency=3)
+        self.assertEqual(self.control.limit, 3)
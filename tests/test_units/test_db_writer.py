@@ -0,0 +1,126 @@
+import sqlite3 as lite
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+
+from gphotos_sync.Checks import do_check
+from gphotos_sync.DbWriter import DbWriter
+from gphotos_sync.GooglePhotosRow import GooglePhotosRow
+from gphotos_sync.LocalData import LocalData
+
+from .test_local_data import make_row
+
+
+class TestDbWriter(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.db_file = Path(self.tmp.name) / "test.sqlite"
+        con = lite.connect(str(self.db_file))
+        con.execute("CREATE TABLE T (Id INTEGER PRIMARY KEY, Value TEXT UNIQUE)")
+        con.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def count(self) -> int:
+        con = lite.connect(str(self.db_file))
+        try:
+            return con.execute("SELECT COUNT() FROM T").fetchone()[0]
+        finally:
+            con.close()
+
+    def test_many_producers(self):
+        writer = DbWriter(self.db_file, {"journal_mode": "WAL"})
+
+        def produce(n: int):
+            for i in range(200):
+                writer.execute(
+                    "INSERT INTO T (Value) VALUES (?)", ("{}-{}".format(n, i),)
+                )
+
+        threads = [Thread(target=produce, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.flush()
+        self.assertEqual(self.count(), 1600)
+        writer.executemany(
+            "INSERT INTO T (Value) VALUES (?)", ((str(i),) for i in range(5))
+        )
+        writer.close()
+        self.assertEqual(self.count(), 1605)
+        with self.assertRaises(RuntimeError):
+            writer.execute("DELETE FROM T")
+
+    def test_failed_command(self):
+        writer = DbWriter(self.db_file, {})
+        writer.execute("INSERT INTO T (Value) VALUES ('a')")
+        writer.execute("INSERT INTO T (Value) VALUES ('a')")
+        writer.execute("INSERT INTO T (Value) VALUES ('b')")
+        # only the failing command is lost and its error is logged and raised
+        with self.assertRaises(lite.IntegrityError):
+            with self.assertLogs("gphotos_sync.DbWriter", "ERROR") as logs:
+                writer.flush()
+        self.assertIn("SQL constraint issue writing 1 rows", logs.output[0])
+        self.assertEqual(self.count(), 2)
+        writer.flush()
+        writer.close()
+
+
+class TestLocalDataWriter(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        do_check(self.root)
+        self.db = LocalData(self.root)
+        self.db.start_writer()
+
+    def tearDown(self):
+        self.db.stop_writer()
+        self.db.con.close()
+        self.tmp.cleanup()
+
+    def test_read_own_writes(self):
+        self.db.put_rows([make_row(i) for i in range(10)])
+        self.db.put_downloaded("rid3")
+        self.assertEqual(self.db.downloaded_count(), 1)
+        num, row = self.db.file_duplicate_no("img_3.jpg", "photos/2020/01", "rid3")
+        self.assertEqual(row.id, "rid3")
+
+    def test_threads(self):
+        self.db.put_rows([make_row(i) for i in range(100)])
+        counts = []
+        connections = []
+
+        def worker(n: int):
+            # each thread has its own connection and sees its own writes
+            for i in range(n, 100, 4):
+                self.db.put_downloaded("rid{}".format(i))
+            counts.append(
+                sum(
+                    1
+                    for _ in self.db.get_rows_by_search(
+                        GooglePhotosRow, skip_downloaded=True
+                    )
+                )
+            )
+            connections.append(self.db.con)
+
+        main_con = self.db.con
+        threads = [Thread(target=worker, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(counts), 4)
+        self.assertEqual(len({id(con) for con in connections + [main_con]}), 5)
+        self.assertTrue(all(count <= 75 for count in counts))
+        self.db.store()
+        self.assertEqual(self.db.downloaded_count(), 100)
+
+        self.db.stop_writer()
+        self.db.put_downloaded("rid1", False)
+        self.assertEqual(self.db.downloaded_count(False), 1)
+        self.assertIs(self.db.con, main_con)
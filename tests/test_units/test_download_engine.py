@@ -0,0 +1,359 @@
+import base64
+import hashlib
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Thread, current_thread
+from unittest import TestCase
+
+from mock import MagicMock, patch
+
+from gphotos_sync import AsyncDownloadPool
+from gphotos_sync.Checks import do_check
+from gphotos_sync.DatabaseMedia import DatabaseMedia
+from gphotos_sync.GooglePhotosDownload import GooglePhotosDownload  # type: ignore
+
+CONTENT = bytes(range(256)) * 1000
+CONTENT_MD5 = base64.b64encode(hashlib.md5(CONTENT).digest()).decode()
+
+
+class Handler(BaseHTTPRequestHandler):
+    # paths that drop the connection half way through their first response
+    flaky: set = set()
+    # paths that serve a wrong byte in the last segment of a segmented download
+    corrupt: set = set()
+    ranges: list = []
+
+    def do_GET(self):
+        if self.path.startswith("/missing"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        offset, end = 0, len(CONTENT)
+        requested = self.headers.get("Range")
+        if requested:
+            self.ranges.append((self.path, requested))
+            first, last = requested[len("bytes=") :].split("-")
+            offset, end = int(first), int(last) + 1 if last else len(CONTENT)
+            self.send_response(206)
+            self.send_header(
+                "Content-Range",
+                "bytes {}-{}/{}".format(offset, end - 1, len(CONTENT)),
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - offset))
+        self.send_header("X-Goog-Hash", "crc32c=AAAAAA==,md5=" + CONTENT_MD5)
+        self.end_headers()
+        if self.path in self.flaky:
+            self.flaky.discard(self.path)
+            self.wfile.write(CONTENT[offset : offset + 1000])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        body = CONTENT[offset:end]
+        if self.path in self.corrupt and end == len(CONTENT) and offset:
+            body = body[:-1] + b"x"
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownloadEngine(TestCase):
+    def setUp(self):
+        Handler.flaky = set()
+        Handler.corrupt = set()
+        Handler.ranges = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        do_check(self.root)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def make_media(self, name: str) -> DatabaseMedia:
+        return DatabaseMedia(
+            _id=name,
+            _relative_folder=Path("photos"),
+            _filename=name,
+            _orig_name=name,
+            _mime_type="image/jpeg",
+            _create_date=datetime(2020, 1, 1),
+            _date=datetime(2020, 1, 1),
+        )
+
+    def make_downloader(
+        self,
+        engine="threads",
+        max_retries=0,
+        segment_threshold=0,
+        adaptive=False,
+        prefetch_batches=2,
+    ):
+        settings = MagicMock(
+            download_engine=engine,
+            adaptive_threads=adaptive,
+            max_threads=4,
+            prefetch_batches=prefetch_batches,
+            max_retries=max_retries,
+            segment_threshold=segment_threshold,
+            download_segments=4,
+            image_timeout=10,
+            video_timeout=10,
+            case_insensitive_fs=False,
+            progress=False,
+        )
+        db = MagicMock(writer=None)
+        return GooglePhotosDownload(MagicMock(), self.root, db, settings)
+
+    def download(self, engine: str, names, max_retries=0, segment_threshold=0):
+        down = self.make_downloader(engine, max_retries, segment_threshold)
+        try:
+            (self.root / "photos").mkdir(exist_ok=True)
+            for name in names:
+                down.download_file(
+                    self.make_media(name), {"baseUrl": self.url + "/" + name}
+                )
+            down.complete_downloads()
+        finally:
+            down.close()
+        return down, down._db
+
+    def check_engine(self, engine: str):
+        names = ["{}_{}.jpg".format(engine, i) for i in range(10)]
+        down, db = self.download(engine, names + ["missing.jpg"])
+        for name in names:
+            self.assertEqual((self.root / "photos" / name).read_bytes(), CONTENT)
+        self.assertFalse((self.root / "photos" / "missing.jpg").exists())
+        self.assertEqual(down.files_downloaded, 10)
+        self.assertEqual(down.files_download_failed, 1)
+        self.assertIn("missing.jpg", down.bad_ids.items)
+        recorded = [
+            rid for call in db.put_downloaded_batch.call_args_list for rid in call[0][0]
+        ]
+        self.assertEqual(sorted(recorded), sorted(names))
+        # no temporary files left behind
+        self.assertEqual(len(list((self.root / "photos").iterdir())), 10)
+
+    def test_threads_engine(self):
+        self.check_engine("threads")
+
+    def test_async_engine(self):
+        if not AsyncDownloadPool.available():
+            self.skipTest("aiohttp not installed")
+        self.check_engine("async")
+
+    def test_threads_engine_writer(self):
+        names = ["writer_{}.jpg".format(i) for i in range(10)]
+        down = self.make_downloader()
+        down._db.writer = MagicMock()
+        threads = set()
+        down._db.put_downloaded.side_effect = lambda _: threads.add(current_thread())
+        try:
+            (self.root / "photos").mkdir()
+            for name in names:
+                down.download_file(
+                    self.make_media(name), {"baseUrl": self.url + "/" + name}
+                )
+            down.complete_downloads()
+        finally:
+            down.close()
+        # each flag is queued by the thread that finished the download
+        recorded = [call[0][0] for call in down._db.put_downloaded.call_args_list]
+        self.assertEqual(sorted(recorded), sorted(names))
+        self.assertNotIn(current_thread(), threads)
+        down._db.put_downloaded_batch.assert_not_called()
+
+    def test_async_file_io_off_loop(self):
+        if not AsyncDownloadPool.available():
+            self.skipTest("aiohttp not installed")
+        threads = []
+        check_download = GooglePhotosDownload.check_download
+
+        def record(down, *args):
+            threads.append(current_thread().name)
+            return check_download(down, *args)
+
+        with patch.object(GooglePhotosDownload, "check_download", record):
+            self.download("async", ["off_loop.jpg"])
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], "gphotos-download-loop")
+
+    def check_resume(self, engine: str):
+        photos = self.root / "photos"
+        photos.mkdir()
+        # a partial file left behind by a previous run
+        (photos / ".gphotos-resumed.jpg.part").write_bytes(CONTENT[:5000])
+        # a connection that drops part way through this run
+        Handler.flaky.add("/dropped.jpg=d")
+
+        down, _ = self.download(engine, ["resumed.jpg", "dropped.jpg"], 2)
+        for name in ["resumed.jpg", "dropped.jpg"]:
+            self.assertEqual((photos / name).read_bytes(), CONTENT)
+        self.assertEqual(down.files_download_failed, 0)
+        self.assertIn(("/resumed.jpg=d", "bytes=5000-"), Handler.ranges)
+        self.assertIn(("/dropped.jpg=d", "bytes=1000-"), Handler.ranges)
+        self.assertEqual(
+            sorted(p.name for p in photos.iterdir()), ["dropped.jpg", "resumed.jpg"]
+        )
+
+    def check_incomplete(self, engine: str):
+        photos = self.root / "photos"
+        Handler.flaky.add("/dropped.jpg=d")
+
+        down, db = self.download(engine, ["dropped.jpg"])
+        self.assertFalse((photos / "dropped.jpg").exists())
+        self.assertEqual(
+            (photos / ".gphotos-dropped.jpg.part").read_bytes(), CONTENT[:1000]
+        )
+        self.assertEqual(down.files_download_failed, 1)
+        # incomplete downloads are not bad ids so they are resumed next run
+        self.assertNotIn("dropped.jpg", down.bad_ids.items)
+
+    def test_threads_resume(self):
+        self.check_resume("threads")
+        self.tearDown()
+        self.setUp()
+        self.check_incomplete("threads")
+
+    def test_async_resume(self):
+        if not AsyncDownloadPool.available():
+            self.skipTest("aiohttp not installed")
+        self.check_resume("async")
+        self.tearDown()
+        self.setUp()
+        self.check_incomplete("async")
+
+    def test_segmented(self):
+        names = ["segmented_{}.jpg".format(i) for i in range(3)]
+        down, _ = self.download("threads", names, segment_threshold=100000)
+        for name in names:
+            self.assertEqual((self.root / "photos" / name).read_bytes(), CONTENT)
+        self.assertEqual(down.files_downloaded, 3)
+        requested = {r for p, r in Handler.ranges if p == "/segmented_0.jpg=d"}
+        self.assertEqual(
+            requested,
+            {
+                "bytes=0-",
+                "bytes=64000-127999",
+                "bytes=128000-191999",
+                "bytes=192000-255999",
+            },
+        )
+
+    def test_segmented_resume(self):
+        photos = self.root / "photos"
+        photos.mkdir()
+        # the files left behind by a run that stopped during a segmented download
+        part = photos / ".gphotos-crashed.jpg.part"
+        part.write_bytes(CONTENT[:1000])
+        (photos / (part.name + ".64000-128000")).write_bytes(CONTENT[64000:128000])
+        (photos / (part.name + ".128000-192000")).write_bytes(b"")
+        (photos / (part.name + ".192000-256000")).write_bytes(CONTENT[192000:200000])
+
+        down, _ = self.download("threads", ["crashed.jpg"], segment_threshold=100000)
+        self.assertEqual((photos / "crashed.jpg").read_bytes(), CONTENT)
+        self.assertEqual(down.files_downloaded, 1)
+        self.assertEqual(
+            sorted(r for _, r in Handler.ranges),
+            ["bytes=1000-63999", "bytes=128000-191999", "bytes=200000-255999"],
+        )
+        self.assertEqual([p.name for p in photos.iterdir()], ["crashed.jpg"])
+
+    def test_segmented_checksum(self):
+        Handler.corrupt.add("/corrupt.jpg=d")
+        down, _ = self.download("threads", ["corrupt.jpg"], segment_threshold=100000)
+        self.assertEqual(down.files_download_failed, 1)
+        self.assertEqual(list((self.root / "photos").iterdir()), [])
+
+    def test_segmented_below_threshold(self):
+        down, _ = self.download("threads", ["small.jpg"], segment_threshold=10**6)
+        self.assertEqual((self.root / "photos" / "small.jpg").read_bytes(), CONTENT)
+        self.assertEqual(Handler.ranges, [("/small.jpg=d", "bytes=0-")])
+
+    def batch_get(self, mediaItemIds):
+        self.batch_gets.append(list(mediaItemIds))
+        results = [
+            {"mediaItem": {"id": i, "baseUrl": self.url + "/" + i}}
+            for i in mediaItemIds
+        ]
+        return MagicMock(json=lambda: {"mediaItemResults": results})
+
+    def check_prefetch(self, lifetime: int, prefetch_batches: int = 2):
+        self.batch_gets: list = []
+        names = ["batch_{}.jpg".format(i) for i in range(100)]
+        down = self.make_downloader(prefetch_batches=prefetch_batches)
+        down.BASE_URL_LIFETIME = lifetime
+        down._api.mediaItems.batchGet.execute = self.batch_get
+        try:
+            down.download_indexed_media([self.make_media(n) for n in names])
+            down.flush_batches()
+            down.complete_downloads()
+        finally:
+            down.close()
+        for name in names:
+            self.assertEqual((self.root / "photos" / name).read_bytes(), CONTENT)
+        self.assertEqual(down.files_downloaded, 100)
+        return self.batch_gets
+
+    def test_prefetch_base_urls(self):
+        batch_gets = self.check_prefetch(50 * 60)
+        self.assertEqual([len(b) for b in batch_gets], [40, 40, 20])
+
+    def test_no_prefetch(self):
+        batch_gets = self.check_prefetch(50 * 60, prefetch_batches=0)
+        self.assertEqual([len(b) for b in batch_gets], [40, 40, 20])
+
+    def test_refresh_expired_base_urls(self):
+        batch_gets = self.check_prefetch(-1)
+        # each prefetched batch was found to be stale and requested again
+        # (the prefetch thread makes the order of the requests vary)
+        self.assertEqual(sorted(len(b) for b in batch_gets), [20, 20, 40, 40, 40, 40])
+
+    def test_pipelined_counts(self):
+        names = ["pipelined_{}.jpg".format(i) for i in range(10)]
+        down = self.make_downloader()
+        down.retry_download = False
+        try:
+            (self.root / "photos").mkdir()
+            for name in names:
+                down.download_file(
+                    self.make_media(name), {"baseUrl": self.url + "/" + name}
+                )
+            with patch.object(down.bad_ids, "report") as report:
+                down.complete_downloads(report=False)
+                report.assert_not_called()
+                # the DB now counts the 10 downloads and 2 from earlier runs
+                down._db.downloaded_count.return_value = 12
+                down._db.get_columns_by_search.return_value = []
+                down.download_photo_media()
+                report.assert_called_once()
+        finally:
+            down.close()
+        self.assertEqual(down.files_downloaded, 10)
+        self.assertEqual(down.files_download_skipped, 2)
+
+    def test_adaptive_threads(self):
+        names = ["adaptive_{}.jpg".format(i) for i in range(30)]
+        down = self.make_downloader(adaptive=True)
+        down.concurrency.window = 5
+        try:
+            (self.root / "photos").mkdir()
+            for name in names:
+                down.download_file(
+                    self.make_media(name), {"baseUrl": self.url + "/" + name}
+                )
+                self.assertLessEqual(len(down.pool_future_to_media), 4)
+            down.complete_downloads()
+        finally:
+            down.close()
+        self.assertEqual(down.files_downloaded, 30)
+        self.assertLessEqual(down.concurrency.limit, 4)
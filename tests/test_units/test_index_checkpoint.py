@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from mock import MagicMock, patch
+from requests.exceptions import HTTPError
+
+from gphotos_sync.Checks import do_check
+from gphotos_sync.GooglePhotosIndex import GooglePhotosIndex
+from gphotos_sync.LocalData import LocalData
+
+# 50 items, newest first, one per day
+LIBRARY = [
+    {
+        "id": "rid{}".format(i),
+        "filename": "img_{}.jpg".format(i),
+        "mimeType": "image/jpeg",
+        "mediaMetadata": {
+            "creationTime": (datetime(2020, 3, 1) - timedelta(days=i)).strftime(
+                "%Y-%m-%dT%H:%M:%SZ"
+            )
+        },
+    }
+    for i in range(50)
+]
+
+
+class IndexTestCase(TestCase):
+    """index a fake library of LIBRARY in a temporary DB"""
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        do_check(self.root)
+        self.db = LocalData(self.root)
+        self.settings = MagicMock(
+            start_date=None,
+            end_date=None,
+            rescan=False,
+            index_workers=1,
+            rolling_rescan=0,
+            include_video=True,
+            favourites_only=False,
+            archived=False,
+            case_insensitive_fs=False,
+            photos_path=Path("photos"),
+            use_flat_path=False,
+            progress=False,
+        )
+        self.searches: list = []
+        self.library = list(LIBRARY)
+
+    def tearDown(self):
+        self.db.con.close()
+        self.tmp.cleanup()
+
+    def search_media(
+        self, page_token=None, start_date=None, end_date=None, fail_at=None, **_
+    ):
+        """pages of 10 items, page_token is the offset of the page"""
+        self.searches.append((page_token, end_date))
+        offset = int(page_token or 0)
+        if offset == fail_at:
+            raise ConnectionError("listing failed")
+        items = [
+            item
+            for item in self.library
+            if (
+                not start_date
+                or item["mediaMetadata"]["creationTime"]
+                >= start_date.strftime("%Y-%m-%d")
+            )
+            and (
+                not end_date
+                or item["mediaMetadata"]["creationTime"]
+                < (end_date + timedelta(days=1)).strftime("%Y-%m-%d")
+            )
+        ]
+        page = {"mediaItems": items[offset : offset + 10]}
+        if offset + 10 < len(items):
+            page["nextPageToken"] = str(offset + 10)
+        return page
+
+    def index(self, search_media) -> GooglePhotosIndex:
+        index = GooglePhotosIndex(MagicMock(), self.root, self.db, self.settings)
+        with patch.object(index, "search_media", search_media):
+            index.index_photos_media()
+        return index
+
+
+class TestIndexCheckpoint(IndexTestCase):
+    def interrupted(self):
+        """index the first 3 pages then fail"""
+        with self.assertRaises(ConnectionError):
+            self.index(lambda **k: self.search_media(fail_at=30, **k))
+        self.assertEqual(self.db.downloaded_count(False), 30)
+        self.assertIsNone(self.db.get_scan_date())
+        self.searches.clear()
+
+    def test_resume(self):
+        self.interrupted()
+        index = self.index(self.search_media)
+        # the listing continued from the saved page
+        self.assertEqual(self.searches, [("30", None), ("40", None)])
+        self.assertEqual(index.files_indexed, 50)
+        self.assertEqual(self.db.downloaded_count(False), 50)
+        self.assertEqual(self.db.get_scan_date(), datetime(2020, 3, 1))
+        self.assertIsNone(self.db.get_index_checkpoint())
+
+    def test_expired_token(self):
+        self.interrupted()
+
+        def search_media(page_token=None, **k):
+            if page_token == "30":
+                raise HTTPError("400 Client Error: Bad Request")
+            return self.search_media(page_token=page_token, **k)
+
+        index = self.index(search_media)
+        # listed the dates that the first 3 pages did not cover, which
+        # includes the day of the last item indexed
+        covered = datetime(2020, 3, 1) - timedelta(days=29)
+        self.assertEqual(
+            self.searches,
+            [(None, covered), ("10", covered), ("20", covered)],
+        )
+        self.assertEqual(index.files_indexed, 50)
+        self.assertEqual(self.db.downloaded_count(False), 50)
+
+    def test_other_search(self):
+        self.interrupted()
+        # the checkpoint is for a different search and is ignored
+        self.settings.include_video = False
+        index = self.index(self.search_media)
+        self.assertEqual(self.searches[0], (None, None))
+        self.assertEqual(index.files_indexed, 20)
@@ -0,0 +1,61 @@
+from datetime import datetime
+
+from gphotos_sync.GooglePhotosIndex import GooglePhotosIndex
+
+from .test_index_checkpoint import LIBRARY, IndexTestCase
+
+
+class TestRollingRescan(IndexTestCase):
+    def test_rolling_slice(self):
+        # 2013 - 2022 in 3 runs: 2019-2022, 2015-2018 and 2013-2014
+        slice_of = GooglePhotosIndex.rolling_slice
+        self.assertEqual(slice_of(2013, 2022, 3, {}), (2019, 2022))
+        # a slice is as stale as its least recently listed year
+        scans = {2021: datetime(2024, 1, 1)}
+        self.assertEqual(slice_of(2013, 2022, 3, scans), (2019, 2022))
+        scans.update({2019: datetime(2024, 1, 2), 2020: datetime(2024, 1, 2)})
+        scans[2022] = datetime(2024, 1, 2)
+        self.assertEqual(slice_of(2013, 2022, 3, scans), (2015, 2018))
+        scans.update({year: datetime(2024, 1, 3) for year in range(2013, 2019)})
+        self.assertEqual(slice_of(2013, 2022, 3, scans), (2019, 2022))
+        # more runs than years
+        self.assertEqual(slice_of(2020, 2021, 5, {2021: datetime.now()}), (2020, 2020))
+
+    def test_rescan_slice(self):
+        self.index(self.search_media)
+        self.assertEqual(self.db.get_slice_scans(), {})
+
+        # an item added with an old date and some deleted items
+        old = dict(LIBRARY[0], id="old", filename="old.jpg")
+        old["mediaMetadata"] = {"creationTime": "2020-01-15T00:00:00Z"}
+        self.library.append(old)
+        del self.library[10:15]
+
+        self.settings.rolling_rescan = 1
+        self.index(self.search_media)
+        self.db.cur.execute("SELECT RemoteId FROM SyncFiles")
+        ids = {row[0] for row in self.db.cur.fetchall()}
+        self.assertIn("old", ids)
+        self.assertEqual(len(ids), 46)
+        self.assertEqual(
+            sorted(self.db.get_slice_scans()),
+            list(range(2020, datetime.now().year + 1)),
+        )
+
+    def test_favourites_not_swept(self):
+        self.index(self.search_media)
+
+        def favourites_only(favourites=False, **k):
+            # only the first item is a favourite
+            page = self.search_media(**k)
+            page["mediaItems"] = [
+                item for item in page["mediaItems"] if item["id"] == "rid0"
+            ]
+            return page
+
+        self.settings.favourites_only = True
+        self.settings.rolling_rescan = 1
+        self.index(favourites_only)
+        # the items that are not favourites remain in the index
+        self.assertEqual(self.db.downloaded_count(False), 50)
+        self.assertEqual(self.db.get_slice_scans(), {})
@@ -0,0 +1,106 @@
+from mock import MagicMock
+
+from gphotos_sync.GooglePhotosIndex import GooglePhotosIndex
+from gphotos_sync.GooglePhotosRow import GooglePhotosRow
+from gphotos_sync.LocalData import LocalData
+
+from .test_index_checkpoint import IndexTestCase
+from .test_local_data import make_row
+
+
+class TestIndexSweep(IndexTestCase):
+    def generations(self) -> dict:
+        self.db.cur.execute("SELECT RemoteId, Generation FROM SyncFiles")
+        return dict(self.db.cur.fetchall())
+
+    def test_deleted_items_removed(self):
+        self.index(self.search_media)
+        self.assertEqual(self.db.get_generation(), 1)
+        self.assertEqual(set(self.generations().values()), {1})
+
+        self.db.put_downloaded("rid1")
+        # an item only in a shared album, and a video that is not listed
+        self.db.put_row(make_row(100))
+        self.db.put_row(
+            GooglePhotosRow.make(**dict(make_row(101).dict, MimeType="video/mp4"))
+        )
+        self.db.put_album_files([("album", "rid5", 0), ("album", "rid100", 1)])
+        self.db.cur.execute(
+            "UPDATE SyncFiles SET Generation = 1 WHERE RemoteId='rid101'"
+        )
+        del self.library[5:10]
+
+        # an incremental listing does not see the whole library
+        self.index(self.search_media)
+        self.assertEqual(self.db.downloaded_count(False), 51)
+
+        self.settings.rescan = True
+        self.settings.include_video = False
+        self.index(self.search_media)
+        self.assertEqual(self.db.get_generation(), 2)
+        generations = self.generations()
+        self.assertNotIn("rid5", generations)
+        self.assertEqual(len(generations), 47)
+        self.assertEqual(generations["rid100"], None)
+        self.assertEqual(generations["rid101"], 1)
+        # the state of the remaining items is kept
+        self.assertEqual(self.db.downloaded_count(), 1)
+        self.db.cur.execute("SELECT DriveRec FROM AlbumFiles")
+        self.assertEqual(self.db.cur.fetchall()[0][0], "rid100")
+
+    def test_upgraded_index(self):
+        self.index(self.search_media)
+        # an index from before schema 6.3 with items in albums, one of them
+        # only in a shared album
+        self.db.put_row(make_row(100))
+        self.db.cur.executemany(
+            "INSERT INTO Albums (RemoteId, IsSharedAlbum) VALUES (?, ?)",
+            [("mine", False), ("shared", True)],
+        )
+        self.db.put_album_files([("mine", "rid5", 0), ("shared", "rid100", 0)])
+        self.db.cur.execute("UPDATE SyncFiles SET Generation = NULL")
+        self.db.cur.execute("UPDATE Globals SET Version = 6.2, Generation = NULL")
+        self.db.store()
+        self.db.con.close()
+        self.db = LocalData(self.root)
+        del self.library[5]
+
+        self.settings.rescan = True
+        self.index(self.search_media)
+        generations = self.generations()
+        # the deleted item in an album of the user's own is found
+        self.assertNotIn("rid5", generations)
+        self.assertEqual(generations["rid100"], 0)
+        self.assertEqual(len(generations), 50)
+
+    def test_resumed_generation(self):
+        with self.assertRaises(ConnectionError):
+            self.index(lambda **k: self.search_media(fail_at=30, **k))
+        # the resumed listing stays in the generation it started
+        self.index(self.search_media)
+        self.assertEqual(self.db.get_generation(), 1)
+        self.assertEqual(set(self.generations().values()), {1})
+        self.assertEqual(len(self.generations()), 50)
+
+    def test_check_for_removed(self):
+        self.db.put_rows([make_row(i) for i in range(3)])
+        self.db.put_row(make_row(3, path="photos/2021/02"))
+        folder = self.root / "photos" / "2020" / "01"
+        other = self.root / "photos" / "2021" / "02"
+        for pth in (folder, other):
+            pth.mkdir(parents=True)
+        names = ["img_0.jpg", "img_1.jpg", "img_2.jpg", "img_3.jpg", ".part"]
+        for name in names:
+            (folder / name).touch()
+        (other / "img_3.jpg").touch()
+        (other / "gone.jpg").touch()
+
+        index = GooglePhotosIndex(MagicMock(), self.root, self.db, self.settings)
+        removed = [folder / "img_3.jpg", other / "gone.jpg"]
+        self.assertEqual(sorted(index.check_for_removed(dry_run=True)), removed)
+        self.assertTrue(all(pth.exists() for pth in removed))
+
+        self.assertEqual(sorted(index.check_for_removed()), removed)
+        self.assertFalse(any(pth.exists() for pth in removed))
+        self.assertTrue((folder / ".part").exists())
+        self.assertTrue((other / "img_3.jpg").exists())
@@ -0,0 +1,467 @@
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+import gphotos_sync.Migrations as Migrations
+from gphotos_sync.Checks import do_check
+from gphotos_sync.GoogleAlbumsRow import GoogleAlbumsRow
+from gphotos_sync.GooglePhotosRow import GooglePhotosRow
+from gphotos_sync.LocalData import IndexCheckpoint, LocalData
+from gphotos_sync.Migrations import Migration
+
+from .test_local_match import make_library
+
+
+def make_row(i: int, path: str = "photos/2020/01", name: str = "") -> GooglePhotosRow:
+    name = name or "img_{}.jpg".format(i)
+    return GooglePhotosRow.make(
+        RemoteId="rid{}".format(i),
+        Url="url",
+        Uid=None,
+        Path=path,
+        FileName=name,
+        OrigFileName=name,
+        DuplicateNo=0,
+        FileSize=0,
+        MimeType="image/jpeg",
+        Description="",
+        ModifyDate=datetime(2020, 1, 1),
+        CreateDate=datetime(2020, 1, 1, 12, 0, i % 60),
+        SyncDate=datetime(2020, 1, 2),
+        Downloaded=0,
+        Location="",
+    )
+
+
+class TestLocalData(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        do_check(self.root)
+        self.db = LocalData(self.root)
+
+    def tearDown(self):
+        self.db.con.close()
+        self.tmp.cleanup()
+
+    def test_put_downloaded_batch(self):
+        for i in range(10):
+            self.db.put_row(make_row(i))
+        self.db.put_downloaded_batch(["rid{}".format(i) for i in range(4)])
+        self.assertEqual(self.db.downloaded_count(), 4)
+        self.assertEqual(self.db.downloaded_count(False), 6)
+
+    def test_put_rows(self):
+        self.db.put_rows([make_row(i) for i in range(10)])
+        # re-inserting existing rows is a no-op
+        self.db.put_rows([make_row(i) for i in range(5, 15)])
+        self.assertEqual(self.db.downloaded_count(False), 15)
+
+        rows = [make_row(i) for i in range(3)]
+        for row in rows:
+            row.Description = "updated"
+        self.db.put_rows(rows, update=True)
+        self.db.cur.execute(
+            "SELECT COUNT() FROM SyncFiles WHERE Description = ?", ("updated",)
+        )
+        self.assertEqual(self.db.cur.fetchone()[0], 3)
+
+    def test_duplicate_no_pending(self):
+        self.db.put_row(make_row(0, name="a.jpg"))
+        pending = {}
+        num, row = self.db.file_duplicate_no("a.jpg", "photos/2020/01", "rid0", pending)
+        self.assertEqual(num, 0)
+        self.assertIsNotNone(row)
+        nums = [
+            self.db.file_duplicate_no(
+                "a.jpg", "photos/2020/01", "new" + str(i), pending
+            )[0]
+            for i in range(3)
+        ]
+        self.assertEqual(nums, [1, 2, 3])
+
+    def pragma(self, db: LocalData, name: str):
+        db.cur.execute("PRAGMA {};".format(name))
+        return db.cur.fetchone()[0]
+
+    def test_fast_profile(self):
+        self.db.put_rows([make_row(i) for i in range(10)])
+        self.db.con.close()
+
+        db = LocalData(self.root, profile="fast")
+        try:
+            self.assertEqual(self.pragma(db, "journal_mode"), "wal")
+            self.assertEqual(self.pragma(db, "synchronous"), 1)  # NORMAL
+            self.assertEqual(self.pragma(db, "temp_store"), 2)  # MEMORY
+            # a second connection can read while the first has uncommitted writes
+            db.put_row(make_row(10))
+            with LocalData(self.root, profile="fast") as reader:
+                self.assertEqual(reader.downloaded_count(False), 10)
+            db.store()
+            self.assertEqual(db.downloaded_count(False), 11)
+        finally:
+            db.con.close()
+        self.db = LocalData(self.root)
+
+    def test_safe_profile_after_fast(self):
+        self.db.con.close()
+        LocalData(self.root, profile="fast").con.close()
+        # the journal mode is kept in the DB file, safe switches it back
+        self.db = LocalData(self.root)
+        self.assertEqual(self.pragma(self.db, "journal_mode"), "delete")
+        self.assertEqual(self.pragma(self.db, "synchronous"), 2)  # FULL
+        self.assertFalse((self.root / "gphotos.sqlite-wal").exists())
+
+    def test_writer_readers_keep_wal(self):
+        self.db.start_writer()
+        try:
+            # a second thread opens a reader connection
+            thread = Thread(target=lambda: self.db.con)
+            thread.start()
+            thread.join()
+            self.assertEqual(self.pragma(self.db, "journal_mode"), "wal")
+        finally:
+            self.db.stop_writer()
+
+    @skipUnless(os.environ.get("GPHOTOS_BENCHMARK"), "set GPHOTOS_BENCHMARK=1")
+    def test_profile_benchmark(self):
+        """the index and match workloads with each profile"""
+        times = {}
+        for profile in ("safe", "fast"):
+            self.db.con.close()
+            self.db = LocalData(self.root, flush_index=True, profile=profile)
+            start = time.perf_counter()
+            for page in range(300):
+                rows = [make_row(page * 100 + i) for i in range(100)]
+                for row in rows:
+                    self.db.file_duplicate_no(row.FileName, row.Path, row.RemoteId)
+                self.db.put_rows(rows)
+                self.db.store()
+            index_time = time.perf_counter() - start
+
+            self.db.cur.execute("DELETE FROM SyncFiles")
+            make_library(self.db, 6000, 4000, 99)
+            self.db.store()
+            start = time.perf_counter()
+            self.db.find_local_matches()
+            self.db.store()
+            times[profile] = (index_time, time.perf_counter() - start)
+        self.assertLess(times["fast"][0], times["safe"][0], times)
+        self.assertLess(times["fast"][1], times["safe"][1] * 1.2, times)
+
+    def test_profile_after_schema_flush(self):
+        self.db.cur.execute("UPDATE Globals SET Version = 1.0 WHERE Id IS 1")
+        self.db.store()
+        self.db.con.close()
+
+        self.db = LocalData(self.root, profile="fast")
+        self.assertEqual(self.pragma(self.db, "journal_mode"), "wal")
+        self.assertEqual(self.db.downloaded_count(False), 0)
+
+    def test_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            LocalData(self.root, profile="turbo")
+
+    def test_key_index(self):
+        for i, name in enumerate(["a.jpg", "a.jpg", "c.jpg"]):
+            row = make_row(i, name=name)
+            row.DuplicateNo = i if name == "a.jpg" else 0
+            self.db.put_row(row)
+
+        expected = [
+            self.db.file_duplicate_no(n, "photos/2020/01", "rid{}".format(i))
+            for i, n in enumerate(["a.jpg", "a.jpg", "c.jpg", "x.jpg", "a.jpg"])
+        ]
+        self.db.load_key_index()
+        indexed = [
+            self.db.file_duplicate_no(n, "photos/2020/01", "rid{}".format(i))
+            for i, n in enumerate(["a.jpg", "a.jpg", "c.jpg", "x.jpg", "a.jpg"])
+        ]
+        self.assertEqual(
+            [(num, row and row.id) for num, row in expected],
+            [(num, row and row.id) for num, row in indexed],
+        )
+        self.assertEqual(indexed[3], (0, None))
+        self.assertEqual(indexed[4], (2, None))
+        # a row written after loading is seen, and numbers are not reused
+        self.db.put_rows([make_row(20, name="x.jpg")])
+        self.assertEqual(
+            self.db.file_duplicate_no("x.jpg", "photos/2020/01", "rid20")[1].id,
+            "rid20",
+        )
+        self.assertEqual(
+            self.db.file_duplicate_no("a.jpg", "photos/2020/01", "rid21")[0], 3
+        )
+
+    def test_case_insensitive_lookup_uses_index(self):
+        self.db.cur.execute(
+            "EXPLAIN QUERY PLAN SELECT MAX(DuplicateNo) FROM SyncFiles "
+            "WHERE Path = ? AND lower(OrigFileName) = ?;",
+            ("photos/2020/01", "a.jpg"),
+        )
+        plan = " ".join(row["detail"] for row in self.db.cur.fetchall())
+        self.assertIn("USING INDEX SyncLowerNameIdx", plan)
+
+        self.db.case_insensitive = True
+        self.db.put_row(make_row(0, name="IMG.JPG"))
+        num, _ = self.db.file_duplicate_no("img.jpg", "photos/2020/01", "rid1")
+        self.assertEqual(num, 1)
+
+    def test_upgrade_in_place(self):
+        self.db.put_rows([make_row(i) for i in range(5)])
+        self.db.cur.execute("DROP INDEX SyncLowerNameIdx")
+        self.db.cur.execute("UPDATE Globals SET Version = 5.7 WHERE Id IS 1")
+        self.db.store()
+        self.db.con.close()
+
+        self.db = LocalData(self.root)
+        self.assertEqual(self.db.downloaded_count(False), 5)
+        self.db.cur.execute("SELECT Version FROM Globals WHERE Id IS 1")
+        self.assertEqual(float(self.db.cur.fetchone()[0]), LocalData.VERSION)
+        self.db.cur.execute(
+            "SELECT name FROM sqlite_master WHERE name = 'SyncLowerNameIdx'"
+        )
+        self.assertIsNotNone(self.db.cur.fetchone())
+
+    def test_get_columns_by_search(self):
+        self.db.put_rows([make_row(i) for i in range(10)])
+        self.db.put_downloaded("rid3")
+        search = {"start_date": datetime(2020, 1, 1), "skip_downloaded": True}
+
+        rows = list(self.db.get_rows_by_search(GooglePhotosRow, **search))
+        columns = list(
+            self.db.get_columns_by_search(
+                GooglePhotosRow, GooglePhotosRow.media_columns, **search
+            )
+        )
+        self.assertEqual([r.id for r in rows], [c.RemoteId for c in columns])
+        self.assertEqual(len(columns), 9)
+        # values are returned as stored
+        self.assertIsInstance(columns[0].CreateDate, int)
+        self.assertFalse(hasattr(columns[0], "__dict__"))
+
+        media = GooglePhotosRow.columns_to_media(columns[0])
+        self.assertFalse(hasattr(media, "__dict__"))
+        self.assertEqual(media.create_date, rows[0].create_date)
+        self.assertEqual(media.relative_path, rows[0].relative_path)
+
+        with self.assertRaises(ValueError):
+            list(self.db.get_columns_by_search(GooglePhotosRow, ["NotAColumn"]))
+
+    def test_dates_stored_as_integers(self):
+        row = make_row(1)
+        self.db.put_row(row)
+        self.db.set_scan_date(datetime(2021, 5, 6, 7, 8, 9))
+        self.db.cur.execute(
+            "SELECT typeof(CreateDate), typeof(SyncDate) FROM SyncFiles"
+        )
+        self.assertEqual(tuple(self.db.cur.fetchone()), ("integer", "integer"))
+        self.assertEqual(self.db.get_scan_date(), datetime(2021, 5, 6, 7, 8, 9))
+        media = next(self.db.get_rows_by_search(GooglePhotosRow))
+        self.assertEqual(media.create_date, row.CreateDate)
+
+        # date range filters compare integers
+        search = {
+            "start_date": datetime(2020, 1, 1, 12),
+            "end_date": datetime(2021, 1, 1),
+        }
+        self.assertEqual(
+            len(list(self.db.get_rows_by_search(GooglePhotosRow, **search))), 1
+        )
+        search["start_date"] = datetime(2020, 1, 1, 12, 0, 2)
+        self.assertEqual(
+            len(list(self.db.get_rows_by_search(GooglePhotosRow, **search))), 0
+        )
+
+    def test_index_checkpoint(self):
+        self.assertIsNone(self.db.get_index_checkpoint())
+        checkpoint = IndexCheckpoint(
+            "{}", None, "token", datetime(2020, 1, 2), 3, 250, 50, datetime(2021, 1, 1)
+        )
+        self.db.put_index_checkpoint(checkpoint)
+        self.db.con.close()
+
+        # committed with each page
+        self.db = LocalData(self.root)
+        self.assertEqual(self.db.get_index_checkpoint(), checkpoint)
+        self.db.clear_index_checkpoint()
+        self.assertIsNone(self.db.get_index_checkpoint())
+
+    def test_upgrade_date_strings(self):
+        self.db.put_rows([make_row(i) for i in range(3)])
+        self.db.cur.execute(
+            "UPDATE SyncFiles SET CreateDate = ?, ModifyDate = ?, SyncDate = NULL "
+            "WHERE RemoteId = 'rid0'",
+            ("2020-01-01 12:00:00", "2019:02:03 04:05:06.123456"),
+        )
+        self.db.cur.execute(
+            "UPDATE SyncFiles SET CreateDate = ?, ModifyDate = ? "
+            "WHERE RemoteId = 'rid1'",
+            ("1899-12-31", "not a date"),
+        )
+        self.db.cur.execute(
+            "UPDATE Globals SET Version = 5.8, LastIndex = '2021-05-06 07:08:09'"
+        )
+        self.db.store()
+        self.db.con.close()
+
+        self.db = LocalData(self.root)
+        rows = {m.id: m for m in self.db.get_rows_by_search(GooglePhotosRow)}
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows["rid0"].create_date, datetime(2020, 1, 1, 12))
+        self.assertEqual(rows["rid0"].modify_date, datetime(2019, 2, 3, 4, 5, 6))
+        self.assertEqual(rows["rid1"].create_date, datetime(1899, 12, 31))
+        self.assertIsNone(rows["rid1"].modify_date)
+        self.assertEqual(self.db.get_scan_date(), datetime(2021, 5, 6, 7, 8, 9))
+        self.db.cur.execute(
+            "SELECT COUNT() FROM SyncFiles WHERE typeof(CreateDate) != 'integer'"
+        )
+        self.assertEqual(self.db.cur.fetchone()[0], 0)
+
+    def test_migrations_match_version(self):
+        versions = [m.version for m in Migrations.MIGRATIONS]
+        self.assertEqual(versions, sorted(versions))
+        self.assertGreater(versions[0], Migrations.OLDEST_VERSION)
+        self.assertEqual(versions[-1], LocalData.VERSION)
+
+    def set_version(self, version: float):
+        self.db.cur.execute("UPDATE Globals SET Version = ? WHERE Id IS 1", (version,))
+        self.db.store()
+        self.db.con.close()
+
+    def test_migration_preserves_state(self):
+        self.db.put_rows([make_row(i) for i in range(5)])
+        self.db.put_downloaded("rid1")
+        self.db.put_location("rid2", "somewhere")
+        self.db.put_album_files([("album", "rid3", 0)])
+        self.set_version(Migrations.OLDEST_VERSION)
+
+        self.db = LocalData(self.root)
+        self.assertEqual(self.db.downloaded_count(), 1)
+        self.db.cur.execute("SELECT Location FROM SyncFiles WHERE RemoteId='rid2'")
+        self.assertEqual(self.db.cur.fetchone()[0], "somewhere")
+        self.db.cur.execute("SELECT DriveRec FROM AlbumFiles")
+        self.assertEqual(self.db.cur.fetchone()[0], "rid3")
+
+    def test_failed_migration_rolls_back(self):
+        self.db.put_rows([make_row(i) for i in range(5)])
+        self.set_version(5.8)
+
+        def fail(cur):
+            raise RuntimeError("upgrade failed")
+
+        broken = Migrations.MIGRATIONS + [
+            Migration(99.0, "test", ["DELETE FROM SyncFiles", fail]),
+        ]
+        with patch.object(Migrations, "MIGRATIONS", broken), patch.object(
+            LocalData, "VERSION", 99.0
+        ):
+            with self.assertRaises(RuntimeError):
+                LocalData(self.root)
+        # the completed migrations were kept, the failed one undone
+        self.db = LocalData(self.root)
+        self.db.cur.execute("SELECT Version FROM Globals WHERE Id IS 1")
+        self.assertEqual(float(self.db.cur.fetchone()[0]), LocalData.VERSION)
+        self.assertEqual(self.db.downloaded_count(False), 5)
+
+    def plan(self, query: str, params) -> str:
+        self.db.cur.execute("EXPLAIN QUERY PLAN " + query, params)
+        return " ".join(row["detail"] for row in self.db.cur.fetchall())
+
+    def test_search_query_uses_indexes(self):
+        query, params = LocalData.search_query(
+            GooglePhotosRow, "RemoteId", skip_downloaded=True
+        )
+        self.assertNotIn("LIKE", query)
+        self.assertIn("SyncPendingIdx", self.plan(query, params + [0, 10]))
+
+        query, params = LocalData.search_query(
+            GooglePhotosRow, "RemoteId", uid="ISNULL"
+        )
+        self.assertIn("UidIdx", self.plan(query, params + [0, 10]))
+
+        query, params = LocalData.search_query(
+            GooglePhotosRow, "RemoteId", file_name="img_1.jpg", path="photos/%"
+        )
+        self.assertIn("FileName = ?", query)
+        self.assertIn("Path LIKE ?", query)
+
+    def test_search_pages(self):
+        self.db.put_rows([make_row(i) for i in range(25)])
+        self.db.put_downloaded("rid7")
+        with patch.object(LocalData, "BLOCK_SIZE", 4):
+            found = []
+            for media in self.db.get_rows_by_search(
+                GooglePhotosRow, skip_downloaded=True
+            ):
+                # updating rows already returned does not disturb the search
+                self.db.put_downloaded(media.id)
+                found.append(media.id)
+        self.assertEqual(len(found), 24)
+        self.assertNotIn("rid7", found)
+        self.assertEqual(self.db.downloaded_count(False), 0)
+
+        found = [
+            m.id
+            for m in self.db.get_rows_by_search(GooglePhotosRow, file_name="img_1%")
+        ]
+        self.assertEqual(
+            sorted(found), ["rid1"] + ["rid1{}".format(i) for i in range(10)]
+        )
+
+    def make_albums(self):
+        self.db.put_rows([make_row(i) for i in range(30)])
+        for a in range(3):
+            self.db.put_row(
+                GoogleAlbumsRow.from_parm(
+                    "album{}".format(a),
+                    "Album {}".format(a),
+                    10,
+                    datetime(2020, 1, 1),
+                    datetime(2020, 2, 1),
+                    False,
+                )
+            )
+        self.db.put_album_files(
+            ("album{}".format(i % 3), "rid{}".format(i), i // 3) for i in range(30)
+        )
+
+    def test_get_album_files(self):
+        self.make_albums()
+        with patch.object(LocalData, "BLOCK_SIZE", 2):
+            files = []
+            for row in self.db.get_album_files():
+                # as create_album_content_links does during iteration
+                self.db.put_album_downloaded(row[5])
+                files.append(row)
+        self.assertEqual(len(files), 30)
+        self.assertEqual(
+            files[0][:3] + files[0][5:6],
+            ("photos/2020/01", "img_0.jpg", "Album 0", "album0"),
+        )
+        self.assertEqual(
+            [f[1] for f in files[:3]], ["img_0.jpg", "img_3.jpg", "img_6.jpg"]
+        )
+        self.assertEqual([f[5] for f in files[::10]], ["album0", "album1", "album2"])
+        # albums already linked are skipped unless downloading again
+        self.assertEqual(list(self.db.get_album_files()), [])
+        inverted = list(
+            self.db.get_album_files("album1", album_invert=True, download_again=True)
+        )
+        self.assertEqual([f[1] for f in inverted[:2]], ["img_28.jpg", "img_25.jpg"])
+
+    def test_album_files_use_covering_index(self):
+        self.make_albums()
+        plan = self.plan(
+            "SELECT SyncFiles.Path FROM AlbumFiles INNER JOIN SyncFiles "
+            "ON AlbumFiles.DriveRec=SyncFiles.RemoteId WHERE AlbumFiles.AlbumRec = ? "
+            "ORDER BY AlbumFiles.Position, AlbumFiles.DriveRec;",
+            ("album1",),
+        )
+        self.assertIn("USING COVERING INDEX AlbumFilesPositionIdx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
@@ -0,0 +1,193 @@
+import os
+import random
+import time
+from collections import Counter
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipUnless
+
+from gphotos_sync.Checks import do_check
+from gphotos_sync.LocalData import LocalData
+
+# the original correlated subquery local match, the reference for
+# LocalData.find_local_matches
+# noinspection SqlWithoutWhere
+MATCH_SQL = [
+    """
+-- stage 0 - remove previous matches
+UPDATE LocalFiles
+set RemoteId = NULL  ;
+""",
+    """
+-- stage 1 - look for unique matches
+UPDATE LocalFiles
+set RemoteId = (SELECT RemoteId
+                FROM SyncFiles
+                WHERE LocalFiles.OriginalFileName == SyncFiles.OrigFileName
+                  AND (LocalFiles.Uid == SyncFiles.Uid AND
+                       LocalFiles.CreateDate = SyncFiles.CreateDate)
+                  -- 32 character ids are legitimate and unique
+                  OR (LocalFiles.Uid == SyncFiles.Uid AND
+                  length(LocalFiles.Uid) == 32)
+)
+WHERE LocalFiles.Uid notnull and LocalFiles.Uid != 'not_supported'
+;
+""",
+    """
+-- stage 2 - mop up entries that have no UID (this is a small enough
+-- population that filename + CreateDate is probably unique)
+with pre_match(RemoteId) as
+   (SELECT RemoteId from LocalFiles where RemoteId notnull)
+UPDATE LocalFiles
+set RemoteId = (SELECT RemoteId
+            FROM SyncFiles
+            WHERE LocalFiles.OriginalFileName == SyncFiles.OrigFileName
+              AND LocalFiles.CreateDate = SyncFiles.CreateDate
+            AND SyncFiles.RemoteId NOT IN (select RemoteId from pre_match)
+)
+WHERE LocalFiles.RemoteId isnull
+;
+""",
+    """
+-- stage 3 FINAL - mop up on filename only
+with pre_match(RemoteId) as
+   (SELECT RemoteId from LocalFiles where RemoteId notnull)
+UPDATE LocalFiles
+set RemoteId = (SELECT RemoteId
+            FROM SyncFiles
+            WHERE LocalFiles.OriginalFileName == SyncFiles.OrigFileName
+            AND SyncFiles.RemoteId NOT IN (select RemoteId from pre_match)
+)
+WHERE LocalFiles.RemoteId isnull
+;
+""",
+]
+
+
+def find_local_matches_sql(db: LocalData):
+    for query in MATCH_SQL:
+        db.cur.execute(query)
+
+
+def make_library(db: LocalData, remote_count: int, local_count: int, seed: int = 1):
+    """A synthetic library that exercises every stage of the local match:
+    local files with and without Uids, 32 character Uids, repeated names
+    and create dates, and local files with no remote counterpart"""
+    rnd = random.Random(seed)
+    names = ["IMG_{:04d}.jpg".format(i) for i in range(remote_count // 3 + 1)]
+    dates = ["2020-01-{:02d} 12:00:00".format(d) for d in range(1, 29)]
+    remote = []
+    for i in range(remote_count):
+        uid = rnd.choice(
+            [None, "uid{}".format(i), "{:032x}".format(i), "uid{}".format(i % 50)]
+        )
+        remote.append(
+            (
+                "rid{}".format(i),
+                uid,
+                rnd.choice(names),
+                rnd.choice(dates),
+                rnd.randint(0, 2),
+                rnd.choice([None, "", "description"]),
+            )
+        )
+    db.cur.executemany(
+        "INSERT INTO SyncFiles (RemoteId, Uid, OrigFileName, CreateDate, "
+        "DuplicateNo, Description, Path, FileName) "
+        "VALUES (?, ?, ?, ?, ?, ?, 'photos', ?)",
+        [r + (r[0] + ".jpg",) for r in remote],
+    )
+    local = []
+    for i in range(local_count):
+        remote_id, uid, name, date, _, _ = rnd.choice(remote)
+        local.append(
+            (
+                "photos/{}".format(i),
+                rnd.choice([uid, uid, None, "not_supported", "other"]),
+                rnd.choice([name, name, name, rnd.choice(names)]),
+                rnd.choice([date, date, rnd.choice(dates)]),
+            )
+        )
+    db.cur.executemany(
+        "INSERT INTO LocalFiles (Path, Uid, OriginalFileName, CreateDate, "
+        "FileName) VALUES (?, ?, ?, ?, ?)",
+        [r + (r[2],) for r in local],
+    )
+
+
+class TestLocalMatch(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        do_check(self.root)
+        self.db = LocalData(self.root)
+
+    def tearDown(self):
+        self.db.con.close()
+        self.tmp.cleanup()
+
+    def matches(self):
+        self.db.cur.execute("SELECT Id, RemoteId FROM LocalFiles ORDER BY Id")
+        return [tuple(row) for row in self.db.cur.fetchall()]
+
+    def compare(self, remote_count: int, local_count: int, seed: int):
+        make_library(self.db, remote_count, local_count, seed)
+
+        start = time.perf_counter()
+        find_local_matches_sql(self.db)
+        sql_time = time.perf_counter() - start
+        expected = self.matches()
+
+        start = time.perf_counter()
+        self.db.find_local_matches()
+        new_time = time.perf_counter() - start
+        self.assertEqual(self.matches(), expected)
+        # all stages must have found something or the test proves little
+        self.assertGreater(len([m for m in expected if m[1]]), local_count // 2)
+        return sql_time, new_time
+
+    def test_same_as_sql(self):
+        for seed in range(5):
+            self.compare(300, 200, seed)
+            self.db.cur.execute("DELETE FROM SyncFiles")
+            self.db.local_erase()
+
+    @skipUnless(os.environ.get("GPHOTOS_BENCHMARK"), "set GPHOTOS_BENCHMARK=1")
+    def test_benchmark(self):
+        sql_time, new_time = self.compare(6000, 4000, 99)
+        self.assertLess(new_time, sql_time)
+
+    def test_reports(self):
+        make_library(self.db, 300, 200, 7)
+        self.db.find_local_matches()
+        self.db.cur.execute("SELECT * FROM LocalFiles ORDER BY Id")
+        local = [dict(row) for row in self.db.cur.fetchall()]
+        self.db.cur.execute("SELECT * FROM SyncFiles ORDER BY Id")
+        remote = [dict(row) for row in self.db.cur.fetchall()]
+
+        matched = Counter(row["RemoteId"] for row in local if row["RemoteId"])
+        missing = [
+            Path(row["Path"]) / row["FileName"] for row in local if not row["RemoteId"]
+        ]
+        extra = [
+            Path(row["Path"]) / row["FileName"]
+            for row in remote
+            if row["RemoteId"] not in matched
+        ]
+        duplicates = sorted(
+            (row["RemoteId"], row["Id"], Path(row["Path"]) / row["FileName"])
+            for row in local
+            if matched.get(row["RemoteId"], 0) > 1
+        )
+        self.assertTrue(missing and extra and duplicates)
+
+        # small pages so that the paging is exercised
+        self.db.BLOCK_SIZE = 7
+        for _ in range(2):
+            # the reports do not modify LocalFiles so can be repeated
+            self.assertEqual(list(self.db.get_missing_paths()), missing)
+            self.assertEqual(list(self.db.get_extra_paths()), extra)
+            self.assertEqual(
+                list(self.db.get_duplicates()),
+                [(remote_id, path) for remote_id, _, path in duplicates],
+            )
@@ -0,0 +1,186 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+from random import random
+from tempfile import TemporaryDirectory
+from threading import Lock
+from time import sleep
+from unittest import TestCase
+
+from mock import MagicMock, patch
+
+from gphotos_sync.Checks import do_check
+from gphotos_sync.GooglePhotosIndex import GooglePhotosIndex
+from gphotos_sync.LocalData import LocalData
+
+
+def pages(count):
+    for i in range(count):
+        page = {"mediaItems": [{"id": str(i)}]}
+        if i < count - 1:
+            page["nextPageToken"] = str(i + 1)
+        yield page
+
+
+class TestPipeline(TestCase):
+    def test_prefetch_pages(self):
+        index = GooglePhotosIndex(MagicMock(), MagicMock(), None, MagicMock())
+        listing = pages(10)
+        with patch.object(index, "search_media", lambda **_: next(listing)):
+            result = list(index.prefetch_pages(None, None))
+        self.assertEqual([p["mediaItems"][0]["id"] for p in result], list("0123456789"))
+
+    def test_prefetch_pages_error(self):
+        index = GooglePhotosIndex(MagicMock(), MagicMock(), None, MagicMock())
+
+        def search_media(**_):
+            raise ConnectionError("listing failed")
+
+        with patch.object(index, "search_media", search_media):
+            with self.assertRaises(ConnectionError):
+                list(index.prefetch_pages(None, None))
+
+    def test_index_photos_media_on_page(self):
+        def item(rid):
+            return {
+                "id": rid,
+                "filename": rid + ".jpg",
+                "mimeType": "image/jpeg",
+                "mediaMetadata": {"creationTime": "2020-01-01T00:00:00Z"},
+            }
+
+        listing = iter(
+            [
+                {"mediaItems": [item("a"), item("b")], "nextPageToken": "1"},
+                # "b" is listed again and is not passed on a second time
+                {"mediaItems": [item("b"), item("c")]},
+            ]
+        )
+        settings = MagicMock(
+            start_date=None,
+            end_date=None,
+            rescan=True,
+            index_workers=1,
+            rolling_rescan=0,
+            include_video=True,
+            favourites_only=False,
+            archived=False,
+            case_insensitive_fs=False,
+            photos_path=Path("photos"),
+            use_flat_path=False,
+            progress=False,
+        )
+        with TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            do_check(root)
+            db = LocalData(root)
+            try:
+                index = GooglePhotosIndex(MagicMock(), root, db, settings)
+                downloads = []
+                with patch.object(index, "search_media", lambda **_: next(listing)):
+                    index.index_photos_media(
+                        on_page=lambda items: downloads.append(
+                            [media.id for media in items]
+                        )
+                    )
+                self.assertEqual(downloads, [["a", "b"], ["c"]])
+                self.assertEqual(db.downloaded_count(False), 3)
+            finally:
+                db.con.close()
+
+    def sharded_index(self, workers, end_date=datetime(2020, 12, 31)):
+        settings = MagicMock()
+        settings.index_workers = workers
+        settings.end_date = end_date
+        return GooglePhotosIndex(MagicMock(), MagicMock(), None, settings)
+
+    @staticmethod
+    def fake_search(library, searches):
+        """a search_media for a list of (id, date), newest first as the API
+        returns them, which records the windows searched"""
+        lock = Lock()
+        library = sorted(library, key=lambda item: item[1], reverse=True)
+
+        def search_media(page_token=None, start_date=None, end_date=None, **_):
+            with lock:
+                searches.append((start_date, end_date))
+            # the workers finish in no particular order
+            sleep(random() / 100)
+            items = [
+                {"id": rid}
+                for rid, date in library
+                if start_date <= date < end_date + timedelta(days=1)
+            ]
+            offset = int(page_token or 0)
+            page = {"mediaItems": items[offset : offset + 10]}
+            if offset + 10 < len(items):
+                page["nextPageToken"] = str(offset + 10)
+            return page
+
+        return search_media
+
+    def test_split_window(self):
+        windows = GooglePhotosIndex.split_window(
+            datetime(2020, 1, 1, 12), datetime(2020, 1, 10, 8), 3
+        )
+        self.assertEqual(
+            windows,
+            [
+                (datetime(2020, 1, 7), datetime(2020, 1, 10)),
+                (datetime(2020, 1, 4), datetime(2020, 1, 6)),
+                (datetime(2020, 1, 1), datetime(2020, 1, 3)),
+            ],
+        )
+        one_day = GooglePhotosIndex.split_window(
+            datetime(2020, 1, 1), datetime(2020, 1, 1), 2
+        )
+        self.assertEqual(one_day, [(datetime(2020, 1, 1), datetime(2020, 1, 1))])
+
+    def test_sharded_pages(self):
+        # a sparse decade followed by a dense year
+        library = [
+            (str(i), datetime(2010, 1, 1) + timedelta(days=365 * i)) for i in range(10)
+        ] + [
+            ("d{}".format(i), datetime(2020, 1, 1) + timedelta(hours=20 * i))
+            for i in range(400)
+        ]
+        searches: list = []
+        index = self.sharded_index(4)
+        search_media = self.fake_search(library, searches)
+        with patch.object(index, "search_media", search_media):
+            result = list(index.sharded_pages(datetime(2010, 1, 1), index.end_date))
+        ids = [item["id"] for page in result for item in page["mediaItems"]]
+        # the items of a serial search, in the same order
+        serial = sorted(library, key=lambda item: item[1], reverse=True)
+        self.assertEqual(ids, [rid for rid, _ in serial])
+        # the dense year was split between the workers
+        self.assertGreater(len(searches), 4 + len(library) // 10)
+        self.assertTrue(
+            any(end - start < timedelta(days=180) for start, end in searches)
+        )
+
+    def test_sharded_pages_unbounded(self):
+        # no start or end date searches the same dates as search_media
+        library = [
+            ("old", datetime(1901, 6, 1)),
+            ("now", datetime(2020, 6, 1)),
+            ("future", datetime(2999, 6, 1)),
+        ]
+        searches: list = []
+        index = self.sharded_index(3, end_date=None)
+        search_media = self.fake_search(library, searches)
+        with patch.object(index, "search_media", search_media):
+            result = list(index.sharded_pages(None, None))
+        ids = [item["id"] for page in result for item in page["mediaItems"]]
+        self.assertEqual(ids, ["future", "now", "old"])
+        self.assertEqual(min(start for start, _ in searches), datetime(1900, 1, 1))
+        self.assertEqual(max(end for _, end in searches), datetime(3000, 1, 1))
+
+    def test_sharded_pages_error(self):
+        index = self.sharded_index(3)
+
+        def search_media(**_):
+            raise ConnectionError("listing failed")
+
+        with patch.object(index, "search_media", search_media):
+            with self.assertRaises(ConnectionError):
+                list(index.sharded_pages(None, None))
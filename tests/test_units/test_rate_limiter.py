@@ -0,0 +1,63 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from gphotos_sync.RateLimiter import QuotaExceeded, RateLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestRateLimiter(TestCase):
+    def test_pacing(self):
+        clock = Clock()
+        bucket = TokenBucket("api", rate=2, clock=clock)
+        # one second of burst then one token every 0.5 seconds
+        self.assertEqual([bucket.reserve() for _ in range(2)], [0, 0])
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+        self.assertAlmostEqual(bucket.reserve(), 1.0)
+        clock.now = 10
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_unlimited(self):
+        bucket = TokenBucket("media")
+        self.assertEqual(sum(bucket.reserve() for _ in range(1000)), 0)
+        self.assertEqual(bucket.used, 1000)
+
+    def test_throttle_and_recover(self):
+        clock = Clock()
+        bucket = TokenBucket("api", rate=10, clock=clock)
+        bucket.throttled()
+        self.assertAlmostEqual(bucket.rate, 7.5)
+        # no recovery within a minute of being throttled
+        clock.now = 30
+        bucket.reserve()
+        self.assertAlmostEqual(bucket.rate, 7.5)
+        for minute in range(2, 20):
+            clock.now = minute * 61
+            bucket.reserve()
+        self.assertEqual(bucket.rate, 10)
+
+    def test_daily_quota_persists(self):
+        with TemporaryDirectory() as tmp:
+            state = Path(tmp) / "gphotos.quota.yaml"
+            limiter = RateLimiter(state, api_daily=5, api_rate=10)
+            for _ in range(3):
+                limiter.api.acquire()
+            limiter.api.throttled()
+            limiter.store()
+
+            limiter = RateLimiter(state, api_daily=5, api_rate=10)
+            self.assertEqual(limiter.api.used, 3)
+            self.assertAlmostEqual(limiter.api.rate, 7.5)
+            limiter.api.acquire()
+            limiter.api.acquire()
+            with self.assertRaises(QuotaExceeded):
+                limiter.api.acquire()
+            # media has its own bucket
+            limiter.media.acquire()